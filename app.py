@@ -1,62 +1,1838 @@
-import requests
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
-import pandas as pd
+from werkzeug.datastructures import FileStorage, MultiDict
 import io
 import json
+import math
+import base64
+import gzip
+import contextvars
+import bisect
+import cProfile
+import heapq
+import pstats
+import random
+import struct
+import hashlib
+import importlib
+import importlib.util
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
-import numpy as np
-import PyPDF2
 import re
-from sklearn.linear_model import LinearRegression
 
 app = Flask(__name__)
 CORS(app)
 
 # -----------------------------
-# In-memory history storage
-# This will be reset every time the application restarts.
-# For persistent storage, a database like Firestore is recommended.
+# Lazy imports
+# pandas, numpy, scipy, PyPDF2 and requests take seconds to import, which
+# adds up on every cold start. Each is bound to a LazyModule that imports the
+# real module on first use and then puts it in its place in this module.
+# warm_up() loads everything up front, e.g. before a pre-forking server
+# forks its workers; WARM_UP=1 does that at import.
 # -----------------------------
-xrd_history = []
-ir_history = []
-bet_history = []
-tga_history = []
-combined_history = []
+WARM_UP = os.environ.get('WARM_UP', '').lower() in ('1', 'true', 'yes', 'on')
+
+class LazyModule:
+    """Placeholder for a module that is imported on first attribute access."""
+
+    def __init__(self, name, alias):
+        self.name = name
+        self.alias = alias
+
+    # Underscored so it can't shadow a module attribute such as np.load
+    def _load_module(self):
+        # import_module takes the import lock, so racing threads get the same module
+        module = importlib.import_module(self.name)
+        globals()[self.alias] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load_module(), attr)
+
+np = LazyModule('numpy', 'np')
+pd = LazyModule('pandas', 'pd')
+signal = LazyModule('scipy.signal', 'signal')
+PyPDF2 = LazyModule('PyPDF2', 'PyPDF2')
+requests = LazyModule('requests', 'requests')
+
+def warm_up():
+    """Import every lazily loaded module, create the AI session and load the reference patterns and similarity indexes now rather than on the first request."""
+    for module in (np, pd, signal, PyPDF2, requests):
+        if isinstance(module, LazyModule):
+            module._load_module()
+    get_ai_session()
+    phase_index.ensure_loaded()
+    for index in similarity_indexes.values():
+        index.refresh()
+
+# -----------------------------
+# History storage
+# A local SQLite database in WAL mode, so history survives restarts and
+# readers don't block the writer. Entries are indexed by technique and
+# timestamp and searchable through an FTS5 index over the query and the
+# AI suggestion. Set HISTORY_DB to ':memory:' for a throwaway store.
+# -----------------------------
+HISTORY_DB = os.environ.get('HISTORY_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.db'))
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+
+class HistoryStore:
+    """Analysis history kept in SQLite, with cursor pagination and full-text search."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        # A private in-memory database only exists on its own connection, so share one
+        self.shared = self._connect() if path == ':memory:' else None
+        db = self._db()
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                technique TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                user_query TEXT,
+                ai_suggestion TEXT,
+                entry TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS history_technique_timestamp ON history (technique, timestamp DESC, id DESC);
+        """)
+        try:
+            db.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+                    user_query, ai_suggestion, content='history', content_rowid='id'
+                );
+                CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+                    INSERT INTO history_fts (rowid, user_query, ai_suggestion)
+                    VALUES (new.id, new.user_query, new.ai_suggestion);
+                END;
+                CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+                    INSERT INTO history_fts (history_fts, rowid, user_query, ai_suggestion)
+                    VALUES ('delete', old.id, old.user_query, old.ai_suggestion);
+                END;
+            """)
+            self.has_fts = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5; search falls back to LIKE
+            self.has_fts = False
+        db.commit()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _db(self):
+        if self.shared is not None:
+            return self.shared
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = self._connect()
+        return db
+
+    def add(self, technique, entry):
+        """Store one history entry and return its ID."""
+        with self.write_lock:
+            db = self._db()
+            cursor = db.execute(
+                "INSERT INTO history (technique, timestamp, user_query, ai_suggestion, entry) VALUES (?, ?, ?, ?, ?)",
+                (technique, entry.get('timestamp'), entry.get('user_query'), entry.get('ai_suggestion'), json.dumps(entry))
+            )
+            db.commit()
+            return cursor.lastrowid
+
+    @staticmethod
+    def _fts_query(search):
+        """Turn free text into an FTS5 query: every word must match, as a prefix."""
+        words = re.findall(r'\w+', search)
+        return ' '.join(f'"{word}"*' for word in words)
+
+    @staticmethod
+    def encode_cursor(timestamp, row_id):
+        return base64.urlsafe_b64encode(f"{timestamp}|{row_id}".encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            timestamp, row_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').rsplit('|', 1)
+            return timestamp, int(row_id)
+        except (ValueError, UnicodeError):
+            raise ValueError("Invalid history cursor.")
+
+    def page(self, technique, limit=HISTORY_PAGE_SIZE, cursor=None, search=None):
+        """Newest-first page of entries. Returns (entries, next_cursor)."""
+        sql = "SELECT h.id, h.timestamp, h.entry FROM history h"
+        params = []
+        where = ["h.technique = ?"]
+        params.append(technique)
+        if search:
+            if self.has_fts:
+                fts_query = self._fts_query(search)
+                if not fts_query:
+                    return [], None
+                # Resolve the MATCH first, then filter/sort the (few) hits by the index
+                where.append("h.id IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)")
+                params.append(fts_query)
+            else:
+                where.append("(h.user_query LIKE ? OR h.ai_suggestion LIKE ?)")
+                params.extend([f"%{search}%", f"%{search}%"])
+        if cursor:
+            timestamp, row_id = self.decode_cursor(cursor)
+            where.append("(h.timestamp < ? OR (h.timestamp = ? AND h.id < ?))")
+            params.extend([timestamp, timestamp, row_id])
+        sql += " WHERE " + " AND ".join(where) + " ORDER BY h.timestamp DESC, h.id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        rows = self._db().execute(sql, params).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self.encode_cursor(rows[-1]['timestamp'], rows[-1]['id'])
+        entries = []
+        for row in rows:
+            entry = json.loads(row['entry'])
+            entry['id'] = row['id']
+            entries.append(entry)
+        return entries, next_cursor
+
+    def get_many(self, entry_ids):
+        """Entries by ID, as {id: entry}, each with its technique. Unknown IDs are left out."""
+        if not entry_ids:
+            return {}
+        placeholders = ','.join('?' * len(entry_ids))
+        rows = self._db().execute(f"SELECT id, technique, entry FROM history WHERE id IN ({placeholders})", list(entry_ids)).fetchall()
+        return {row['id']: dict(json.loads(row['entry']), id=row['id'], technique=row['technique']) for row in rows}
+
+    def version(self):
+        """A counter that grows with every added entry, shared by all processes using the database."""
+        row = self._db().execute("SELECT seq FROM sqlite_sequence WHERE name = 'history'").fetchone()
+        return row[0] if row else 0
+
+    def count(self, technique):
+        return self._db().execute("SELECT COUNT(*) FROM history WHERE technique = ?", (technique,)).fetchone()[0]
+
+history_store = HistoryStore(HISTORY_DB)
+
+# -----------------------------
+# Spectrum blob storage
+# History entries don't embed spectra. Each spectrum is written once per
+# content hash as a float32 .npy file (one contiguous row per column) that
+# can be memory-mapped, and the entry keeps only a small reference. The
+# directory is capped by size and age; the least recently stored or read
+# blobs are evicted first.
+# -----------------------------
+SPECTRA_DIR = os.environ.get('SPECTRA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spectra'))
+SPECTRA_MAX_BYTES = int(os.environ.get('SPECTRA_MAX_BYTES', 1024 * 1024 * 1024))
+SPECTRA_RETENTION_DAYS = float(os.environ.get('SPECTRA_RETENTION_DAYS', 365))
+
+class SpectrumBlobStore:
+    """Deduplicated float32 .npy storage for parsed spectra."""
+
+    def __init__(self, directory, max_bytes, retention_days):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.retention_seconds = retention_days * 24 * 60 * 60
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self._blob_files())
+
+    def _path(self, blob_id, suffix):
+        return os.path.join(self.directory, f"{blob_id}{suffix}")
+
+    def _blob_files(self):
+        """(mtime, size, blob_id) for every stored blob."""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, stat.st_size, name[:-len('.npy')]))
+        return files
+
+    def put(self, df):
+        """Store the numeric columns of df and return a reference for a history entry."""
+        columns = [col for col in df.columns
+                   if pd.api.types.is_numeric_dtype(df[col]) or pd.api.types.is_bool_dtype(df[col])]
+        array = np.empty((len(columns), len(df)), dtype='<f4')
+        for i, col in enumerate(columns):
+            array[i] = df[col].to_numpy(dtype='<f4')
+        digest = hashlib.sha256(array.tobytes())
+        digest.update(json.dumps(columns).encode('utf-8'))
+        blob_id = digest.hexdigest()
+
+        path = self._path(blob_id, '.npy')
+        with self.lock:
+            if os.path.exists(path):
+                os.utime(path)
+            else:
+                with open(self._path(blob_id, '.json'), 'w') as f:
+                    json.dump({"columns": columns, "length": len(df)}, f)
+                tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, array)
+                os.replace(tmp_path, path)
+                self.total_bytes += os.path.getsize(path)
+                if self.total_bytes > self.max_bytes:
+                    self._evict()
+        return {"blob_id": blob_id, "columns": columns, "length": len(df)}
+
+    def load(self, blob_id):
+        """Memory-map a stored spectrum back into a DataFrame. Returns None if it was evicted."""
+        if not re.fullmatch(r'[0-9a-f]{64}', blob_id):
+            return None
+        try:
+            with open(self._path(blob_id, '.json')) as f:
+                meta = json.load(f)
+            array = np.load(self._path(blob_id, '.npy'), mmap_mode='r')
+            os.utime(self._path(blob_id, '.npy'))
+        except FileNotFoundError:
+            return None
+        return pd.DataFrame({col: array[i] for i, col in enumerate(meta["columns"])})
+
+    def _evict(self):
+        """Drop expired blobs, then the oldest ones until under the size cap. Caller holds the lock."""
+        now = time.time()
+        total = 0
+        for mtime, size, blob_id in sorted(self._blob_files(), reverse=True):
+            if total + size > self.max_bytes or now - mtime > self.retention_seconds:
+                for suffix in ('.npy', '.json'):
+                    try:
+                        os.remove(self._path(blob_id, suffix))
+                    except FileNotFoundError:
+                        pass
+            else:
+                total += size
+        self.total_bytes = total
+
+    def stats(self):
+        with self.lock:
+            return {"bytes": self.total_bytes, "max_bytes": self.max_bytes, "directory": self.directory}
+
+spectrum_blobs = SpectrumBlobStore(SPECTRA_DIR, SPECTRA_MAX_BYTES, SPECTRA_RETENTION_DAYS)
+
+# -----------------------------
+# AI Response Cache
+# Re-running an analysis with the same files and query builds the same
+# prompt, so Gemini responses are memoized on (model, canonical prompt).
+# Set AI_CACHE_DB to a file path to keep the cache across restarts.
+# -----------------------------
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-2.5-flash-preview-05-20')
+AI_CACHE_MAX_ITEMS = int(os.environ.get('AI_CACHE_MAX_ITEMS', 512))
+AI_CACHE_TTL_SECONDS = int(os.environ.get('AI_CACHE_TTL_SECONDS', 24 * 60 * 60))
+AI_CACHE_DB = os.environ.get('AI_CACHE_DB')
+
+def canonicalize_prompt(prompt):
+    """Collapse whitespace so indentation and blank-line differences don't change the cache key."""
+    return ' '.join(prompt.split())
+
+class AICache:
+    """TTL + LRU cache of AI responses, optionally backed by SQLite."""
+
+    def __init__(self, max_items, ttl_seconds, db_path=None):
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # key -> (created, text)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS ai_cache ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL, last_used REAL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS ai_cache_last_used ON ai_cache (last_used)")
+            self.db.commit()
+
+    @staticmethod
+    def make_key(model, prompt):
+        return hashlib.sha256(f"{model}\0{canonicalize_prompt(prompt)}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] > self.ttl_seconds:
+                del self.entries[key]
+                entry = None
+            if entry is None and self.db is not None:
+                row = self.db.execute(
+                    "SELECT created, response FROM ai_cache WHERE key = ? AND created >= ?",
+                    (key, now - self.ttl_seconds)
+                ).fetchone()
+                if row is not None:
+                    self.db.execute("UPDATE ai_cache SET last_used = ? WHERE key = ?", (now, key))
+                    self.db.commit()
+                    entry = (row[0], row[1])
+                    self._remember(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, model, text):
+        now = time.time()
+        with self.lock:
+            self._remember(key, (now, text))
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO ai_cache (key, model, response, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (key, model, text, now, now)
+                )
+                self.db.execute("DELETE FROM ai_cache WHERE created < ?", (now - self.ttl_seconds,))
+                self.db.execute(
+                    "DELETE FROM ai_cache WHERE key NOT IN "
+                    "(SELECT key FROM ai_cache ORDER BY last_used DESC LIMIT ?)",
+                    (self.max_items,)
+                )
+                self.db.commit()
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_items:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "items": len(self.entries),
+                "max_items": self.max_items,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "persistent": self.db is not None
+            }
+
+ai_cache = AICache(AI_CACHE_MAX_ITEMS, AI_CACHE_TTL_SECONDS, AI_CACHE_DB)
+
+def bypass_cache_requested():
+    """True if the client set the bypass_cache form field (or query parameter)."""
+    value = request.form.get('bypass_cache') or request.args.get('bypass_cache') or ''
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+# -----------------------------
+# AI Client
+# One shared keep-alive session for all Gemini calls, with connect/read
+# timeouts and retry with exponential backoff on connection errors and
+# 429/5xx responses. GEMINI_API_BASE can point at a local stub server.
+# -----------------------------
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', "YOUR_API_KEY_HERE")
+GEMINI_API_BASE = os.environ.get('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com/v1beta')
+AI_CONNECT_TIMEOUT = float(os.environ.get('AI_CONNECT_TIMEOUT', 5))
+AI_READ_TIMEOUT = float(os.environ.get('AI_READ_TIMEOUT', 120))
+AI_MAX_RETRIES = int(os.environ.get('AI_MAX_RETRIES', 3))
+AI_POOL_SIZE = int(os.environ.get('AI_POOL_SIZE', 16))
+
+ai_session = None
+ai_session_lock = threading.Lock()
+
+def create_ai_session():
+    """Build a pooled requests session with retry/backoff for the AI API."""
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=AI_MAX_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['POST']),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=AI_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Content-Type': 'application/json'})
+    return session
+
+def get_ai_session():
+    """Create the shared session on first use."""
+    global ai_session
+    with ai_session_lock:
+        if ai_session is None:
+            ai_session = create_ai_session()
+    return ai_session
+
+def ai_url(method):
+    return f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:{method}"
 
 # -----------------------------
 # Helper Functions
 # -----------------------------
-def get_ai_suggestion(prompt):
-    """Generate suggestion using Gemini API."""
+def get_ai_suggestion(prompt, use_cache=True):
+    """Generate suggestion using Gemini API.
+
+    Identical prompts are answered from ai_cache. With use_cache=False the
+    API is always called and the fresh answer replaces the cached one.
+    """
+    cache_key = AICache.make_key(GEMINI_MODEL, prompt)
+    if use_cache:
+        cached = ai_cache.get(cache_key)
+        if cached is not None:
+            return cached
     try:
-        api_key = "YOUR_API_KEY_HERE"
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={api_key}"
-        headers = {'Content-Type': 'application/json'}
         payload = {"contents": [{"parts": [{"text": prompt}]}]}
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
+        with ai_gate.admit():
+            response = get_ai_session().post(
+                ai_url('generateContent'),
+                params={'key': GEMINI_API_KEY},
+                data=json.dumps(payload),
+                timeout=(AI_CONNECT_TIMEOUT, AI_READ_TIMEOUT)
+            )
         response.raise_for_status()
         candidate = response.json().get('candidates', [{}])[0]
         generated_text = candidate.get('content', {}).get('parts', [{}])[0].get('text', 'No response from AI.')
+        # Failed generations are not cached so a retry gets a real answer
+        if candidate.get('content'):
+            ai_cache.put(cache_key, GEMINI_MODEL, generated_text)
         return generated_text
     except requests.exceptions.RequestException as e:
         print(f"API request failed: {e}")
         return f"Error: Failed to connect to AI service. {e}"
 
-def parse_xrd_data(file):
-    import pandas as pd
-    import io
-    import numpy as np
-    
-    # Read the data from the CSV file
-    content = file.stream.read().decode('utf-8')
-    df = pd.read_csv(io.StringIO(content))
+def stream_ai_suggestion(prompt, use_cache=True):
+    """Like get_ai_suggestion, but yields text chunks as Gemini generates them."""
+    cache_key = AICache.make_key(GEMINI_MODEL, prompt)
+    if use_cache:
+        cached = ai_cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+    chunks = []
+    try:
+        payload = {"contents": [{"parts": [{"text": prompt}]}]}
+        with ai_gate.admit(), get_ai_session().post(
+            ai_url('streamGenerateContent'),
+            params={'key': GEMINI_API_KEY, 'alt': 'sse'},
+            data=json.dumps(payload),
+            timeout=(AI_CONNECT_TIMEOUT, AI_READ_TIMEOUT),
+            stream=True
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                event = json.loads(line[len('data:'):])
+                candidate = (event.get('candidates') or [{}])[0]
+                for part in candidate.get('content', {}).get('parts', []):
+                    text = part.get('text')
+                    if text:
+                        chunks.append(text)
+                        yield text
+    except Overloaded as e:
+        # The response has started, so the rejection can only be reported in the text
+        yield f"Error: {e}"
+        return
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"API streaming request failed: {e}")
+        yield f"Error: Failed to connect to AI service. {e}"
+        return
+    if chunks:
+        ai_cache.put(cache_key, GEMINI_MODEL, ''.join(chunks))
+    else:
+        yield 'No response from AI.'
+
+# -----------------------------
+# Request Metrics
+# Every request gets an X-Request-ID (the client's, if it sent a sane one).
+# /analyze-* and follow-up requests also get a RequestTimer; code marks its
+# stages with `with timed('parse'):`. The totals go back in a Server-Timing
+# header and into Prometheus histograms served on /metrics. Stages that run
+# in parallel (e.g. one parse per upload) add up, so a stage can exceed the
+# request's wall time. Parsers in the process pool aren't broken down further.
+# Set PROFILE_SLOWEST to keep cProfile stats of the N slowest requests among
+# a PROFILE_SAMPLE_RATE share of them, listed on /metrics/profiles.
+# -----------------------------
+TIMED_PATH_PREFIX = '/analyze-'
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(1024 * 4 ** k for k in range(11))  # 1 KiB to 1 GiB
+REQUEST_ID_PATTERN = re.compile(r'[\w.:-]{1,64}')
+PROFILE_SLOWEST = int(os.environ.get('PROFILE_SLOWEST', 0))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.1))
+PROFILE_TOP_FUNCTIONS = 30
+
+class Histogram:
+    """A Prometheus histogram with one series per combination of label values."""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            counts, total = self.series.get(label_values, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.series[label_values] = (counts, total + value)
+
+    def render(self):
+        """The histogram in the Prometheus text exposition format."""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in sorted(self.series.items())]
+        for label_values, counts, total in series:
+            labels = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return '\n'.join(lines)
+
+request_duration = Histogram('analysis_request_duration_seconds', 'Time spent handling analysis requests.',
+                             ('endpoint', 'status'), DURATION_BUCKETS)
+stage_duration = Histogram('analysis_stage_duration_seconds', 'Time spent per stage of analysis requests.',
+                           ('endpoint', 'stage'), DURATION_BUCKETS)
+request_size = Histogram('analysis_request_bytes', 'Size of analysis request bodies.', ('endpoint',), SIZE_BUCKETS)
+response_size = Histogram('analysis_response_bytes', 'Size of analysis response bodies.', ('endpoint',), SIZE_BUCKETS)
+
+class RequestTimer:
+    """Per-stage durations of one request. Stages may be timed from several threads."""
+
+    def __init__(self, endpoint, request_id):
+        self.endpoint = endpoint or 'unknown'
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.profiler = None
+        if PROFILE_SLOWEST and random.random() < PROFILE_SAMPLE_RATE:
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # Another profiler is already active on this thread
+                self.profiler = None
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self):
+        """The stages so far as a Server-Timing header value, in milliseconds."""
+        with self.lock:
+            stages = list(self.stages.items())
+        stages.append(('total', time.perf_counter() - self.started))
+        return ', '.join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in stages)
+
+    def finish(self, status, request_bytes=None, response_bytes=None):
+        """Record the finished request in the /metrics histograms."""
+        elapsed = time.perf_counter() - self.started
+        request_duration.observe(elapsed, self.endpoint, str(status))
+        with self.lock:
+            stages = list(self.stages.items())
+        for stage, seconds in stages:
+            stage_duration.observe(seconds, self.endpoint, stage)
+        if request_bytes is not None:
+            request_size.observe(request_bytes, self.endpoint)
+        if response_bytes is not None:
+            response_size.observe(response_bytes, self.endpoint)
+        if self.profiler is not None:
+            self.profiler.disable()
+            slow_profiles.offer(elapsed, self)
+
+class SlowProfiles:
+    """The cProfile stats of the PROFILE_SLOWEST slowest profiled requests."""
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.heap = []  # (duration, request_id, entry), fastest first
+        self.lock = threading.Lock()
+
+    def offer(self, duration, timer):
+        with self.lock:
+            if len(self.heap) >= self.max_items and duration <= self.heap[0][0]:
+                return
+        # Formatting the stats is the slow part, so only do it for a keeper
+        stats = io.StringIO()
+        pstats.Stats(timer.profiler, stream=stats).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        entry = {
+            "request_id": timer.request_id,
+            "endpoint": timer.endpoint,
+            "duration": duration,
+            "stages": dict(timer.stages),
+            "recorded": datetime.now().isoformat(),
+            "stats": stats.getvalue()
+        }
+        with self.lock:
+            heapq.heappush(self.heap, (duration, timer.request_id, entry))
+            if len(self.heap) > self.max_items:
+                heapq.heappop(self.heap)
+
+    def slowest(self):
+        with self.lock:
+            return [entry for _, _, entry in sorted(self.heap, key=lambda item: item[0], reverse=True)]
+
+slow_profiles = SlowProfiles(PROFILE_SLOWEST)
+
+def current_timer():
+    return g.get('timer') if g else None
+
+@contextmanager
+def timed(stage, timer=None):
+    """Add the time spent in the block to a stage of timer (default: the current request's)."""
+    timer = timer or current_timer()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timer is not None:
+            timer.add(stage, time.perf_counter() - started)
+
+@app.before_request
+def start_request_timer():
+    client_id = request.headers.get('X-Request-ID', '')
+    g.request_id = client_id if REQUEST_ID_PATTERN.fullmatch(client_id) else uuid.uuid4().hex
+    # An async submission is timed by its job instead
+    if request.path.startswith(TIMED_PATH_PREFIX) and not async_requested():
+        g.timer = RequestTimer(request.endpoint, g.request_id)
+
+@app.after_request
+def finish_request_timer(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    timer = g.pop('timer', None)
+    if timer is None:
+        return response
+    response.headers['Server-Timing'] = timer.server_timing()
+    request_bytes = request.content_length
+    if response.is_streamed:
+        # The AI answer is still to come; finish once the stream is done
+        response.call_on_close(lambda: timer.finish(response.status_code, request_bytes))
+    else:
+        timer.finish(response.status_code, request_bytes, response.content_length)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request and stage histograms in the Prometheus text format."""
+    body = '\n'.join([histogram.render() for histogram in (request_duration, stage_duration, request_size, response_size)]
+                     + [render_admission_metrics()])
+    return Response(body + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/profiles', methods=['GET'])
+def get_slow_profiles():
+    return jsonify({"enabled": PROFILE_SLOWEST > 0, "profiles": slow_profiles.slowest()})
+
+# -----------------------------
+# Admission Control
+# CPU-bound parsing and outbound AI calls each pass through an AdmissionGate:
+# at most `limit` run at once, up to `queue_size` more wait their turn for at
+# most `timeout` seconds, and anything beyond that is turned away at once
+# with a 503 and Retry-After. Parse cache and AI cache hits skip the gates.
+# Queue depth and rejections are exported on /metrics. A limit of 0 disables
+# a gate.
+# -----------------------------
+PARSE_MAX_CONCURRENT = int(os.environ.get('PARSE_MAX_CONCURRENT', os.cpu_count() or 1))
+PARSE_QUEUE_SIZE = int(os.environ.get('PARSE_QUEUE_SIZE', 16))
+PARSE_QUEUE_TIMEOUT = float(os.environ.get('PARSE_QUEUE_TIMEOUT', 30))
+AI_MAX_CONCURRENT = int(os.environ.get('AI_MAX_CONCURRENT', 16))
+AI_QUEUE_SIZE = int(os.environ.get('AI_QUEUE_SIZE', 32))
+AI_QUEUE_TIMEOUT = float(os.environ.get('AI_QUEUE_TIMEOUT', 30))
+# Bounds for the Retry-After estimate, in seconds
+RETRY_AFTER_MIN = 1
+RETRY_AFTER_MAX = 60
+
+class Overloaded(Exception):
+    """Raised when an AdmissionGate turns work away."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdmissionGate:
+    """A concurrency limit with a bounded, deadline-limited waiting queue."""
+
+    def __init__(self, name, label, limit, queue_size, timeout):
+        self.name = name
+        self.label = label
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = {'queue_full': 0, 'timeout': 0}
+        # Moving average of how long work holds a slot, for Retry-After
+        self.average_hold = 1.0
+        self.condition = threading.Condition()
+
+    def retry_after(self):
+        """Seconds until the current backlog should have cleared."""
+        estimate = self.average_hold * (self.waiting + 1) / max(self.limit, 1)
+        return int(min(max(estimate, RETRY_AFTER_MIN), RETRY_AFTER_MAX))
+
+    def reject(self, reason, message):
+        self.rejected[reason] += 1
+        return Overloaded(message, self.retry_after())
+
+    def acquire(self):
+        with self.condition:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                self.admitted += 1
+                return
+            if self.waiting >= self.queue_size:
+                raise self.reject('queue_full', f"The server is at capacity for {self.label}. Please retry shortly.")
+            self.waiting += 1
+            try:
+                admitted = self.condition.wait_for(lambda: self.active < self.limit, timeout=self.timeout)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                raise self.reject('timeout', f"Timed out waiting for capacity for {self.label}. Please retry shortly.")
+            self.active += 1
+            self.admitted += 1
+
+    def release(self, held):
+        with self.condition:
+            self.active -= 1
+            self.average_hold = 0.9 * self.average_hold + 0.1 * held
+            self.condition.notify()
+
+    @contextmanager
+    def admit(self):
+        """Hold a slot for the duration of the block. Raises Overloaded if none can be had."""
+        if self.limit <= 0:
+            yield
+            return
+        with timed(f"{self.name}_queue"):
+            self.acquire()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - started)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "limit": self.limit,
+                "active": self.active,
+                "waiting": self.waiting,
+                "queue_size": self.queue_size,
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected)
+            }
+
+parse_gate = AdmissionGate('parse', 'file parsing', PARSE_MAX_CONCURRENT, PARSE_QUEUE_SIZE, PARSE_QUEUE_TIMEOUT)
+ai_gate = AdmissionGate('ai', 'AI requests', AI_MAX_CONCURRENT, AI_QUEUE_SIZE, AI_QUEUE_TIMEOUT)
+admission_gates = (parse_gate, ai_gate)
+
+def overloaded_response(e):
+    response = jsonify({"error": str(e)})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+def render_admission_metrics():
+    """Gate occupancy and rejections in the Prometheus text format."""
+    stats = [(gate.name, gate.stats()) for gate in admission_gates]
+    lines = []
+    for metric, kind, help_text, key in (
+        ('analysis_admission_limit', 'gauge', 'Concurrent work allowed past each gate.', 'limit'),
+        ('analysis_admission_active', 'gauge', 'Work currently past each gate.', 'active'),
+        ('analysis_admission_waiting', 'gauge', 'Work queued at each gate.', 'waiting'),
+        ('analysis_admission_admitted_total', 'counter', 'Work admitted by each gate.', 'admitted'),
+    ):
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"]
+        lines += [f'{metric}{{gate="{name}"}} {gate_stats[key]}' for name, gate_stats in stats]
+    metric = 'analysis_admission_rejected_total'
+    lines += [f"# HELP {metric} Work turned away by each gate.", f"# TYPE {metric} counter"]
+    for name, gate_stats in stats:
+        lines += [f'{metric}{{gate="{name}",reason="{reason}"}} {count}' for reason, count in gate_stats['rejected'].items()]
+    return '\n'.join(lines)
+
+# -----------------------------
+# CSV Ingestion
+# Instrument exports can run to hundreds of MB. Parsers sniff the header from
+# the first CSV_SNIFF_BYTES, then parse only the columns they need straight
+# from the upload's byte stream (no decoded copy of the text), as float32,
+# with the pyarrow CSV engine when it is installed.
+# -----------------------------
+CSV_ENGINE = os.environ.get('CSV_ENGINE') or ('pyarrow' if importlib.util.find_spec('pyarrow') else 'c')
+CSV_SNIFF_BYTES = 64 * 1024
+
+def sniff_csv(file, header='infer'):
+    """Parse the first rows of an uploaded CSV to learn its columns, then rewind."""
+    stream = file.stream
+    stream.seek(0)
+    head = stream.read(CSV_SNIFF_BYTES)
+    stream.seek(0)
+    if len(head) == CSV_SNIFF_BYTES and b'\n' in head:
+        head = head[:head.rindex(b'\n') + 1]
+    return pd.read_csv(io.BytesIO(head), header=header)
+
+def read_csv_columns(file, columns, dtype='float32', header='infer', engine=None, **read_options):
+    """Parse only the given columns of an uploaded CSV from its byte stream.
+
+    engine overrides CSV_ENGINE, e.g. for separators pyarrow doesn't support;
+    read_options go to pd.read_csv.
+    """
+    stream = file.stream
+    stream.seek(0)
+    options = {"usecols": list(columns), "header": header, **read_options}
+    with timed('decode'):
+        try:
+            return pd.read_csv(stream, dtype=dtype and {col: dtype for col in columns}, engine=engine or CSV_ENGINE, **options)
+        except ValueError:
+            if dtype is None:
+                raise
+            # Some value past the sniffed rows isn't numeric: coerce it to NaN instead
+            stream.seek(0)
+            df = pd.read_csv(stream, dtype=str, **options)
+            return df.apply(pd.to_numeric, errors='coerce').astype(dtype)
+
+def widen_float32(df):
+    """float32 columns as float64 rounded to float32 precision, so JSON shows 10.0035 rather than 10.003499984741211."""
+    float32_cols = [col for col in df.columns if df[col].dtype == np.float32]
+    if not float32_cols:
+        return df
+    widened = {}
+    for col in float32_cols:
+        values = df[col].to_numpy(dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # 7 significant digits, the most float32 holds
+            magnitude = np.floor(np.log10(np.abs(values)))
+            scale = 10.0 ** (6 - np.where(np.isfinite(magnitude), magnitude, 0))
+        widened[col] = np.round(values * scale) / scale
+    return df.assign(**widened)
+
+def peak_rows(df, x_col, peaks):
+    """Row index of each peak record, in the same order, or -1 where no row matches.
+
+    Peak records carry x values rounded by widen_float32, so the column is
+    rounded the same way before they are looked up.
+    """
+    x = widen_float32(df[[x_col]])[x_col].to_numpy(dtype=np.float64)
+    peak_x = np.array([peak[x_col] for peak in peaks], dtype=np.float64)
+    order = np.argsort(x, kind='stable')
+    found = order[np.minimum(np.searchsorted(x, peak_x, sorter=order), len(x) - 1)]
+    return np.where(x[found] == peak_x, found, -1)
+
+# -----------------------------
+# Spectrum Readers
+# XRD and IR uploads don't have to be headed CSV. The format is sniffed from
+# the content, so the same bytes always parse the same way whatever the
+# file is called:
+#   npy/npz - NumPy arrays, viewed in place with no text parsing
+#   xy      - headerless numeric tables (.xy, .xye, .dpt, ...): whitespace or
+#             comma separated, after any comment or title lines; the first
+#             two columns are x and y and the rest (e.g. .xye errors) is ignored
+#   csv     - everything else, with each parser's column detection
+# -----------------------------
+NPY_MAGIC = b'\x93NUMPY'
+ZIP_MAGIC = b'PK\x03\x04'
+# A title or comment block longer than this isn't an .xy file
+SPECTRUM_MAX_HEADER_LINES = 50
+NUMBER = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+XY_WHITESPACE_LINE = re.compile(rf'{NUMBER}(?:\s+{NUMBER})+')
+XY_COMMA_LINE = re.compile(rf'{NUMBER}(?:\s*,\s*{NUMBER})+')
+# Array names recognized in an .npz holding separate x and y arrays
+NPZ_X_NAMES = ('x', 'pos', '2theta', 'two_theta', 'twotheta', 'angle', 'wavenumber')
+NPZ_Y_NAMES = ('y', 'iobs', 'intensity', 'counts', 'absorbance', 'transmittance')
+
+def sniff_spectrum(file):
+    """Work out how to read an XRD/IR upload from its first bytes.
+
+    Returns:
+        (kind, options): kind is 'npy', 'npz', 'xy' or 'csv'; for 'xy',
+        options are the read_csv arguments for the data lines.
+    """
+    stream = file.stream
+    stream.seek(0)
+    head = stream.read(CSV_SNIFF_BYTES)
+    stream.seek(0)
+    if head.startswith(NPY_MAGIC):
+        return 'npy', {}
+    if head.startswith(ZIP_MAGIC):
+        return 'npz', {}
+    for skip, line in enumerate(head.split(b'\n')[:SPECTRUM_MAX_HEADER_LINES + 1]):
+        line = line.decode('latin-1').strip()
+        if XY_WHITESPACE_LINE.fullmatch(line):
+            return 'xy', {"sep": r'\s+', "skiprows": skip}
+        if XY_COMMA_LINE.fullmatch(line):
+            # A comma-separated file with a header line is a regular CSV
+            return ('xy', {"sep": ',', "skiprows": 0}) if skip == 0 else ('csv', {})
+    return 'csv', {}
+
+def load_npy(stream):
+    """The array in an .npy stream, as a read-only view of an in-memory upload's buffer when possible."""
+    stream.seek(0)
+    version = np.lib.format.read_magic(stream)
+    if version not in ((1, 0), (2, 0)) or not hasattr(stream, 'getbuffer'):
+        stream.seek(0)
+        return np.load(stream, allow_pickle=False)
+    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+    shape, fortran_order, dtype = read_header(stream)
+    if dtype.hasobject:
+        raise ValueError("The .npy file holds Python objects, not numbers.")
+    data = np.frombuffer(stream.getbuffer(), dtype=dtype, count=math.prod(shape), offset=stream.tell())
+    return data.reshape(shape, order='F' if fortran_order else 'C')
+
+def array_columns(array):
+    """x and y from an (n, 2+) array of columns or a (2+, n) array of rows."""
+    if array.ndim == 2 and array.shape[1] in (2, 3):
+        return array[:, 0], array[:, 1]
+    if array.ndim == 2 and array.shape[0] in (2, 3):
+        return array[0], array[1]
+    raise ValueError(f"Expected an array of shape (n, 2) or (2, n), got {array.shape}.")
+
+def load_numpy_spectrum(stream, kind):
+    """x and y arrays from an .npy or .npz upload."""
+    if kind == 'npy':
+        return array_columns(load_npy(stream))
+    stream.seek(0)
+    try:
+        archive = np.load(stream, allow_pickle=False)
+    except (ValueError, zipfile.BadZipFile) as e:
+        raise ValueError(f"Could not read the .npz file: {e}")
+    with archive:
+        if len(archive.files) == 1:
+            return array_columns(archive[archive.files[0]])
+        names = {name.lower(): name for name in archive.files}
+        x_name = next((names[name] for name in NPZ_X_NAMES if name in names), None)
+        y_name = next((names[name] for name in NPZ_Y_NAMES if name in names), None)
+        if x_name is None or y_name is None:
+            raise ValueError("The .npz file must hold one (n, 2) array, or x and y arrays (e.g. 'x' and 'y').")
+        return archive[x_name], archive[y_name]
+
+def read_spectrum(file, names):
+    """Read an npy, npz or xy upload as a float32 DataFrame with columns names.
+
+    Returns None for a CSV, which the caller reads with its own column detection.
+    """
+    kind, options = sniff_spectrum(file)
+    if kind == 'csv':
+        return None
+    if kind == 'xy':
+        df = read_csv_columns(file, [0, 1], header=None, engine='c', **options)
+        return df.set_axis(names, axis=1)
+    x, y = load_numpy_spectrum(file.stream, kind)
+    if len(x) != len(y) or not (np.issubdtype(x.dtype, np.number) and np.issubdtype(y.dtype, np.number)):
+        raise ValueError("The x and y arrays must be numeric and of the same length.")
+    return pd.DataFrame({names[0]: np.asarray(x, dtype=np.float32), names[1]: np.asarray(y, dtype=np.float32)})
+
+# -----------------------------
+# Peak Detection
+# One engine for XRD and IR: Savitzky-Golay smoothing, then peaks filtered by
+# prominence, width and spacing. Prominence is a fraction of the smoothed
+# spectrum's range; width, distance and the smoothing window are in points.
+# Any setting can be overridden per request, see get_peak_settings().
+# -----------------------------
+PEAK_DEFAULTS = {
+    'xrd': {"smooth_window": 5, "smooth_order": 2, "prominence": 0.02, "width": 1, "distance": 3, "max_peaks": 10},
+    'ir': {"smooth_window": 7, "smooth_order": 2, "prominence": 0.05, "width": 2, "distance": 5, "max_peaks": 5},
+}
+
+@timed('peaks')
+def detect_peaks(y, smooth_window=5, smooth_order=2, prominence=0.02, width=1, distance=3, max_peaks=10):
+    """Find the most intense peaks in one spectrum or a 2-D stack of spectra (one per row).
+
+    Returns:
+        (smoothed, peaks): the smoothed intensities, same shape as y, and the
+        peak indices ordered by decreasing raw intensity (one array per row for
+        a stack).
+    """
+    y = np.asarray(y)
+    stack = np.atleast_2d(y)
+    n = stack.shape[1]
+
+    # savgol_filter needs an odd window longer than the polynomial order and no longer than the data
+    window = min(int(smooth_window), n if n % 2 else n - 1)
+    window -= 1 - window % 2
+    if window > smooth_order:
+        smoothed = signal.savgol_filter(stack, window, int(smooth_order), axis=-1)
+    else:
+        smoothed = stack
+
+    span = np.ptp(smoothed, axis=-1) if n else np.zeros(len(stack))
+    peaks = []
+    for row, raw, rng in zip(smoothed, stack, span):
+        if not max_peaks:
+            peaks.append(np.array([], dtype=np.intp))
+            continue
+        found, _ = signal.find_peaks(row, prominence=prominence * rng, width=width, distance=max(1, int(distance)))
+        peaks.append(found[np.argsort(raw[found], kind='stable')[::-1][:max_peaks]])
+    return (smoothed, peaks) if y.ndim == 2 else (smoothed[0], peaks[0])
+
+def get_peak_settings(technique):
+    """Per-request peak settings from the form or query string, e.g. peak_prominence=0.1.
+
+    A technique prefix (xrd_peak_prominence) takes precedence, so
+    /analyze-combined can tune XRD and IR separately. Only overrides are
+    returned; the parsers fill in PEAK_DEFAULTS.
+    """
+    settings = {}
+    for name, default in PEAK_DEFAULTS[technique].items():
+        field = name if name.startswith('smooth') or name == 'max_peaks' else f"peak_{name}"
+        value = request.values.get(f"{technique}_{field}") or request.values.get(field)
+        if value is None or value == '':
+            continue
+        try:
+            value = type(default)(value)
+        except ValueError:
+            raise ValueError(f"{field} must be a number.")
+        if value < 0:
+            raise ValueError(f"{field} must not be negative.")
+        settings[name] = value
+    return settings
+
+# -----------------------------
+# BET Fitting
+# Closed-form least squares over every contiguous window of the isotherm at
+# once: prefix sums give each window's fit in O(1). A window qualifies if it
+# meets the Rouquerol consistency criteria:
+#   1. Va(1 - P/P0) increases with P/P0 across the window
+#   2. C > 0
+#   3. the monolayer pressure 1 / (sqrt(C) + 1) lies inside the window
+# The qualifying window with the most points wins, then the highest R².
+# -----------------------------
+BET_MIN_POINTS = 3
+BET_FALLBACK_RANGE = (0.05, 0.35)
+# The window arrays grow with points squared. Longer isotherms are thinned
+# evenly to BET_MAX_FIT_POINTS to choose the window, which is then refitted on
+# every point inside it. Stacks are fitted in chunks of at most
+# BET_MAX_WINDOWS windows.
+BET_MAX_FIT_POINTS = 300
+BET_MAX_WINDOWS = 500_000
+
+@timed('bet_fit')
+def fit_bet(p, va, rouquerol=True, min_points=BET_MIN_POINTS):
+    """Fit the BET equation to one isotherm or a stack of isotherms.
+
+    Args:
+        p, va: relative pressures and adsorbed volumes. 1-D for one isotherm,
+            or 2-D with one isotherm per row (pad shorter rows with NaN).
+        rouquerol: If False, any window with a positive Vm qualifies, which
+            selects the whole (pre-filtered) range.
+
+    Returns:
+        A dict with vm, c, r2, p_min, p_max and n_points, or None if no window
+        qualifies. A list of those for a 2-D input. For isotherms longer than
+        BET_MAX_FIT_POINTS the window is chosen on the thinned points, and
+        vm, c, r2 and n_points come from a refit on all points inside it.
+    """
+    single = np.ndim(p) == 1
+    p = np.atleast_2d(np.asarray(p, dtype=np.float64))
+    va = np.atleast_2d(np.asarray(va, dtype=np.float64))
+
+    # Drop unusable points (NaN sorts last) and order each isotherm by pressure
+    usable = (p > 0) & (p < 1) & (va > 0)
+    p = np.where(usable, p, np.nan)
+    order = np.argsort(p, axis=1)
+    p = np.take_along_axis(p, order, axis=1)
+    va = np.take_along_axis(np.where(usable, va, np.nan), order, axis=1)
+    n_usable = usable.sum(axis=1)
+
+    thinned = n_usable > BET_MAX_FIT_POINTS
+    full_p, full_va = p, va
+    if thinned.any():
+        thinned_p = np.full((len(p), BET_MAX_FIT_POINTS), np.nan)
+        thinned_va = np.full((len(p), BET_MAX_FIT_POINTS), np.nan)
+        for row, k in enumerate(n_usable):
+            keep = np.unique(np.linspace(0, k - 1, min(k, BET_MAX_FIT_POINTS)).round().astype(int))
+            thinned_p[row, :len(keep)] = p[row, keep]
+            thinned_va[row, :len(keep)] = va[row, keep]
+        p, va = thinned_p, thinned_va
+        n_usable = np.minimum(n_usable, BET_MAX_FIT_POINTS)
+    # Trailing columns that are padding in every row
+    width = max(int(n_usable.max(initial=0)), 1)
+    p, va = p[:, :width], va[:, :width]
+
+    rows_per_chunk = max(1, BET_MAX_WINDOWS // (width * width))
+    fits = []
+    for start in range(0, len(p), rows_per_chunk):
+        chunk = slice(start, start + rows_per_chunk)
+        fits.extend(fit_bet_windows(p[chunk], va[chunk], n_usable[chunk], rouquerol, min_points))
+    for row in np.flatnonzero(thinned):
+        if fits[row] is not None:
+            fits[row].update(refit_bet_window(full_p[row], full_va[row], fits[row]["p_min"], fits[row]["p_max"]))
+    return fits[0] if single else fits
+
+def refit_bet_window(p, va, p_min, p_max):
+    """Least-squares BET line through every point with p_min <= P/P0 <= p_max."""
+    inside = (p >= p_min) & (p <= p_max)
+    x = p[inside]
+    y = x / (va[inside] * (1 - x))
+    slope, intercept = np.polyfit(x, y, 1)
+    return {
+        "vm": float(1 / (slope + intercept)),
+        "c": float(slope / intercept + 1),
+        "r2": float(np.corrcoef(x, y)[0, 1] ** 2),
+        "n_points": int(inside.sum())
+    }
+
+def fit_bet_windows(p, va, n_usable, rouquerol, min_points):
+    """Score every window of pressure-sorted, NaN-padded isotherms and return the best fit per row."""
+    m, n = p.shape
+    with np.errstate(all='ignore'):
+        y = p / (va * (1 - p))
+        # Centering keeps the prefix-sum differences well conditioned
+        x_mean = np.nanmean(np.where(n_usable[:, None] > 0, p, 0), axis=1, keepdims=True)
+        y_mean = np.nanmean(np.where(n_usable[:, None] > 0, y, 0), axis=1, keepdims=True)
+        xc = np.nan_to_num(p - x_mean)
+        yc = np.nan_to_num(y - y_mean)
+
+        def prefix(a):
+            return np.concatenate([np.zeros((m, 1)), np.cumsum(a, axis=1)], axis=1)
+
+        def window(a):
+            # [row, i, j] = sum of a over points i..j
+            sums = prefix(a)
+            return sums[:, None, 1:] - sums[:, :n, None]
+
+        sx, sy = window(xc), window(yc)
+        sxx, sxy, syy = window(xc * xc), window(xc * yc), window(yc * yc)
+        first = np.arange(n)[:, None]
+        last = np.arange(n)[None, :]
+        count = (last - first + 1).astype(np.float64)
+
+        var_x = sxx - sx * sx / count
+        cov_xy = sxy - sx * sy / count
+        var_y = syy - sy * sy / count
+        slope = cov_xy / var_x
+        intercept = y_mean[:, :, None] + (sy - slope * sx) / count - slope * x_mean[:, :, None]
+        r2 = cov_xy * cov_xy / (var_x * var_y)
+        vm = 1 / (slope + intercept)
+        c = slope / intercept + 1
+
+        valid = (count >= min_points) & (last < n_usable[:, None, None]) & (vm > 0)
+        if rouquerol:
+            # steps[row, k] counts the first k steps where Va(1 - p) fails to increase
+            steps = prefix(~(np.diff(va * (1 - p), axis=1) > 0))[:, :n]
+            increasing = (steps[:, None, :] - steps[:, :, None]) == 0
+            p_monolayer = 1 / (np.sqrt(c) + 1)
+            valid &= increasing & (c > 0) & (p_monolayer >= p[:, :, None]) & (p_monolayer <= p[:, None, :])
+
+        score = np.where(valid, count + np.nan_to_num(r2), -np.inf).reshape(m, -1)
+
+    fits = []
+    for row, best in enumerate(np.argmax(score, axis=1)):
+        if not np.isfinite(score[row, best]):
+            fits.append(None)
+            continue
+        i, j = divmod(best, n)
+        fits.append({
+            "vm": float(vm[row, i, j]),
+            "c": float(c[row, i, j]),
+            "r2": float(r2[row, i, j]),
+            "p_min": float(p[row, i]),
+            "p_max": float(p[row, j]),
+            "n_points": int(j - i + 1),
+            "rouquerol": rouquerol
+        })
+    return fits
+
+# -----------------------------
+# Phase Identification
+# Reference stick patterns are read from REFERENCE_PATTERNS_DIR: CSV or
+# whitespace tables with a header naming a d-spacing (Å) or 2θ column and an
+# intensity column, plus optionally a phase column so one file can hold many
+# phases (otherwise the file name is the phase). Every line of every phase
+# goes into one array sorted by d, and the built index is saved next to the
+# references, to be reloaded as long as the files are unchanged.
+# Observed peaks are matched by binary search for the window of ±tolerance
+# in 2θ around each peak. Each phase with at least PHASE_MIN_MATCHES matched
+# peaks gets a figure of merit in [0, 1]: the fraction of observed intensity
+# it explains, times the fraction of its strong lines (in the scanned range)
+# that were found, times a penalty for the mean position error.
+# -----------------------------
+REFERENCE_PATTERNS_DIR = os.environ.get('REFERENCE_PATTERNS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'references'))
+REFERENCE_INDEX_FILE = os.environ.get('REFERENCE_INDEX_FILE', os.path.join(REFERENCE_PATTERNS_DIR, '.index.npz'))
+REFERENCE_EXTENSIONS = ('.csv', '.txt', '.dat', '.stick')
+# Wavelength of 2θ columns in reference files and the default for uploads (Cu Kα1, Å)
+XRD_WAVELENGTH = float(os.environ.get('XRD_WAVELENGTH', 1.5406))
+PHASE_TOLERANCE = float(os.environ.get('PHASE_TOLERANCE', 0.2))  # degrees 2θ
+PHASE_MIN_MATCHES = 2
+PHASE_MAX_CANDIDATES = int(os.environ.get('PHASE_MAX_CANDIDATES', 5))
+# Reference lines at least this strong (percent of the phase's strongest) must be seen
+PHASE_STRONG_LINE = 20
+
+def d_from_two_theta(two_theta, wavelength):
+    return wavelength / (2 * np.sin(np.radians(two_theta) / 2))
+
+def two_theta_from_d(d, wavelength):
+    return 2 * np.degrees(np.arcsin(np.clip(wavelength / (2 * d), -1, 1)))
+
+def read_reference_file(path):
+    """(phase names, d-spacings, intensities) of the stick pattern(s) in one file."""
+    with open(path, 'rb') as f:
+        first_line = f.readline()
+    sep = ',' if b',' in first_line else r'\s+'
+    df = pd.read_csv(path, sep=sep, comment='#', engine='c')
+    columns = {col.strip().lower(): col for col in df.columns}
+
+    def find(*names):
+        return next((columns[name] for name in names if name in columns), None)
+
+    d_col = find('d', 'd_spacing', 'd-spacing', 'dspacing', 'd (å)', 'd(å)', 'd_a')
+    two_theta_col = find('2theta', '2θ', 'two_theta', 'twotheta', 'pos', '2theta (deg)')
+    intensity_col = find('intensity', 'i', 'i/i0', 'i_rel', 'int', 'rel_intensity', 'iobs')
+    phase_col = find('phase', 'name', 'mineral', 'compound')
+    if intensity_col is None or (d_col is None and two_theta_col is None):
+        raise ValueError(f"{os.path.basename(path)}: needs a d (or 2theta) column and an intensity column.")
+
+    if d_col is not None:
+        d = pd.to_numeric(df[d_col], errors='coerce').to_numpy(dtype=np.float64)
+    else:
+        d = d_from_two_theta(pd.to_numeric(df[two_theta_col], errors='coerce').to_numpy(dtype=np.float64), XRD_WAVELENGTH)
+    intensity = pd.to_numeric(df[intensity_col], errors='coerce').to_numpy(dtype=np.float64)
+    if phase_col is not None:
+        names = df[phase_col].astype(str).str.strip().to_numpy()
+    else:
+        names = np.full(len(df), os.path.splitext(os.path.basename(path))[0], dtype=object)
+    keep = np.isfinite(d) & (d > 0) & np.isfinite(intensity) & (intensity > 0)
+    return names[keep], d[keep], intensity[keep]
+
+class PhaseIndex:
+    """All reference lines sorted by d-spacing, loaded on first use."""
+
+    def __init__(self, directory, index_file):
+        self.directory = directory
+        self.index_file = index_file
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.names = self.d = self.phase = self.intensity = None
+        self.load_seconds = None
+        self.source = None
+
+    def reference_files(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(self.directory)
+            for name in names
+            if name.lower().endswith(REFERENCE_EXTENSIONS) and not name.startswith('.')
+        )
+
+    def fingerprint(self, paths):
+        digest = hashlib.sha256()
+        for path in paths:
+            stat = os.stat(path)
+            digest.update(f"{os.path.relpath(path, self.directory)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode('utf-8'))
+        return digest.hexdigest()
+
+    def ensure_loaded(self):
+        with self.lock:
+            if not self.loaded:
+                started = time.perf_counter()
+                self._load()
+                self.load_seconds = time.perf_counter() - started
+                self.loaded = True
+        return self
+
+    def _load(self):
+        paths = self.reference_files()
+        fingerprint = self.fingerprint(paths)
+        try:
+            with np.load(self.index_file, allow_pickle=False) as saved:
+                if str(saved['fingerprint']) == fingerprint:
+                    self.names, self.d, self.phase, self.intensity = (
+                        saved['names'], saved['d'], saved['phase'], saved['intensity'])
+                    self.source = 'saved index'
+                    return
+        except (OSError, KeyError, ValueError):
+            pass
+
+        all_names, all_d, all_intensity = [], [], []
+        for path in paths:
+            try:
+                names, d, intensity = read_reference_file(path)
+            except (ValueError, pd.errors.ParserError, UnicodeDecodeError) as e:
+                print(f"Skipping reference file {path}: {e}")
+                continue
+            all_names.append(names)
+            all_d.append(d)
+            all_intensity.append(intensity)
+        names = np.concatenate(all_names) if all_names else np.array([], dtype=object)
+        d = np.concatenate(all_d) if all_d else np.array([])
+        intensity = np.concatenate(all_intensity) if all_intensity else np.array([])
+
+        phase_names, phase = np.unique(names.astype(str), return_inverse=True)
+        # Intensities relative to each phase's strongest line
+        strongest = np.zeros(len(phase_names))
+        np.maximum.at(strongest, phase, intensity)
+        intensity = 100 * intensity / strongest[phase] if len(phase) else intensity
+
+        order = np.argsort(d, kind='stable')
+        self.names = phase_names
+        self.d = d[order]
+        self.phase = phase[order].astype(np.int32)
+        self.intensity = intensity[order].astype(np.float32)
+        self.source = f"{len(paths)} file(s)"
+        if paths:
+            try:
+                # Write then rename, so a concurrent reader never sees half a file
+                temp_file = f"{self.index_file}.{uuid.uuid4().hex}.tmp.npz"
+                np.savez(temp_file, fingerprint=np.array(fingerprint), names=self.names,
+                         d=self.d, phase=self.phase, intensity=self.intensity)
+                os.replace(temp_file, self.index_file)
+            except OSError as e:
+                print(f"Could not save the reference index: {e}")
+
+    def match(self, peaks, two_theta_range=None, wavelength=XRD_WAVELENGTH, tolerance=PHASE_TOLERANCE,
+              max_candidates=PHASE_MAX_CANDIDATES):
+        """Rank reference phases against observed peaks.
+
+        Args:
+            peaks: list of {"Pos": 2θ, "Iobs": intensity}, as parse_xrd_data returns.
+            two_theta_range: (min, max) 2θ of the scan, so lines outside it aren't expected.
+            wavelength: X-ray wavelength of the scan in Å.
+            tolerance: matching window, ± degrees 2θ.
+
+        Returns:
+            Up to max_candidates dicts with phase, figure_of_merit, matched_peaks,
+            total_peaks, mean_delta_2theta and strong_lines_found, best first.
+        """
+        self.ensure_loaded()
+        two_theta = np.array([peak['Pos'] for peak in peaks], dtype=np.float64)
+        observed = np.array([peak['Iobs'] for peak in peaks], dtype=np.float64)
+        usable = (two_theta > tolerance) & (two_theta + tolerance < 180) & (observed > 0)
+        two_theta, observed = two_theta[usable], observed[usable]
+        if not len(two_theta) or not len(self.d):
+            return []
+
+        # Larger 2θ means smaller d, so the window's upper 2θ bound gives its lower d bound
+        start = np.searchsorted(self.d, d_from_two_theta(two_theta + tolerance, wavelength), side='left')
+        stop = np.searchsorted(self.d, d_from_two_theta(two_theta - tolerance, wavelength), side='right')
+        counts = stop - start
+        if not counts.sum():
+            return []
+        hit_peak = np.repeat(np.arange(len(two_theta)), counts)
+        hit_line = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)
+        hit_phase = self.phase[hit_line]
+        error = np.abs(two_theta_from_d(self.d[hit_line], wavelength) - two_theta[hit_peak])
+
+        # Closest line per (phase, peak)
+        order = np.lexsort((error, hit_peak, hit_phase))
+        pair = hit_phase[order].astype(np.int64) * len(two_theta) + hit_peak[order]
+        best = order[np.concatenate(([True], pair[1:] != pair[:-1]))]
+        hit_peak, hit_line, hit_phase, error = hit_peak[best], hit_line[best], hit_phase[best], error[best]
+
+        n_phases = len(self.names)
+        matched = np.bincount(hit_phase, minlength=n_phases)
+        candidates = np.flatnonzero(matched >= min(PHASE_MIN_MATCHES, len(two_theta)))
+        if not len(candidates):
+            return []
+        explained = np.bincount(hit_phase, weights=observed[hit_peak], minlength=n_phases) / observed.sum()
+        mean_error = np.bincount(hit_phase, weights=error, minlength=n_phases) / np.maximum(matched, 1)
+
+        # Strong reference lines inside the scanned range, and how many of them were found
+        low, high = two_theta_range if two_theta_range else (two_theta.min(), two_theta.max())
+        first = np.searchsorted(self.d, d_from_two_theta(min(high + tolerance, 179.9), wavelength), side='left')
+        last = np.searchsorted(self.d, d_from_two_theta(max(low - tolerance, 0.1), wavelength), side='right')
+        strong = self.intensity[first:last] >= PHASE_STRONG_LINE
+        expected = np.bincount(self.phase[first:last][strong], minlength=n_phases)
+        found_lines = np.unique(hit_line[self.intensity[hit_line] >= PHASE_STRONG_LINE])
+        found = np.bincount(self.phase[found_lines], minlength=n_phases)
+        coverage = np.where(expected > 0, found / np.maximum(expected, 1), 0)
+
+        merit = explained * coverage * (1 - 0.5 * mean_error / tolerance)
+        ranked = candidates[np.argsort(-merit[candidates], kind='stable')][:max_candidates]
+        return [{
+            "phase": str(self.names[i]),
+            "figure_of_merit": round(float(merit[i]), 3),
+            "matched_peaks": int(matched[i]),
+            "total_peaks": len(two_theta),
+            "strong_lines_found": f"{found[i]}/{expected[i]}",
+            "mean_delta_2theta": round(float(mean_error[i]), 4)
+        } for i in ranked if merit[i] > 0]
+
+    def stats(self):
+        self.ensure_loaded()
+        return {
+            "directory": self.directory,
+            "phases": len(self.names),
+            "lines": len(self.d),
+            "source": self.source,
+            "load_ms": round(self.load_seconds * 1000, 1)
+        }
+
+phase_index = PhaseIndex(REFERENCE_PATTERNS_DIR, REFERENCE_INDEX_FILE)
+
+def get_phase_settings():
+    """wavelength (Å) and phase_tolerance (° 2θ) from the form or query string."""
+    settings = {}
+    for field, name in (('wavelength', 'wavelength'), ('phase_tolerance', 'tolerance')):
+        value = request.values.get(field)
+        if value is None or value == '':
+            continue
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValueError(f"{field} must be a number.")
+        if value <= 0:
+            raise ValueError(f"{field} must be positive.")
+        settings[name] = value
+    return settings
+
+def stage_requested(field):
+    """False if the client switched an optional analysis stage off (field=0, as a form field or query parameter)."""
+    value = request.values.get(field) or ''
+    return value.lower() not in ('0', 'false', 'no', 'off')
+
+def format_phase_candidates(candidates):
+    """One prompt line per candidate phase."""
+    if not candidates:
+        return "none above the matching threshold"
+    return "; ".join(f"{c['phase']} (figure of merit {c['figure_of_merit']}, {c['matched_peaks']}/{c['total_peaks']} peaks, "
+                     f"strong lines {c['strong_lines_found']})" for c in candidates)
+
+@app.route('/references', methods=['GET'])
+def reference_stats():
+    return jsonify(phase_index.stats())
+
+# -----------------------------
+# Peak Profile Fitting
+# Each detected XRD peak is fitted with a pseudo-Voigt on a linear background,
+# over a window of PROFILE_WINDOW_FWHM half-widths on either side (stopping
+# halfway to the next detected peak). All windows are padded to one length
+# and masked, and the fits run together as one batched Levenberg–Marquardt:
+# each iteration builds every peak's Jacobian at once and solves all the 6×6
+# normal equations in a single np.linalg.solve call. Crystallite size comes
+# from the Scherrer equation, after removing INSTRUMENT_FWHM in quadrature.
+# -----------------------------
+SCHERRER_K = float(os.environ.get('SCHERRER_K', 0.9))
+INSTRUMENT_FWHM = float(os.environ.get('INSTRUMENT_FWHM', 0))  # degrees 2θ
+PROFILE_WINDOW_FWHM = 2
+PROFILE_MIN_HALF_WINDOW = 3
+PROFILE_MAX_HALF_WINDOW = 200
+PROFILE_MAX_ITERATIONS = 50
+PROFILE_TOLERANCE = 1e-5
+# Area of a unit-height, unit-FWHM Lorentzian and Gaussian
+LORENTZ_AREA = math.pi / 2
+GAUSS_AREA = math.sqrt(math.pi / (4 * math.log(2)))
+
+def pseudo_voigt(params, x):
+    """Batched pseudo-Voigt plus linear background, and its Jacobian.
+
+    params has one row per peak: height, centre, FWHM, Lorentzian fraction,
+    background offset and slope. x has one row of positions per peak.
+    """
+    height, centre, fwhm, eta, offset, slope = (params[:, i, None] for i in range(6))
+    u = (x - centre) / fwhm
+    lorentz = 1 / (1 + 4 * u ** 2)
+    gauss = np.exp(-4 * math.log(2) * u ** 2)
+    profile = eta * lorentz + (1 - eta) * gauss
+    d_profile_du = -8 * u * (eta * lorentz ** 2 + (1 - eta) * math.log(2) * gauss)
+    model = height * profile + offset + slope * x
+    jacobian = np.stack([
+        profile,
+        -height * d_profile_du / fwhm,
+        -height * d_profile_du * u / fwhm,
+        height * (lorentz - gauss),
+        np.ones_like(x),
+        x
+    ], axis=-1)
+    return model, jacobian
+
+def fit_profiles_batched(params, x, y, mask):
+    """Levenberg–Marquardt fit of pseudo_voigt for all peak windows at once.
+
+    Returns the fitted parameters and each window's residual sum of squares.
+    """
+    damping = np.full(len(params), 1e-3)
+    model, jacobian = pseudo_voigt(params, x)
+    jacobian = jacobian * mask[..., None]
+    cost = (((model - y) * mask) ** 2).sum(axis=1)
+    active = np.arange(len(params))
+    for _ in range(PROFILE_MAX_ITERATIONS):
+        if not len(active):
+            break
+        # Only the windows still being fitted take part in the solve
+        x_a, y_a, mask_a, jacobian_a = x[active], y[active], mask[active], jacobian[active]
+        residual = (model[active] - y_a) * mask_a
+        jtj = np.einsum('pli,plj->pij', jacobian_a, jacobian_a)
+        gradient = np.einsum('pli,pl->pi', jacobian_a, residual)
+        diagonal = np.einsum('pii->pi', jtj)
+        jtj[:, np.arange(6), np.arange(6)] += damping[active, None] * diagonal + 1e-12
+        step = np.linalg.solve(jtj, -gradient[..., None])[..., 0]
+
+        trial = params[active] + step
+        trial[:, 2] = np.abs(trial[:, 2])
+        trial[:, 3] = np.clip(trial[:, 3], 0, 1)
+        trial_model, trial_jacobian = pseudo_voigt(trial, x_a)
+        trial_cost = (((trial_model - y_a) * mask_a) ** 2).sum(axis=1)
+
+        better = trial_cost < cost[active]
+        converged = better & (cost[active] - trial_cost <= PROFILE_TOLERANCE * np.maximum(cost[active], 1e-30))
+        improved = active[better]
+        params[improved] = trial[better]
+        model[improved] = trial_model[better]
+        jacobian[improved] = trial_jacobian[better] * mask_a[better, :, None]
+        cost[improved] = trial_cost[better]
+        damping[active] = np.where(better, damping[active] / 3, damping[active] * 3)
+        # Stop on windows that have converged or whose step no longer changes anything
+        active = active[~converged & (damping[active] < 1e6)]
+    return params, cost
+
+@timed('peak_fit')
+def fit_peak_profiles(df, peaks, wavelength=XRD_WAVELENGTH):
+    """Fit a pseudo-Voigt to every detected XRD peak.
+
+    Args:
+        df: spectrum from parse_xrd_data, with its Smoothed_Iobs and Peak_Marker columns.
+        peaks: peaks as parse_xrd_data returns them.
+        wavelength: X-ray wavelength in Å, for the Scherrer size.
+
+    Returns:
+        One dict per peak, in the same order: Pos, FWHM and Area from the fit,
+        Eta (Lorentzian fraction), R2 and Crystallite_Size_nm (None when the
+        fit failed or the peak is no wider than the instrument).
+    """
+    if not has_rows(df) or not peaks:
+        return []
+    x = df['Pos'].to_numpy(dtype=np.float64)
+    y = df['Iobs'].to_numpy(dtype=np.float64)
+    n = len(x)
+    marked = np.flatnonzero(df['Peak_Marker'].to_numpy())
+    rows = peak_rows(df, 'Pos', peaks)
+    centre = rows[rows >= 0]
+    # Peaks that can't be placed on the spectrum keep their slot, unfitted
+    profiles = [{"Pos": peak['Pos'], "FWHM": None, "Area": None, "Eta": None, "R2": None, "Crystallite_Size_nm": None}
+                for peak in peaks]
+    if not len(centre):
+        return profiles
+
+    # Starting widths (in points) from the smoothed curve
+    smoothed = df['Smoothed_Iobs'].to_numpy(dtype=np.float64)
+    widths, _, left, right = signal.peak_widths(smoothed, centre, rel_height=0.5)
+    half_window = np.clip(np.ceil(PROFILE_WINDOW_FWHM * widths), PROFILE_MIN_HALF_WINDOW, PROFILE_MAX_HALF_WINDOW).astype(np.intp)
+
+    # Keep each window on its own side of the neighbouring detected peaks
+    ordered = np.sort(marked)
+    position = np.searchsorted(ordered, centre)
+    lower = np.where(position > 0, (ordered[np.maximum(position - 1, 0)] + centre + 1) // 2, 0)
+    upper = np.where(position + 1 < len(ordered), (ordered[np.minimum(position + 1, len(ordered) - 1)] + centre) // 2, n - 1)
+
+    span = int(half_window.max())
+    offsets = np.arange(-span, span + 1)
+    index = centre[:, None] + offsets
+    mask = ((np.abs(offsets) <= half_window[:, None]) & (index >= lower[:, None]) & (index <= upper[:, None])).astype(np.float64)
+    index = np.clip(index, 0, n - 1)
+
+    # Centre x on each peak and scale y to its height, to keep the normal equations well conditioned
+    origin = x[centre]
+    window_x = x[index] - origin[:, None]
+    scale = np.maximum(np.abs(y[centre]), 1e-12)
+    window_y = y[index] / scale[:, None]
+    floor = np.where(mask > 0, window_y, np.inf).min(axis=1)
+    fwhm = np.abs(np.interp(right, np.arange(n), x) - np.interp(left, np.arange(n), x))
+    fwhm = np.where(fwhm > 0, fwhm, np.abs(window_x).max(axis=1) / 2)
+    params = np.column_stack([1 - floor, np.zeros(len(centre)), fwhm, np.full(len(centre), 0.5), floor, np.zeros(len(centre))])
+
+    params, cost = fit_profiles_batched(params, window_x, window_y, mask)
+
+    height, shift, fwhm, eta, _, _ = params.T
+    height = height * scale
+    fitted_pos = origin + shift
+    area = height * fwhm * (eta * LORENTZ_AREA + (1 - eta) * GAUSS_AREA)
+    mean_y = (window_y * mask).sum(axis=1) / mask.sum(axis=1)
+    total = (((window_y - mean_y[:, None]) * mask) ** 2).sum(axis=1)
+    r2 = 1 - cost / np.where(total > 0, total, 1)
+    ok = np.isfinite(params).all(axis=1) & (height > 0) & (fwhm > 0) & (np.abs(shift) <= np.abs(window_x).max(axis=1))
+
+    # Scherrer: size = Kλ / (β cos θ), β the sample broadening in radians
+    broadening = np.sqrt(np.maximum(fwhm ** 2 - INSTRUMENT_FWHM ** 2, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        size = SCHERRER_K * wavelength / (np.radians(broadening) * np.cos(np.radians(fitted_pos / 2))) / 10
+
+    for i, slot in enumerate(np.flatnonzero(rows >= 0)):
+        if not ok[i]:
+            profiles[slot]["Pos"] = round(float(origin[i]), 4)
+            continue
+        profiles[slot] = {
+            "Pos": round(float(fitted_pos[i]), 4),
+            "FWHM": round(float(fwhm[i]), 4),
+            "Area": round(float(area[i]), 3),
+            "Eta": round(float(eta[i]), 3),
+            "R2": round(float(r2[i]), 4),
+            "Crystallite_Size_nm": round(float(size[i]), 1) if broadening[i] > 0 and np.isfinite(size[i]) else None
+        }
+    return profiles
+
+# -----------------------------
+# Thermogram Analysis
+# TGA instruments log temperature and mass at a high rate, often millions of
+# rows per run. The samples are averaged into TGA_TEMPERATURE_STEP bins with
+# bincount, which leaves a curve of a few hundred to a few thousand points
+# whatever the logging rate. The mass (as percent of the initial mass) is
+# smoothed there with Savitzky–Golay and differentiated against temperature
+# to give the DTG. Each mass-loss step is a DTG minimum; its extent comes
+# from peak_widths near the base of the DTG peak, and its extrapolated
+# onset/offset from where the tangent at the steepest point meets the mass
+# before and after the step.
+# -----------------------------
+TGA_TEMPERATURE_STEP = float(os.environ.get('TGA_TEMPERATURE_STEP', 1.0))  # °C
+TGA_MAX_BINS = 20_000
+TGA_SMOOTH_WINDOW = 11  # bins
+TGA_SMOOTH_ORDER = 2
+# A step's DTG peak must reach this fraction of the fastest loss rate...
+TGA_STEP_PROMINENCE = 0.05
+# ...and the step must lose at least this many percent of the initial mass
+TGA_MIN_STEP_LOSS = 0.5
+# Fraction of the DTG peak's prominence at which a step's extent is measured
+TGA_STEP_EXTENT = 0.95
+
+def bin_thermogram(temperature, mass, time_values=None):
+    """Mean temperature, mass (and time) per temperature bin, empty bins dropped."""
+    low, high = float(temperature.min()), float(temperature.max())
+    step = max(TGA_TEMPERATURE_STEP, (high - low) / TGA_MAX_BINS)
+    bins = ((temperature - low) / step).astype(np.int64) if step > 0 else np.zeros(len(temperature), dtype=np.int64)
+    counts = np.bincount(bins)
+    filled = counts > 0
+    counts = counts[filled]
+    binned = {
+        "Temp": np.bincount(bins, weights=temperature)[filled] / counts,
+        "Mass": np.bincount(bins, weights=mass)[filled] / counts
+    }
+    if time_values is not None:
+        binned["Time"] = np.bincount(bins, weights=time_values)[filled] / counts
+    return binned
+
+def thermogram_steps(temp, weight, dtg):
+    """Mass-loss steps of a binned thermogram, in order of temperature."""
+    if len(temp) < 3:
+        return []
+    loss_rate = -dtg
+    fastest = loss_rate.max()
+    if not fastest > 0:
+        return []
+    peaks, _ = signal.find_peaks(loss_rate, prominence=TGA_STEP_PROMINENCE * fastest)
+    if not len(peaks):
+        return []
+    _, _, left, right = signal.peak_widths(loss_rate, peaks, rel_height=TGA_STEP_EXTENT)
+    positions = np.arange(len(temp))
+    start_temp = np.interp(left, positions, temp)
+    end_temp = np.interp(right, positions, temp)
+    start_weight = np.interp(left, positions, weight)
+    end_weight = np.interp(right, positions, weight)
+    loss = start_weight - end_weight
+
+    # Extrapolated onset/offset: the tangent at the peak meets the mass before/after the step
+    slope = dtg[peaks]
+    onset = temp[peaks] + (start_weight - weight[peaks]) / slope
+    offset = temp[peaks] + (end_weight - weight[peaks]) / slope
+    keep = loss >= TGA_MIN_STEP_LOSS
+    return [{
+        "onset_temp": round(float(np.clip(onset[i], start_temp[i], temp[peaks[i]])), 1),
+        "offset_temp": round(float(np.clip(offset[i], temp[peaks[i]], end_temp[i])), 1),
+        "peak_temp": round(float(temp[peaks[i]]), 1),
+        "mass_loss_percent": round(float(loss[i]), 2),
+        "max_rate": round(float(loss_rate[peaks[i]]), 4)
+    } for i in np.flatnonzero(keep)]
+
+@timed('thermogram')
+def analyze_thermogram(temperature, mass, time_values=None):
+    """Binned curve and step summary of a thermogram.
+
+    Args:
+        temperature, mass, time_values: raw logged columns (time is optional).
+
+    Returns:
+        (curve, summary): a DataFrame with Temp, Weight_normalized (% of the
+        initial mass), DTG (%/°C) and Time if given; and a dict with
+        initial_mass, residue_percent, total_weight_loss, temperature_range
+        and the steps from thermogram_steps().
+    """
+    finite = np.isfinite(temperature) & np.isfinite(mass)
+    if time_values is not None:
+        finite &= np.isfinite(time_values)
+        time_values = time_values[finite]
+    temperature, mass = temperature[finite], mass[finite]
+    if len(temperature) < 2:
+        raise ValueError("The TGA file needs at least two rows with a temperature and a mass.")
+
+    binned = bin_thermogram(temperature.astype(np.float64), mass.astype(np.float64),
+                            None if time_values is None else time_values.astype(np.float64))
+    temp = binned["Temp"]
+    initial_mass = binned["Mass"][0]
+    if not initial_mass:
+        raise ValueError("The initial mass in the TGA file is zero.")
+    weight = 100 * binned["Mass"] / initial_mass
+
+    # savgol_filter needs an odd window longer than the polynomial order and no longer than the data
+    window = min(TGA_SMOOTH_WINDOW, len(weight) if len(weight) % 2 else len(weight) - 1)
+    smoothed = signal.savgol_filter(weight, window, TGA_SMOOTH_ORDER) if window > TGA_SMOOTH_ORDER else weight
+    dtg = np.gradient(smoothed, temp) if len(temp) > 1 else np.zeros_like(temp)
+
+    curve = pd.DataFrame({"Temp": temp, "Weight_normalized": smoothed, "DTG": dtg}).astype(np.float32)
+    if "Time" in binned:
+        curve.insert(1, "Time", binned["Time"].astype(np.float32))
+    summary = {
+        "initial_mass": round(float(initial_mass), 4),
+        "residue_percent": round(float(smoothed[-1]), 2),
+        "total_weight_loss": round(float(100 - smoothed[-1]), 2),
+        "temperature_range": [round(float(temp[0]), 1), round(float(temp[-1]), 1)],
+        "steps": thermogram_steps(temp, smoothed, dtg)
+    }
+    return curve, summary
+
+def format_tga_steps(steps):
+    """One prompt line per mass-loss step."""
+    if not steps:
+        return "none detected"
+    return "; ".join(f"{step['onset_temp']}–{step['offset_temp']} °C (DTG peak {step['peak_temp']} °C): "
+                     f"{step['mass_loss_percent']}% loss" for step in steps)
+
+# -----------------------------
+# Parsers
+# -----------------------------
+def parse_xrd_data(file, peak_settings=None):
+    df_clean = read_spectrum(file, ['Pos', 'Iobs'])
+    if df_clean is None:
+        df_clean = read_xrd_csv(file)
+
+    # Clean up any non-numeric data
+    df_clean.dropna(subset=['Pos', 'Iobs'], inplace=True)
+
+    # Peak detection; the peaks come back sorted by intensity
+    smoothed, peak_index = detect_peaks(df_clean['Iobs'].to_numpy(), **{**PEAK_DEFAULTS['xrd'], **(peak_settings or {})})
+    df_clean['Smoothed_Iobs'] = smoothed.astype(np.float32)
+    peak_marker = np.zeros(len(df_clean), dtype=bool)
+    peak_marker[peak_index] = True
+    df_clean['Peak_Marker'] = peak_marker
+
+    peaks_info = widen_float32(df_clean[['Pos', 'Iobs']].iloc[peak_index]).to_dict('records')
     
+    # Return both the full data and the detected peaks
+    return df_clean, peaks_info
+
+def read_xrd_csv(file):
+    """Pos and Iobs from a CSV with recognizable column names."""
+    # Only the header is needed to pick the columns
+    header = sniff_csv(file).columns
+
     # Identify position and intensity columns based on keywords
     pos_col = None
     iobs_col = None
     
-    for col in df.columns:
+    for col in header:
         col_lower = col.lower()
         if 'pos' in col_lower or '2θ' in col_lower:
             pos_col = col
@@ -67,118 +1843,145 @@ def parse_xrd_data(file):
     if not pos_col or not iobs_col:
         raise ValueError("The XRD file must contain 'Pos' (or '2θ') and 'Iobs' (or 'Intensity') columns.")
 
-    # Create a new DataFrame containing ONLY the two relevant columns
-    df_clean = df[[pos_col, iobs_col]].copy()
+    # Parse ONLY the two relevant columns
+    df_clean = read_csv_columns(file, [pos_col, iobs_col])
     
     # Rename columns to a consistent format for the rest of the program
-    df_clean.rename(columns={pos_col: 'Pos', iobs_col: 'Iobs'}, inplace=True)
-    
-    # Ensure columns are numeric and clean up any non-numeric data
-    df_clean['Pos'] = pd.to_numeric(df_clean['Pos'], errors='coerce')
-    df_clean['Iobs'] = pd.to_numeric(df_clean['Iobs'], errors='coerce')
-    df_clean.dropna(subset=['Pos', 'Iobs'], inplace=True)
+    return df_clean.rename(columns={pos_col: 'Pos', iobs_col: 'Iobs'})[['Pos', 'Iobs']]
 
-    # Simple peak detection
-    df_clean['Smoothed_Iobs'] = df_clean['Iobs'].rolling(window=5, center=True).mean().fillna(0)
-    df_clean['Peak_Marker'] = (df_clean['Smoothed_Iobs'] > df_clean['Smoothed_Iobs'].shift(1)) & \
-                             (df_clean['Smoothed_Iobs'] > df_clean['Smoothed_Iobs'].shift(-1))
-    
-    peak_locations = df_clean[df_clean['Peak_Marker']]
-    
-    # Sort peaks by intensity and get the top 10
-    peaks_info = peak_locations[['Pos', 'Iobs']].sort_values(by='Iobs', ascending=False).head(10).to_dict('records')
-    
-    # Return both the full data and the detected peaks
-    return df_clean.to_dict('records'), peaks_info
+def parse_ir_data(file, peak_settings=None):
+    df = read_spectrum(file, ['Wavenumber', 'Absorbance'])
+    if df is None:
+        df = read_ir_csv(file)
+
+    # Peak detection; the peaks come back sorted by absorbance
+    df = df.dropna()
+    _, peak_index = detect_peaks(df['Absorbance'].to_numpy(), **{**PEAK_DEFAULTS['ir'], **(peak_settings or {})})
 
-def parse_ir_data(file):
-    content = file.stream.read().decode('utf-8')
-    data_io = io.StringIO(content)
+    peak_info = widen_float32(df.iloc[peak_index]).to_dict('records')
 
+    return df, peak_info
+
+def read_ir_csv(file):
+    """Wavenumber and Absorbance from the first two numeric columns of a CSV."""
+    header = 'infer'
     try:
-        df = pd.read_csv(data_io)
+        sample = sniff_csv(file)
     except pd.errors.ParserError:
-        data_io.seek(0)
-        df = pd.read_csv(data_io, header=None)
+        header = None
+        sample = sniff_csv(file, header=None)
 
-    numeric_cols = df.select_dtypes(include=np.number).columns
+    numeric_cols = sample.select_dtypes(include=np.number).columns
     if len(numeric_cols) < 2:
         raise ValueError("The IR file must contain at least two numeric data columns.")
 
-    df.rename(columns={numeric_cols[0]: 'Wavenumber', numeric_cols[1]: 'Absorbance'}, inplace=True)
-    df = df[['Wavenumber', 'Absorbance']]
-
-    # Simple peak detection
-    peaks = df[(df['Absorbance'] > np.mean(df['Absorbance']) + 2 * np.std(df['Absorbance'])) &
-               (df['Absorbance'].diff().shift(-1) < 0) &
-               (df['Absorbance'].diff().shift(1) > 0)]
-    peaks = peaks.sort_values(by='Absorbance', ascending=False).head(5)
-
-    peak_info = peaks.to_dict('records')
-
-    return df.to_dict('records'), peak_info
+    df = read_csv_columns(file, numeric_cols[:2], header=header)
+    return df.rename(columns={numeric_cols[0]: 'Wavenumber', numeric_cols[1]: 'Absorbance'})[['Wavenumber', 'Absorbance']]
 
 def parse_bet_data(file):
-    content = file.stream.read().decode('utf-8')
-    df = pd.read_csv(io.StringIO(content))
+    header = sniff_csv(file).columns
 
-    if 'P/P0' not in df.columns or 'Va' not in df.columns:
+    if 'P/P0' not in header or 'Va' not in header:
         raise ValueError("CSV must contain 'P/P0' and 'Va' columns.")
 
+    # Isotherms are small and the BET fit is sensitive to rounding, so keep float64
+    df = read_csv_columns(file, ['P/P0', 'Va'], dtype='float64')
+
     # Call the main parsing function that handles the calculation
     return parse_bet_data_from_df(df)
 
+# PDF reports are read page by page and extraction stops as soon as the
+# surface area or an isotherm table turns up. Size and page limits keep a
+# huge report from tying up a worker.
+PDF_MAX_BYTES = int(os.environ.get('PDF_MAX_BYTES', 50 * 1024 * 1024))
+PDF_MAX_PAGES = int(os.environ.get('PDF_MAX_PAGES', 200))
+# Text carried over from the previous page, so a match can span a page break
+PDF_PAGE_OVERLAP = 4096
+# A reported surface area wins over the table fit, so after a complete table a
+# few more pages are read for one. An area reported further on is missed and
+# the table fit is used instead; more pages mean slower parses of long reports.
+PDF_AREA_LOOKAHEAD_PAGES = int(os.environ.get('PDF_AREA_LOOKAHEAD_PAGES', 2))
+
+BET_AREA_PATTERN = re.compile(r'BET Surface Area: (\d+\.\d+) m²/g')
+BET_TABLE_PATTERNS = (
+    re.compile(r'P/P0\s+Va\s+.*\n((?:\s*-?\d+\.\d+\s+-?\d+\.\d+\n)+)'),  # Original pattern
+    re.compile(r'Rel\.\s+Pressure\s+Quantity\s+Adsorbed\n((?:\s*-?\d+\.\d+\s+-?\d+\.\d+\n)+)'), # Common alternative
+    re.compile(r'p/p0\s+v\n((?:\s*-?\d+\.\d+\s+-?\d+\.\d+\n)+)'), # Another common pattern
+)
+# What may follow a table that could still continue on the next page
+BET_TABLE_TAIL = re.compile(r'[\s\d.\-]*')
+
 def parse_pdf_bet_data(file):
-    reader = PyPDF2.PdfReader(io.BytesIO(file.stream.read()))
+    raw = file.stream.read()
+    if len(raw) > PDF_MAX_BYTES:
+        raise ValueError(f"The PDF is larger than the {PDF_MAX_BYTES // (1024 * 1024)} MB limit.")
+    reader = PyPDF2.PdfReader(io.BytesIO(raw))
+    pages = reader.pages
+
     text = ""
-    for page in reader.pages:
-        text += page.extract_text() or ""
-
-    # Attempt to find the specific BET surface area value first
-    area_match = re.search(r'BET Surface Area: (\d+\.\d+) m²/g', text)
-    if area_match:
-        surface_area = float(area_match.group(1))
-        # No full data available from this method, so return empty list
-        return surface_area, []
-
-    # If the specific value isn't found, try to find a data table
-    data_patterns = [
-        r'P/P0\s+Va\s+.*\n((?:\s*-?\d+\.\d+\s+-?\d+\.\d+\n)+)',  # Original pattern
-        r'Rel\.\s+Pressure\s+Quantity\s+Adsorbed\n((?:\s*-?\d+\.\d+\s+-?\d+\.\d+\n)+)', # Common alternative
-        r'p/p0\s+v\n((?:\s*-?\d+\.\d+\s+-?\d+\.\d+\n)+)' # Another common pattern
-    ]
-
-    for pattern in data_patterns:
-        bet_data_match = re.search(pattern, text)
-        if bet_data_match:
-            data_lines = bet_data_match.group(1).strip().split('\n')
-            data = [line.strip().split() for line in data_lines]
-
-            df = pd.DataFrame(data, columns=['P/P0', 'Va']).astype(float)
-            # Call the main BET calculation function to get the area and full data
-            return parse_bet_data_from_df(df)
+    table_match = None
+    table_rows = None
+    last_page = None
+    for number in range(min(len(pages), PDF_MAX_PAGES)):
+        # A table that runs to the end of the page keeps the window growing until it ends
+        if table_match is None or table_rows is not None:
+            text = text[-PDF_PAGE_OVERLAP:]
+        # Earlier text was already searched for the area, apart from the overlap
+        area_start = max(len(text) - PDF_PAGE_OVERLAP, 0)
+        with timed('decode'):
+            text += pages[number].extract_text() or ""
+
+        # Attempt to find the specific BET surface area value first
+        area_match = BET_AREA_PATTERN.search(text, area_start)
+        if area_match:
+            surface_area = float(area_match.group(1))
+            # No full data (or fit) available from this method, so return empty list
+            return surface_area, [], None
+
+        # If the specific value isn't found, try to find a data table
+        if table_rows is None:
+            table_match = next((match for match in (pattern.search(text) for pattern in BET_TABLE_PATTERNS) if match), None)
+            # The table is complete once it is followed by something other than more rows.
+            # Keep reading for a reported surface area, which still takes precedence.
+            if table_match and not BET_TABLE_TAIL.fullmatch(text, table_match.end()):
+                table_rows = table_match.group(1)
+                last_page = number + PDF_AREA_LOOKAHEAD_PAGES
+        if last_page is not None and number >= last_page:
+            break
+
+    if table_match and table_rows is None:
+        table_rows = table_match.group(1)
+    if table_rows:
+        data_lines = table_rows.strip().split('\n')
+        data = [line.strip().split() for line in data_lines]
+
+        df = pd.DataFrame(data, columns=['P/P0', 'Va']).astype(float)
+        # Call the main BET calculation function to get the area and full data
+        return parse_bet_data_from_df(df)
 
     # If neither method works, raise an error
+    if len(pages) > PDF_MAX_PAGES:
+        raise ValueError(f"Could not find a valid BET surface area or data table in the first {PDF_MAX_PAGES} pages of the PDF.")
     raise ValueError("Could not find a valid BET surface area or data table in the PDF.")
 
 def parse_bet_data_from_df(df):
-    """Parses BET data from a DataFrame and calculates surface area."""
-    df['BET_Plot'] = 1 / (df['Va'] * ((1 / df['P/P0']) - 1))
+    """Parses BET data from a DataFrame and calculates surface area.
 
-    linear_region = df[(df['P/P0'] >= 0.05) & (df['P/P0'] <= 0.35)]
-    if linear_region.empty or len(linear_region) < 2:
-        raise ValueError("Not enough data points in the linear region (0.05-0.35 p/p0) for regression.")
-
-    X = linear_region[['P/P0']]
-    y = linear_region['BET_Plot']
+    Returns:
+        (surface_area, df, fit), fit being the fit_bet() result for the chosen range.
+    """
+    df['BET_Plot'] = 1 / (df['Va'] * ((1 / df['P/P0']) - 1))
 
-    model = LinearRegression()
-    model.fit(X, y)
-    slope = model.coef_[0]
-    intercept = model.intercept_
+    fit = fit_bet(df['P/P0'].to_numpy(), df['Va'].to_numpy())
+    if fit is None:
+        # No range meets the Rouquerol criteria (e.g. a noisy isotherm): use the classic window
+        low, high = BET_FALLBACK_RANGE
+        linear_region = df[(df['P/P0'] >= low) & (df['P/P0'] <= high)]
+        fit = fit_bet(linear_region['P/P0'].to_numpy(), linear_region['Va'].to_numpy(), rouquerol=False, min_points=2)
+        if fit is None:
+            raise ValueError(f"No BET range meets the Rouquerol criteria and there are not enough data points in the linear region ({low}-{high} p/p0) for regression.")
 
-    Vm = 1 / (slope + intercept)
-    C = (slope/intercept) + 1
+    Vm = fit['vm']
 
     # Correct calculation of surface area with a conversion factor
     # Na = 6.022e23 (molecules/mol)
@@ -187,29 +1990,66 @@ def parse_bet_data_from_df(df):
     # 1e18 Å^2 per m^2
     surface_area = (Vm * 6.022e23 * 16.2) / 22414 / 1e18 * 1e4
 
-    return surface_area, df.to_dict('records')
+    return surface_area, df, fit
 
 def parse_tga_data(file):
     """
-    Parses TGA-related data from a file-like object, focusing on
-    adsorption capacity and desorption energy, by intelligently
-    searching for relevant column names.
+    Parses a TGA file: either a thermogram (temperature and mass, optionally
+    time, logged over a run) or a table of adsorption capacity and desorption
+    energy values.
 
     Args:
-        file: A file-like object containing TGA-related data in CSV format.
-              The CSV should ideally contain columns related to 'adsorption
-              capacity' and 'desorption energy'.
+        file: A file-like object containing TGA data in CSV format.
 
     Returns:
-        A dictionary containing the parsed data from the found columns.
-        
+        (curve, results): for a thermogram, the binned curve from
+        analyze_thermogram() and its step summary; for an adsorption table,
+        None and a dictionary of the two parsed columns.
+
     Raises:
-        ValueError: If a suitable column for either adsorption capacity or
-                    desorption energy cannot be found.
+        ValueError: If neither temperature and mass columns nor adsorption
+                    capacity and desorption energy columns can be found.
     """
-    df = pd.read_csv(io.StringIO(file.stream.read().decode('utf-8')))
-    df.columns = df.columns.str.strip()  # Clean up column names
+    df = sniff_csv(file)
+    raw_columns = df.columns
+    df.columns = df.columns.str.strip()
+    raw_names = dict(zip(df.columns, raw_columns))
 
+    # Thermogram columns; DTG/derivative columns exported by the instrument are ignored
+    def find_thermogram_column(keywords):
+        for col in df.columns:
+            col_lower = col.lower()
+            if any(keyword in col_lower for keyword in keywords) and 'dtg' not in col_lower and 'deriv' not in col_lower:
+                return col
+        return None
+
+    temperature_col = find_thermogram_column(['temp', '°c'])
+    mass_col = find_thermogram_column(['mass', 'weight', 'wt', 'tg'])
+    time_col = find_thermogram_column(['time'])
+    if temperature_col and mass_col and temperature_col != mass_col:
+        columns = [temperature_col, mass_col] + ([time_col] if time_col and time_col not in (temperature_col, mass_col) else [])
+        data = read_csv_columns(file, [raw_names[col] for col in columns])
+        data.columns = data.columns.str.strip()
+        return analyze_thermogram(
+            data[temperature_col].to_numpy(),
+            data[mass_col].to_numpy(),
+            data[time_col].to_numpy() if len(columns) == 3 else None
+        )
+    return None, parse_tga_adsorption_table(file, df, raw_names)
+
+def parse_tga_adsorption_table(file, df, raw_names):
+    """
+    Parses adsorption capacity and desorption energy by intelligently
+    searching for relevant column names.
+
+    Args:
+        file: The uploaded CSV.
+        df: Its sniffed first rows, with stripped column names.
+        raw_names: Stripped column name -> column name in the file.
+
+    Returns:
+        A dictionary containing the parsed data from the found columns.
+    """
     # Define a list of possible keywords for each column
     adsorption_keywords = ['adsorption', 'capacity', 'mmol', 'g']
     desorption_keywords = ['desorption', 'energy', 'consumption', 'kj', 'mol']
@@ -230,10 +2070,14 @@ def parse_tga_data(file):
     desorption_col = find_column(df, desorption_keywords)
 
     if not adsorption_col:
-        raise ValueError(f"Could not find a suitable column for 'adsorption capacity'. Please check the column headers in your CSV file. It should contain keywords like {', '.join(adsorption_keywords)}.")
+        raise ValueError(f"Could not find temperature and mass columns, or a suitable column for 'adsorption capacity'. Please check the column headers in your CSV file. It should contain keywords like {', '.join(adsorption_keywords)}.")
 
     if not desorption_col:
-        raise ValueError(f"Could not find a suitable column for 'desorption energy'. Please check the column headers in your CSV file. It should contain keywords like {', '.join(desorption_keywords)}.")
+        raise ValueError(f"Could not find temperature and mass columns, or a suitable column for 'desorption energy'. Please check the column headers in your CSV file. It should contain keywords like {', '.join(desorption_keywords)}.")
+
+    # Parse only the two matched columns, keeping whatever type they hold
+    df = read_csv_columns(file, [raw_names[adsorption_col], raw_names[desorption_col]], dtype=None)
+    df.columns = df.columns.str.strip()
 
     adsorption_capacity = df[adsorption_col].values.tolist()
     desorption_energy = df[desorption_col].values.tolist()
@@ -243,6 +2087,561 @@ def parse_tga_data(file):
         "desorption_energy": desorption_energy
     }
 
+# -----------------------------
+# Parse Cache
+# The same reference files get uploaded over and over, so parse results are
+# cached by a hash of the uploaded bytes, the parser and PARSER_VERSION.
+# Bump PARSER_VERSION whenever a parser's output changes.
+# Cached results are shared between requests and must be treated as read-only.
+# -----------------------------
+PARSER_VERSION = 8
+PARSE_CACHE_MAX_BYTES = int(os.environ.get('PARSE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+PARSE_CACHE_DIR = os.environ.get('PARSE_CACHE_DIR')  # Optional: spill evicted entries to disk
+PARSE_CACHE_DISK_MAX_BYTES = int(os.environ.get('PARSE_CACHE_DISK_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+
+def estimate_size(value):
+    """Rough in-memory size of a parse result in bytes."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(item) for item in value) + 8 * len(value)
+    if isinstance(value, dict):
+        return sum(estimate_size(item) for item in value.values()) + 64 * len(value)
+    return 64
+
+class ParseCache:
+    """LRU cache of parse results with a memory budget and optional disk spill."""
+
+    def __init__(self, max_bytes, spill_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, f"{key}.pkl")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+
+        value = self._load_spilled(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                old_key, (old_value, old_size) = self.entries.popitem(last=False)
+                self.current_bytes -= old_size
+                self.evictions += 1
+                evicted.append((old_key, old_value))
+        for old_key, old_value in evicted:
+            self._spill(old_key, old_value)
+
+    def _spill(self, key, value):
+        if not self.spill_dir:
+            return
+        path = self._spill_path(key)
+        if os.path.exists(path):
+            return
+        try:
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            self._trim_disk()
+        except OSError as e:
+            print(f"Parse cache spill failed: {e}")
+
+    def _load_spilled(self, key):
+        if not self.spill_dir:
+            return None
+        path = self._spill_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)
+            return value
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print(f"Parse cache could not read {path}: {e}")
+            return None
+
+    def _trim_disk(self):
+        """Delete the least recently used spill files once the disk budget is exceeded."""
+        files = []
+        for name in os.listdir(self.spill_dir):
+            if name.endswith('.pkl'):
+                path = os.path.join(self.spill_dir, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "items": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "spill_dir": self.spill_dir
+            }
+
+parse_cache = ParseCache(PARSE_CACHE_MAX_BYTES, PARSE_CACHE_DIR, PARSE_CACHE_DISK_MAX_BYTES)
+
+def parse_cache_key(parser, raw, options):
+    digest = hashlib.sha256(raw)
+    digest.update(f"\0{parser.__name__}:{PARSER_VERSION}:{json.dumps(options, sort_keys=True)}".encode('utf-8'))
+    return digest.hexdigest()
+
+def parse_bytes(parser, raw, filename, content_type=None, options=None):
+    """Run a parser on raw upload bytes. Top-level so it can run in a worker process."""
+    upload = FileStorage(stream=io.BytesIO(raw), filename=filename, content_type=content_type)
+    return parser(upload, **(options or {}))
+
+def cached_parse(parser, file, **options):
+    """Run parser on an uploaded file, reusing the result for byte-identical uploads."""
+    with timed('read'):
+        raw = file.stream.read()
+    key = parse_cache_key(parser, raw, options)
+
+    result = parse_cache.get(key)
+    if result is None:
+        with parse_gate.admit(), timed('parse'):
+            result = parse_bytes(parser, raw, file.filename, file.content_type, options)
+        parse_cache.put(key, result)
+    return result
+
+def bet_parser_for(file):
+    """PDF reports and CSV isotherms go through different BET parsers."""
+    return parse_pdf_bet_data if file.filename.lower().endswith('.pdf') else parse_bet_data
+
+# -----------------------------
+# Parallel Parsing
+# Independent uploads (e.g. the seven files of /analyze-combined) are parsed
+# concurrently. Small files use a thread pool. Files of at least
+# PROCESS_PARSE_MIN_BYTES go to a process pool, because pandas CSV parsing
+# and PDF text extraction hold the GIL.
+# -----------------------------
+PARSE_THREAD_WORKERS = int(os.environ.get('PARSE_THREAD_WORKERS', min(8, (os.cpu_count() or 1) + 2)))
+PARSE_PROCESS_WORKERS = int(os.environ.get('PARSE_PROCESS_WORKERS', min(4, os.cpu_count() or 1)))
+PROCESS_PARSE_MIN_BYTES = int(os.environ.get('PROCESS_PARSE_MIN_BYTES', 8 * 1024 * 1024))
+# PDF text extraction costs far more per byte than CSV parsing
+PROCESS_PARSE_PDF_MIN_BYTES = int(os.environ.get('PROCESS_PARSE_PDF_MIN_BYTES', 1024 * 1024))
+
+parse_thread_pool = None
+parse_process_pool = None
+parse_pool_lock = threading.Lock()
+
+def get_parse_pools():
+    """Create the parse pools on first use."""
+    global parse_thread_pool, parse_process_pool
+    with parse_pool_lock:
+        if parse_thread_pool is None:
+            parse_thread_pool = ThreadPoolExecutor(max_workers=PARSE_THREAD_WORKERS, thread_name_prefix='parse')
+        if parse_process_pool is None and PARSE_PROCESS_WORKERS > 0:
+            # spawn rather than fork: the server is multi-threaded by the time the pool starts
+            parse_process_pool = ProcessPoolExecutor(
+                max_workers=PARSE_PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+    return parse_thread_pool, parse_process_pool
+
+def parse_uploads(uploads):
+    """Parse several uploads concurrently.
+
+    Args:
+        uploads: dict of form field name -> (parser, file) or
+            (parser, file, options), options being keyword arguments for the parser.
+
+    Returns:
+        A dict of form field name -> parser result.
+
+    Raises:
+        ValueError: If any file fails to parse, naming every failing field.
+        Overloaded: If the parse gate has no room for this request.
+    """
+    thread_pool, process_pool = get_parse_pools()
+    results = {}
+    tasks = {}
+    for field, (parser, file, *options) in uploads.items():
+        options = options[0] if options else {}
+        # Upload streams belong to the request, so read them here
+        with timed('read'):
+            raw = file.stream.read()
+        key = parse_cache_key(parser, raw, options)
+        cached = parse_cache.get(key)
+        if cached is not None:
+            results[field] = cached
+            continue
+        min_bytes = PROCESS_PARSE_PDF_MIN_BYTES if file.filename.lower().endswith('.pdf') else PROCESS_PARSE_MIN_BYTES
+        pool = process_pool if process_pool is not None and len(raw) >= min_bytes else thread_pool
+        task = (parse_bytes, parser, raw, file.filename, file.content_type, options)
+        if pool is thread_pool:
+            # Run in a copy of the request context, so the parser can time its stages
+            task = (contextvars.copy_context().run,) + task
+        tasks[field] = (key, pool, task)
+    if not tasks:
+        return results
+
+    errors = []
+    unexpected = False
+    # One slot per request; the pools bound how many of its files parse at once
+    with parse_gate.admit():
+        futures = {field: (key, pool.submit(*task)) for field, (key, pool, task) in tasks.items()}
+        for completed, (field, (key, future)) in enumerate(futures.items(), start=1):
+            try:
+                with timed('parse'):
+                    results[field] = future.result()
+                parse_cache.put(key, results[field])
+                report_progress('parsing', files_parsed=completed, files_total=len(futures))
+            except Exception as e:
+                unexpected = unexpected or not isinstance(e, ValueError)
+                errors.append(f"{field}: {e}")
+    if errors:
+        if unexpected:
+            raise RuntimeError("; ".join(errors))
+        raise ValueError("; ".join(errors))
+    return results
+
+# -----------------------------
+# Response Encoding
+# Spectra are parsed into DataFrames and only turned into JSON here, so the
+# client can pick the wire format:
+#   records  - list of row objects (default, what the UI has always used)
+#   columnar - one JSON array per column
+#   float32  - one base64 little-endian float32 buffer per numeric column
+#   binary   - application/octet-stream: "MAB1" magic, uint32 header length,
+#              JSON header, then the raw float32 column buffers
+# -----------------------------
+RESPONSE_FORMATS = ('records', 'columnar', 'float32', 'binary')
+FORMAT_MIMETYPES = {
+    'application/vnd.material-analysis.columnar+json': 'columnar',
+    'application/vnd.material-analysis.float32+json': 'float32',
+    'application/octet-stream': 'binary',
+}
+BINARY_MAGIC = b'MAB1'
+
+def get_response_format():
+    """Pick the wire format from ?format= (or a form field), then the Accept header."""
+    fmt = request.args.get('format') or request.form.get('format')
+    if fmt:
+        if fmt not in RESPONSE_FORMATS:
+            raise ValueError(f"Unknown format '{fmt}'. Use one of: {', '.join(RESPONSE_FORMATS)}.")
+        return fmt
+    # Only explicit entries count; a browser's */* should keep the default.
+    accepted = [mimetype for mimetype, _ in request.accept_mimetypes]
+    for mimetype, fmt in FORMAT_MIMETYPES.items():
+        if mimetype in accepted:
+            return fmt
+    return 'records'
+
+def encode_frame(df, fmt, buffers=None):
+    """Encode a DataFrame in the given wire format."""
+    df = widen_float32(df) if fmt in ('records', 'columnar') else df
+    if fmt == 'records':
+        return df.to_dict('records')
+
+    columns = {}
+    for col in df.columns:
+        series = df[col]
+        is_numeric = pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series)
+        if fmt == 'columnar' or not is_numeric:
+            columns[col] = series.tolist()
+            continue
+        raw = np.ascontiguousarray(series.to_numpy(dtype='<f4')).tobytes()
+        if buffers is None:
+            columns[col] = base64.b64encode(raw).decode('ascii')
+        else:
+            columns[col] = {"offset": sum(len(b) for b in buffers), "nbytes": len(raw)}
+            buffers.append(raw)
+    return {"format": 'columnar' if fmt == 'columnar' else 'float32', "length": len(df), "columns": columns}
+
+def encode_payload(obj, fmt, buffers=None):
+    """Recursively encode every DataFrame found in a response payload."""
+    if isinstance(obj, pd.DataFrame):
+        return encode_frame(obj, fmt, buffers)
+    if isinstance(obj, dict):
+        return {key: encode_payload(value, fmt, buffers) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [encode_payload(value, fmt, buffers) for value in obj]
+    return obj
+
+def analysis_response(payload):
+    """Serialize an analysis payload in the format the client asked for."""
+    fmt = get_response_format()
+    if fmt != 'binary':
+        return jsonify(encode_payload(payload, fmt))
+
+    buffers = []
+    header = json.dumps(encode_payload(payload, fmt, buffers)).encode('utf-8')
+    # Pad the header so the float32 buffers start 4-byte aligned.
+    header += b' ' * (-(len(BINARY_MAGIC) + 4 + len(header)) % 4)
+    body = BINARY_MAGIC + struct.pack('<I', len(header)) + header + b''.join(buffers)
+    return Response(body, mimetype='application/octet-stream')
+
+def stream_requested():
+    """True if the client asked for Server-Sent Events (?stream=1, a form field, or Accept: text/event-stream)."""
+    value = request.args.get('stream') or request.form.get('stream') or ''
+    if value.lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    return 'text/event-stream' in [mimetype for mimetype, _ in request.accept_mimetypes]
+
+def sse_event(event, data):
+    """Format one Server-Sent Event with a JSON data line."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def ai_response(prompt, payload, on_complete=None, session=None):
+    """Get the AI suggestion for prompt and return it together with payload.
+
+    By default this blocks on the AI call and returns one response in the
+    requested wire format. With streaming requested it returns an SSE stream:
+    a "result" event with the encoded payload, "token" events as text arrives,
+    and a final "done" event with the full ai_suggestion.
+    on_complete(ai_suggestion) runs once the suggestion is complete, e.g. to
+    record history.
+    session ties the exchange to an analysis session, see analysis_session().
+    The payload then carries its analysis_id and the question and answer are
+    added to the session's turns.
+    """
+    use_cache = not bypass_cache_requested()
+    timer = current_timer()
+    if session is not None:
+        analysis_id = session.get('analysis_id') or analysis_sessions.create(
+            session['technique'], compact_summary({**session.get('context', {}), **payload}))
+        payload = dict(payload, analysis_id=analysis_id)
+        record = on_complete
+
+        def on_complete(ai_suggestion):
+            # A failed AI call shouldn't become part of the conversation
+            if not ai_suggestion.startswith('Error:'):
+                analysis_sessions.add_turn(analysis_id, session.get('question', ''), ai_suggestion)
+            if record:
+                record(ai_suggestion)
+    if not stream_requested():
+        report_progress('ai')
+        with timed('ai'):
+            ai_suggestion = get_ai_suggestion(prompt, use_cache=use_cache)
+        if on_complete:
+            with timed('history'):
+                on_complete(ai_suggestion)
+        report_progress('encoding')
+        with timed('encode'):
+            return analysis_response(dict(payload, ai_suggestion=ai_suggestion))
+
+    # Binary payloads can't go in an event stream; base64 float32 is the closest fit
+    fmt = get_response_format()
+    with timed('encode'):
+        encoded = encode_payload(payload, 'float32' if fmt == 'binary' else fmt)
+
+    def generate():
+        # Runs after the request context is gone, so the timer is passed explicitly
+        yield sse_event('result', encoded)
+        chunks = []
+        with timed('ai', timer):
+            for chunk in stream_ai_suggestion(prompt, use_cache=use_cache):
+                chunks.append(chunk)
+                yield sse_event('token', {"text": chunk})
+        ai_suggestion = ''.join(chunks)
+        if on_complete:
+            with timed('history', timer):
+                on_complete(ai_suggestion)
+        yield sse_event('done', {"ai_suggestion": ai_suggestion})
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def has_rows(data):
+    """True if parsed data (a DataFrame or a list of records) is non-empty."""
+    return data is not None and len(data) > 0
+
+# -----------------------------
+# Response Compression
+# Analysis and history JSON is large and repetitive. Responses of at least
+# COMPRESS_MIN_BYTES are compressed with brotli (if installed and accepted)
+# or gzip. Event streams are compressed incrementally and flushed after every
+# chunk, so events still arrive as soon as they're sent.
+# -----------------------------
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+# Packed float32 buffers barely compress, so binary responses are left alone
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/event-stream', 'text/plain', 'text/html')
+
+brotli = LazyModule('brotli', 'brotli') if importlib.util.find_spec('brotli') else None
+
+def choose_encoding():
+    """The best encoding the client accepts: br, gzip or None."""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+def compress_stream(chunks, encoding):
+    """Compress an iterable of str/bytes chunks, flushing after each one."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip container
+        compress, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    try:
+        for chunk in chunks:
+            yield compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk) + flush()
+        yield finish()
+    finally:
+        # Closing the source runs its cleanup, e.g. an AI stream's on_complete
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+@app.after_request
+def compress_response(response):
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.status_code != 200 \
+            or response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return response
+        with timed('compress'):
+            if encoding == 'br':
+                response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+            else:
+                response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# -----------------------------
+# Plot Downsampling
+# The charts are at most ~1500 px wide, so the analyze endpoints send a
+# Largest-Triangle-Three-Buckets downsample and keep the full-resolution
+# spectrum server-side. Zooming in re-fetches just the visible window.
+# -----------------------------
+DEFAULT_MAX_POINTS = 2000
+SPECTRUM_STORE_MAX_ITEMS = 32
+
+spectrum_store = OrderedDict()
+spectrum_store_lock = threading.Lock()
+
+def get_max_points():
+    """Read the point budget from ?max_points= or the form. 0 disables downsampling."""
+    value = request.args.get('max_points') or request.form.get('max_points')
+    if value is None or value == '':
+        return DEFAULT_MAX_POINTS
+    try:
+        max_points = int(value)
+    except ValueError:
+        raise ValueError("max_points must be an integer.")
+    if max_points < 0:
+        raise ValueError("max_points must not be negative.")
+    return max_points
+
+def lttb_indices(x, y, n_out):
+    """Return the indices of the Largest-Triangle-Three-Buckets downsample of (x, y)."""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # Bucket i covers edges[i]:edges[i + 1]; the first and last points are always kept.
+    edges = (np.arange(n_out - 1) * ((n - 2) / (n_out - 2))).astype(np.int64) + 1
+    edges[-1] = n - 1
+
+    sampled = np.empty(n_out, dtype=np.int64)
+    sampled[0] = 0
+    sampled[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = n - 1, n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        # Twice the triangle area, up to sign, for every candidate in the bucket.
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        sampled[i + 1] = a
+    return sampled
+
+@timed('downsample')
+def downsample_spectrum(df, x_col, y_col, max_points, peaks=()):
+    """LTTB-downsample a spectrum to max_points rows, always keeping the detected peaks."""
+    if not has_rows(df) or not max_points or len(df) <= max_points:
+        return df
+    x = df[x_col].to_numpy(dtype=np.float64)
+    y = df[y_col].to_numpy(dtype=np.float64)
+    indices = lttb_indices(x, y, max_points)
+    if peaks:
+        rows = peak_rows(df, x_col, peaks)
+        indices = np.union1d(indices, rows[rows >= 0])
+    return df.iloc[indices]
+
+def store_spectrum(df, technique, x_col, y_col):
+    """Keep a full-resolution spectrum for zoom re-fetches and return its ID."""
+    spectrum_id = uuid.uuid4().hex
+    with spectrum_store_lock:
+        spectrum_store[spectrum_id] = {"technique": technique, "x_col": x_col, "y_col": y_col, "data": df}
+        while len(spectrum_store) > SPECTRUM_STORE_MAX_ITEMS:
+            spectrum_store.popitem(last=False)
+    return spectrum_id
+
+def get_stored_spectrum(spectrum_id):
+    """Look up a stored spectrum, marking it as recently used. Returns None if it has expired."""
+    with spectrum_store_lock:
+        entry = spectrum_store.get(spectrum_id)
+        if entry is not None:
+            spectrum_store.move_to_end(spectrum_id)
+        return entry
+
 # -----------------------------
 # API Endpoints
 # -----------------------------
@@ -263,46 +2662,90 @@ def analyze_xrd():
         if not original_file or not modified_file:
             return jsonify({"error": "Missing original or modified file"}), 400
 
+        max_points = get_max_points()
+
         # Process the files and get the data and peaks
-        original_data, original_peaks = parse_xrd_data(original_file)
-        modified_data, modified_peaks = parse_xrd_data(modified_file)
+        peak_settings = get_peak_settings('xrd')
+        phase_settings = get_phase_settings()
+        original_data, original_peaks = cached_parse(parse_xrd_data, original_file, peak_settings=peak_settings)
+        modified_data, modified_peaks = cached_parse(parse_xrd_data, modified_file, peak_settings=peak_settings)
+        original_spectrum_id = store_spectrum(original_data, 'xrd', 'Pos', 'Iobs')
+        modified_spectrum_id = store_spectrum(modified_data, 'xrd', 'Pos', 'Iobs')
+
+        # Peak widths and crystallite sizes
+        original_profiles, modified_profiles = [], []
+        profile_lines = ""
+        if stage_requested('profiles'):
+            wavelength = phase_settings.get('wavelength', XRD_WAVELENGTH)
+            original_profiles = fit_peak_profiles(original_data, original_peaks, wavelength)
+            modified_profiles = fit_peak_profiles(modified_data, modified_peaks, wavelength)
+            profile_lines = f"""
+        Original Peak Profiles (pseudo-Voigt fits; FWHM in degrees 2θ, Scherrer crystallite size in nm): {json.dumps(original_profiles)}
+        Modified Peak Profiles (pseudo-Voigt fits; FWHM in degrees 2θ, Scherrer crystallite size in nm): {json.dumps(modified_profiles)}"""
+
+        # Candidate phases from the reference patterns, if there are any
+        original_phases, modified_phases = [], []
+        match_phases = stage_requested('phases')
+        if match_phases:
+            with timed('phase_id'):
+                original_phases = phase_index.match(original_peaks, (original_data['Pos'].min(), original_data['Pos'].max()), **phase_settings)
+                modified_phases = phase_index.match(modified_peaks, (modified_data['Pos'].min(), modified_data['Pos'].max()), **phase_settings)
+        phase_lines = ""
+        if match_phases and len(phase_index.d):
+            phase_lines = f"""
+        Candidate phases (original, from reference pattern matching): {format_phase_candidates(original_phases)}
+        Candidate phases (modified, from reference pattern matching): {format_phase_candidates(modified_phases)}"""
 
         # Build the prompt for the AI
         prompt = f"""
         Analyze the following XRD data. The original material was modified.
         Original XRD Peaks: {json.dumps(original_peaks)}
-        Modified XRD Peaks: {json.dumps(modified_peaks)}
+        Modified XRD Peaks: {json.dumps(modified_peaks)}{profile_lines}{phase_lines}
         Modification Description: {explanation}
         User's Specific Query: {ai_query}
 
         Provide a comprehensive summary of the changes observed between the original and modified XRD patterns. Discuss the potential implications of these changes from a materials science perspective (e.g., changes in crystallinity, phase transformations, or crystallite size).
         """
 
-        # Get the AI suggestion
-        ai_suggestion = get_ai_suggestion(prompt)
-
-        # Store history
-        history_entry = {
-            "timestamp": datetime.now().isoformat(),
-            "original_file_name": original_file.filename,
-            "modified_file_name": modified_file.filename,
-            "explanation": explanation,
-            "user_query": ai_query,
-            "original_xrd_peaks": original_peaks,
-            "modified_xrd_peaks": modified_peaks,
-            "ai_suggestion": ai_suggestion
-        }
-        xrd_history.append(history_entry)
-
-        # Return the results as a JSON response
-        return jsonify({
-            "original_data": original_data,
-            "modified_data": modified_data,
-            "ai_suggestion": ai_suggestion,
+        # Store history once the AI suggestion is available
+        def record_history(ai_suggestion):
+            history_entry = {
+                "timestamp": datetime.now().isoformat(),
+                "original_file_name": original_file.filename,
+                "modified_file_name": modified_file.filename,
+                "explanation": explanation,
+                "user_query": ai_query,
+                "original_xrd_peaks": original_peaks,
+                "modified_xrd_peaks": modified_peaks,
+                "original_profiles": original_profiles,
+                "modified_profiles": modified_profiles,
+                "original_phases": original_phases,
+                "modified_phases": modified_phases,
+                "original_xrd_data": spectrum_blobs.put(original_data),
+                "modified_xrd_data": spectrum_blobs.put(modified_data),
+                "ai_suggestion": ai_suggestion
+            }
+            history_id = history_store.add('xrd', history_entry)
+            index_spectra('xrd', history_id, original_data, modified_data)
+
+        # Get the AI suggestion and return the results
+        return ai_response(prompt, {
+            "original_data": downsample_spectrum(original_data, 'Pos', 'Iobs', max_points, original_peaks),
+            "modified_data": downsample_spectrum(modified_data, 'Pos', 'Iobs', max_points, modified_peaks),
             "original_peaks": original_peaks,
-            "modified_peaks": modified_peaks
-        })
-
+            "modified_peaks": modified_peaks,
+            "original_profiles": original_profiles,
+            "modified_profiles": modified_profiles,
+            "original_phases": original_phases,
+            "modified_phases": modified_phases,
+            "original_spectrum_id": original_spectrum_id,
+            "modified_spectrum_id": modified_spectrum_id
+        }, record_history, analysis_session('xrd', ai_query, explanation=explanation))
+
+    except Overloaded as e:
+        return overloaded_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         # This will catch any error and send a specific message to the client
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
@@ -315,8 +2758,13 @@ def analyze_ir():
         explanation = request.form.get('explanation', '')
         ai_query = request.form.get('ai_query', '')
 
-        original_data, original_peaks = parse_ir_data(original_file)
-        modified_data, modified_peaks = parse_ir_data(modified_file)
+        max_points = get_max_points()
+
+        peak_settings = get_peak_settings('ir')
+        original_data, original_peaks = cached_parse(parse_ir_data, original_file, peak_settings=peak_settings)
+        modified_data, modified_peaks = cached_parse(parse_ir_data, modified_file, peak_settings=peak_settings)
+        original_spectrum_id = store_spectrum(original_data, 'ir', 'Wavenumber', 'Absorbance')
+        modified_spectrum_id = store_spectrum(modified_data, 'ir', 'Wavenumber', 'Absorbance')
 
         prompt = f"""
         Analyze the following IR data. The original material was modified.
@@ -328,27 +2776,34 @@ def analyze_ir():
         Provide a comprehensive summary of the changes observed between the original and modified IR spectra. Discuss the potential implications of these changes from a materials science perspective (e.g., formation or disappearance of functional groups, changes in bonding).
         """
 
-        ai_suggestion = get_ai_suggestion(prompt)
-
-        history_entry = {
-            "timestamp": datetime.now().isoformat(),
-            "original_file_name": original_file.filename,
-            "modified_file_name": modified_file.filename,
-            "explanation": explanation,
-            "user_query": ai_query,
-            "original_ir_peaks": original_peaks,
-            "modified_ir_peaks": modified_peaks,
-            "ai_suggestion": ai_suggestion
-        }
-        ir_history.append(history_entry)
-
-        return jsonify({
-            "original_data": original_data,
-            "modified_data": modified_data,
-            "ai_suggestion": ai_suggestion,
+        def record_history(ai_suggestion):
+            history_entry = {
+                "timestamp": datetime.now().isoformat(),
+                "original_file_name": original_file.filename,
+                "modified_file_name": modified_file.filename,
+                "explanation": explanation,
+                "user_query": ai_query,
+                "original_ir_peaks": original_peaks,
+                "modified_ir_peaks": modified_peaks,
+                "original_ir_data": spectrum_blobs.put(original_data),
+                "modified_ir_data": spectrum_blobs.put(modified_data),
+                "ai_suggestion": ai_suggestion
+            }
+            history_id = history_store.add('ir', history_entry)
+            index_spectra('ir', history_id, original_data, modified_data)
+
+        return ai_response(prompt, {
+            "original_data": downsample_spectrum(original_data, 'Wavenumber', 'Absorbance', max_points, original_peaks),
+            "modified_data": downsample_spectrum(modified_data, 'Wavenumber', 'Absorbance', max_points, modified_peaks),
             "original_peaks": original_peaks,
-            "modified_peaks": modified_peaks
-        })
+            "modified_peaks": modified_peaks,
+            "original_spectrum_id": original_spectrum_id,
+            "modified_spectrum_id": modified_spectrum_id
+        }, record_history, analysis_session('ir', ai_query, explanation=explanation))
+    except Overloaded as e:
+        return overloaded_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -364,50 +2819,57 @@ def analyze_bet():
         modified_data = None
         original_surface_area = None
         modified_surface_area = None
+        original_fit = None
+        modified_fit = None
 
-        if original_file:
-            if original_file.filename.lower().endswith('.pdf'):
-                original_surface_area, original_data = parse_pdf_bet_data(original_file)
-            else:
-                original_surface_area, original_data = parse_bet_data(original_file)
+        # Parse both files concurrently; large PDF reports go to the process pool
+        uploads = {}
+        if original_file: uploads['original_file'] = (bet_parser_for(original_file), original_file)
+        if modified_file: uploads['modified_file'] = (bet_parser_for(modified_file), modified_file)
+        parsed = parse_uploads(uploads)
 
-        if modified_file:
-            if modified_file.filename.lower().endswith('.pdf'):
-                modified_surface_area, modified_data = parse_pdf_bet_data(modified_file)
-            else:
-                modified_surface_area, modified_data = parse_bet_data(modified_file)
+        if 'original_file' in parsed:
+            original_surface_area, original_data, original_fit = parsed['original_file']
+        if 'modified_file' in parsed:
+            modified_surface_area, modified_data, modified_fit = parsed['modified_file']
 
         prompt = f"""
         Analyze the following BET data. The original material was modified.
         Original BET Surface Area: {original_surface_area} m²/g
         Modified BET Surface Area: {modified_surface_area} m²/g
+        Original BET Fit (C constant and P/P0 range used): {json.dumps(original_fit)}
+        Modified BET Fit (C constant and P/P0 range used): {json.dumps(modified_fit)}
         Modification Description: {explanation}
         User's Specific Query: {ai_query}
 
         Provide a comprehensive summary of the changes in surface area and pore volume between the original and modified materials. Discuss the potential implications of these changes from a materials science perspective.
         """
 
-        ai_suggestion = get_ai_suggestion(prompt)
-
-        history_entry = {
-            "timestamp": datetime.now().isoformat(),
-            "original_file_name": original_file.filename if original_file else None,
-            "modified_file_name": modified_file.filename if modified_file else None,
-            "explanation": explanation,
-            "user_query": ai_query,
-            "original_bet_surface_area": original_surface_area,
-            "modified_bet_surface_area": modified_surface_area,
-            "ai_suggestion": ai_suggestion
-        }
-        bet_history.append(history_entry)
-
-        return jsonify({
+        def record_history(ai_suggestion):
+            history_entry = {
+                "timestamp": datetime.now().isoformat(),
+                "original_file_name": original_file.filename if original_file else None,
+                "modified_file_name": modified_file.filename if modified_file else None,
+                "explanation": explanation,
+                "user_query": ai_query,
+                "original_bet_surface_area": original_surface_area,
+                "modified_bet_surface_area": modified_surface_area,
+                "original_bet_fit": original_fit,
+                "modified_bet_fit": modified_fit,
+                "ai_suggestion": ai_suggestion
+            }
+            history_store.add('bet', history_entry)
+
+        return ai_response(prompt, {
             "original_data": original_data,
             "modified_data": modified_data,
-            "ai_suggestion": ai_suggestion,
             "original_surface_area": original_surface_area,
-            "modified_surface_area": modified_surface_area
-        })
+            "modified_surface_area": modified_surface_area,
+            "original_fit": original_fit,
+            "modified_fit": modified_fit
+        }, record_history, analysis_session('bet', ai_query, explanation=explanation))
+    except Overloaded as e:
+        return overloaded_response(e)
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
@@ -422,16 +2884,26 @@ def analyze_tga():
         if not tga_file or tga_file.filename == '':
             return jsonify({"error": "No TGA file provided."}), 400
 
-        # The parse_tga_data function returns a single dictionary.
-        # We assign the result to a single variable.
-        tga_results = parse_tga_data(tga_file)
+        max_points = get_max_points()
 
-        # We can't use total_weight_loss and peak_info as they aren't
-        # returned by the parse_tga_data function. We'll use the available data.
-        adsorption_capacity = tga_results.get('adsorption_capacity', [])
-        desorption_energy = tga_results.get('desorption_energy', [])
+        # A thermogram gives a curve and its step summary; an adsorption table only values
+        tga_data, tga_results = cached_parse(parse_tga_data, tga_file)
 
-        prompt = f"""
+        if tga_data is not None:
+            # Only the compact summary goes to the AI, never the curve
+            prompt = f"""
+Analyze the following TGA thermogram:
+Temperature Range (°C): {tga_results['temperature_range'][0]} to {tga_results['temperature_range'][1]}
+Total Weight Loss: {tga_results['total_weight_loss']}% (residue {tga_results['residue_percent']}%)
+Mass-Loss Steps: {format_tga_steps(tga_results['steps'])}
+User's Specific Query: {ai_query}
+
+Provide a detailed interpretation of the mass-loss steps. Discuss what they suggest about the material's composition, such as moisture or solvent loss, decomposition of organic components or ligands, and its thermal stability.
+"""
+        else:
+            adsorption_capacity = tga_results.get('adsorption_capacity', [])
+            desorption_energy = tga_results.get('desorption_energy', [])
+            prompt = f"""
 Analyze the following TGA data analysis results:
 Adsorption Capacity (mmol/g): {adsorption_capacity}
 Desorption Energy Consumption (kJ/mol)_exp: {desorption_energy}
@@ -440,23 +2912,27 @@ User's Specific Query: {ai_query}
 Provide a detailed interpretation based on these values. Discuss the relationship between the adsorption capacity and desorption energy, and what this suggests about the material's properties and performance.
 """
 
-        ai_suggestion = get_ai_suggestion(prompt)
-
-        history_entry = {
-            "timestamp": datetime.now().isoformat(),
-            "tga_file_name": tga_file.filename,
-            "user_query": ai_query,
-            "adsorption_capacity": adsorption_capacity,
-            "desorption_energy": desorption_energy,
-            "ai_suggestion": ai_suggestion
-        }
-        tga_history.append(history_entry)
-
-        return jsonify({
-            "tga_results": tga_results, # Returning the full dictionary for convenience
-            "ai_suggestion": ai_suggestion
-        })
-
+        def record_history(ai_suggestion):
+            history_entry = {
+                "timestamp": datetime.now().isoformat(),
+                "tga_file_name": tga_file.filename,
+                "user_query": ai_query,
+                "tga_results": tga_results,
+                "adsorption_capacity": tga_results.get('adsorption_capacity'),
+                "desorption_energy": tga_results.get('desorption_energy'),
+                "ai_suggestion": ai_suggestion
+            }
+            if tga_data is not None:
+                history_entry['tga_data'] = spectrum_blobs.put(tga_data)
+            history_store.add('tga', history_entry)
+
+        return ai_response(prompt, {
+            "tga_data": downsample_spectrum(tga_data, 'Temp', 'Weight_normalized', max_points),
+            "tga_results": tga_results
+        }, record_history, analysis_session('tga', ai_query))
+
+    except Overloaded as e:
+        return overloaded_response(e)
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
@@ -473,6 +2949,7 @@ def analyze_combined():
         modified_bet_file = request.files.get('modified_bet_file')
         tga_file = request.files.get('tga_file')
         ai_query = request.form.get('ai_query', '')
+        max_points = get_max_points()
 
         original_xrd_data = None
         modified_xrd_data = None
@@ -490,258 +2967,1071 @@ def analyze_combined():
         modified_bet_surface_area = None
         tga_results = None
 
-        if original_xrd_file:
-            original_xrd_data, original_xrd_peaks = parse_xrd_data(original_xrd_file)
-
-        if modified_xrd_file:
-            modified_xrd_data, modified_xrd_peaks = parse_xrd_data(modified_xrd_file)
-
-        if original_ir_file:
-            original_ir_data, original_ir_peaks = parse_ir_data(original_ir_file)
-
-        if modified_ir_file:
-            modified_ir_data, modified_ir_peaks = parse_ir_data(modified_ir_file)
-
-        if original_bet_file:
-            if original_bet_file.filename.lower().endswith('.pdf'):
-                original_bet_surface_area, original_bet_data = parse_pdf_bet_data(original_bet_file)
-            else:
-                original_bet_surface_area, original_bet_data = parse_bet_data(original_bet_file)
-        
-        if modified_bet_file:
-            if modified_bet_file.filename.lower().endswith('.pdf'):
-                modified_bet_surface_area, modified_bet_data = parse_pdf_bet_data(modified_bet_file)
-            else:
-                modified_bet_surface_area, modified_bet_data = parse_bet_data(modified_bet_file)
-        
-        if tga_file:
-            tga_results = parse_tga_data(tga_file)
+        # Parse every provided file concurrently
+        uploads = {}
+        xrd_peaks = {"peak_settings": get_peak_settings('xrd')}
+        ir_peaks = {"peak_settings": get_peak_settings('ir')}
+        if original_xrd_file: uploads['original_xrd_file'] = (parse_xrd_data, original_xrd_file, xrd_peaks)
+        if modified_xrd_file: uploads['modified_xrd_file'] = (parse_xrd_data, modified_xrd_file, xrd_peaks)
+        if original_ir_file: uploads['original_ir_file'] = (parse_ir_data, original_ir_file, ir_peaks)
+        if modified_ir_file: uploads['modified_ir_file'] = (parse_ir_data, modified_ir_file, ir_peaks)
+        if original_bet_file: uploads['original_bet_file'] = (bet_parser_for(original_bet_file), original_bet_file)
+        if modified_bet_file: uploads['modified_bet_file'] = (bet_parser_for(modified_bet_file), modified_bet_file)
+        if tga_file: uploads['tga_file'] = (parse_tga_data, tga_file)
+        parsed = parse_uploads(uploads)
+
+        if 'original_xrd_file' in parsed:
+            original_xrd_data, original_xrd_peaks = parsed['original_xrd_file']
+        if 'modified_xrd_file' in parsed:
+            modified_xrd_data, modified_xrd_peaks = parsed['modified_xrd_file']
+        if 'original_ir_file' in parsed:
+            original_ir_data, original_ir_peaks = parsed['original_ir_file']
+        if 'modified_ir_file' in parsed:
+            modified_ir_data, modified_ir_peaks = parsed['modified_ir_file']
+        if 'original_bet_file' in parsed:
+            original_bet_surface_area, original_bet_data, _ = parsed['original_bet_file']
+        if 'modified_bet_file' in parsed:
+            modified_bet_surface_area, modified_bet_data, _ = parsed['modified_bet_file']
+        if 'tga_file' in parsed:
+            tga_data, tga_results = parsed['tga_file']
 
         # Build the prompt for the AI based on the data that was actually provided
         prompt = "Analyze the following combined materials data. "
         
         # CORRECTED LOGIC: Check for existence of EITHER original OR modified BET data
-        if original_bet_data or modified_bet_data:
-            if original_bet_data and modified_bet_data:
+        if has_rows(original_bet_data) or has_rows(modified_bet_data):
+            if has_rows(original_bet_data) and has_rows(modified_bet_data):
                 prompt += f"Original BET Surface Area: {original_bet_surface_area} m²/g. Modified BET Surface Area: {modified_bet_surface_area} m²/g. "
-            elif original_bet_data:
+            elif has_rows(original_bet_data):
                 prompt += f"Original BET Surface Area: {original_bet_surface_area} m²/g. "
-            elif modified_bet_data:
+            elif has_rows(modified_bet_data):
                 prompt += f"Modified BET Surface Area: {modified_bet_surface_area} m²/g. "
         
         # Include other data if provided
-        if original_xrd_data or modified_xrd_data:
+        if has_rows(original_xrd_data) or has_rows(modified_xrd_data):
             prompt += f"Original XRD Peaks: {json.dumps(original_xrd_peaks)}. Modified XRD Peaks: {json.dumps(modified_xrd_peaks)}. "
-        if original_ir_data or modified_ir_data:
+        if has_rows(original_ir_data) or has_rows(modified_ir_data):
             prompt += f"Original IR Peaks: {json.dumps(original_ir_peaks)}. Modified IR Peaks: {json.dumps(modified_ir_peaks)}. "
         if tga_results:
             prompt += f"TGA Results: {json.dumps(tga_results)}. "
         prompt += f"User's Specific Query: {ai_query}"
         
-        # Get the AI suggestion
-        ai_suggestion = get_ai_suggestion(prompt)
-
-        # Store history
-        history_entry = {
-            "timestamp": datetime.now().isoformat(),
-            "user_query": ai_query,
-            "ai_suggestion": ai_suggestion
-        }
-        if original_xrd_data: history_entry['original_xrd_data'] = original_xrd_data
-        if modified_xrd_data: history_entry['modified_xrd_data'] = modified_xrd_data
-        if original_ir_data: history_entry['original_ir_data'] = original_ir_data
-        if modified_ir_data: history_entry['modified_ir_data'] = modified_ir_data
-        if original_bet_data: history_entry['original_bet_data'] = original_bet_data
-        if modified_bet_data: history_entry['modified_bet_data'] = modified_bet_data
-        if tga_results: history_entry['tga_data'] = tga_results
-        
-        combined_history.append(history_entry)
-
-        return jsonify({
-            "original_xrd": original_xrd_data,
-            "modified_xrd": modified_xrd_data,
-            "original_ir": original_ir_data,
-            "modified_ir": modified_ir_data,
+        # Store history once the AI suggestion is available
+        def record_history(ai_suggestion):
+            history_entry = {
+                "timestamp": datetime.now().isoformat(),
+                "user_query": ai_query,
+                "ai_suggestion": ai_suggestion,
+                # Summary fields listed by /history/combined
+                "original_xrd_peaks": original_xrd_peaks,
+                "modified_xrd_peaks": modified_xrd_peaks,
+                "original_ir_peaks": original_ir_peaks,
+                "modified_ir_peaks": modified_ir_peaks,
+                "original_bet_surface_area": original_bet_surface_area,
+                "modified_bet_surface_area": modified_bet_surface_area,
+                "tga_results": tga_results,
+                # Per-technique names, since one entry holds several uploads
+                "original_xrd_file_name": original_xrd_file.filename if original_xrd_file else None,
+                "modified_xrd_file_name": modified_xrd_file.filename if modified_xrd_file else None,
+                "original_ir_file_name": original_ir_file.filename if original_ir_file else None,
+                "modified_ir_file_name": modified_ir_file.filename if modified_ir_file else None,
+                "original_bet_file_name": original_bet_file.filename if original_bet_file else None,
+                "modified_bet_file_name": modified_bet_file.filename if modified_bet_file else None,
+                "tga_file_name": tga_file.filename if tga_file else None
+            }
+            # Spectra are stored once as blobs; the entry only keeps references
+            if has_rows(original_xrd_data): history_entry['original_xrd_data'] = spectrum_blobs.put(original_xrd_data)
+            if has_rows(modified_xrd_data): history_entry['modified_xrd_data'] = spectrum_blobs.put(modified_xrd_data)
+            if has_rows(original_ir_data): history_entry['original_ir_data'] = spectrum_blobs.put(original_ir_data)
+            if has_rows(modified_ir_data): history_entry['modified_ir_data'] = spectrum_blobs.put(modified_ir_data)
+            if has_rows(original_bet_data): history_entry['original_bet_data'] = spectrum_blobs.put(original_bet_data)
+            if has_rows(modified_bet_data): history_entry['modified_bet_data'] = spectrum_blobs.put(modified_bet_data)
+            if has_rows(tga_data): history_entry['tga_data'] = spectrum_blobs.put(tga_data)
+
+            history_id = history_store.add('combined', history_entry)
+            if has_rows(original_xrd_data) or has_rows(modified_xrd_data):
+                index_spectra('xrd', history_id, original_xrd_data, modified_xrd_data)
+            if has_rows(original_ir_data) or has_rows(modified_ir_data):
+                index_spectra('ir', history_id, original_ir_data, modified_ir_data)
+
+        # Get the AI suggestion and return the results
+        return ai_response(prompt, {
+            "original_xrd": downsample_spectrum(original_xrd_data, 'Pos', 'Iobs', max_points, original_xrd_peaks),
+            "modified_xrd": downsample_spectrum(modified_xrd_data, 'Pos', 'Iobs', max_points, modified_xrd_peaks),
+            "original_ir": downsample_spectrum(original_ir_data, 'Wavenumber', 'Absorbance', max_points, original_ir_peaks),
+            "modified_ir": downsample_spectrum(modified_ir_data, 'Wavenumber', 'Absorbance', max_points, modified_ir_peaks),
             "original_bet": original_bet_data,
             "modified_bet": modified_bet_data,
-            "tga_data": tga_results,
-            "ai_suggestion": ai_suggestion
-        })
+            "tga_data": downsample_spectrum(tga_data, 'Temp', 'Weight_normalized', max_points),
+            "tga_results": tga_results
+        }, record_history, analysis_session(
+            'combined', ai_query,
+            # The response only carries spectra for these, which the summary leaves out
+            original_xrd_peaks=original_xrd_peaks,
+            modified_xrd_peaks=modified_xrd_peaks,
+            original_ir_peaks=original_ir_peaks,
+            modified_ir_peaks=modified_ir_peaks,
+            original_bet_surface_area=original_bet_surface_area,
+            modified_bet_surface_area=modified_bet_surface_area
+        ))
+
+    except Overloaded as e:
+        return overloaded_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"An unexpected error occurred: {e}"}), 500
 
+@app.route('/spectrum/<spectrum_id>', methods=['GET'])
+def get_spectrum_window(spectrum_id):
+    """Full-resolution data for one x window (2θ or wavenumber) of a spectrum returned by /analyze-xrd or /analyze-ir."""
+    try:
+        entry = get_stored_spectrum(spectrum_id)
+        if entry is None:
+            return jsonify({"error": "Spectrum not found or expired. Please re-run the analysis."}), 404
+
+        df = entry["data"]
+        x_col = entry["x_col"]
+        x_min = request.args.get('x_min', type=float)
+        x_max = request.args.get('x_max', type=float)
+        if x_min is not None and x_max is not None and x_min > x_max:
+            x_min, x_max = x_max, x_min
+
+        mask = np.ones(len(df), dtype=bool)
+        if x_min is not None:
+            mask &= (df[x_col] >= x_min).to_numpy()
+        if x_max is not None:
+            mask &= (df[x_col] <= x_max).to_numpy()
+        window = df[mask]
+
+        # Full resolution unless the client asks for a budget
+        max_points = request.args.get('max_points', default=0, type=int)
+        return analysis_response({
+            "spectrum_id": spectrum_id,
+            "technique": entry["technique"],
+            "total_points": int(mask.sum()),
+            "data": downsample_spectrum(window, x_col, entry["y_col"], max_points)
+        })
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": f"An unexpected error occurred: {e}"}), 500
 
 # -----------------------------
-# Follow-up question
+# Batch Analysis
+# Composition series of tens to hundreds of samples in one request. Every
+# spectrum is interpolated onto a common grid, peaks are found in one pass
+# over the resulting 2-D array and matched across samples, and a single AI
+# call summarizes the whole series.
 # -----------------------------
-@app.route('/analyze-xrd-followup', methods=['POST'])
-def follow_up_xrd():
-    try:
-        data = request.form
-        query = data.get('user_query', '')
-        prev_analysis = json.loads(data.get('previous_analysis', '{}'))
+BATCH_MAX_SAMPLES = int(os.environ.get('BATCH_MAX_SAMPLES', 500))
+BATCH_MAX_UNZIPPED_BYTES = int(os.environ.get('BATCH_MAX_UNZIPPED_BYTES', 1024 * 1024 * 1024))
+
+BATCH_TECHNIQUES = {
+    'xrd': (parse_xrd_data, 'Pos', 'Iobs'),
+    'ir': (parse_ir_data, 'Wavenumber', 'Absorbance'),
+}
+
+def batch_samples(files):
+    """Expand uploaded files and zip archives into one FileStorage per sample."""
+    samples = []
+    for file in files:
+        if not file or not file.filename:
+            continue
+        if not file.filename.lower().endswith('.zip'):
+            samples.append(file)
+            continue
+        try:
+            archive = zipfile.ZipFile(io.BytesIO(file.stream.read()))
+        except zipfile.BadZipFile:
+            raise ValueError(f"{file.filename} is not a valid zip archive.")
+        with archive:
+            members = [info for info in archive.infolist()
+                       if not info.is_dir() and not info.filename.startswith('__MACOSX/')
+                       and not os.path.basename(info.filename).startswith('.')]
+            if sum(info.file_size for info in members) > BATCH_MAX_UNZIPPED_BYTES:
+                raise ValueError(f"{file.filename} is too large once unzipped.")
+            for info in members:
+                samples.append(FileStorage(stream=io.BytesIO(archive.read(info)), filename=info.filename))
+    if len(samples) < 2:
+        raise ValueError("Upload at least two sample files (or a zip of them) as 'files'.")
+    if len(samples) > BATCH_MAX_SAMPLES:
+        raise ValueError(f"At most {BATCH_MAX_SAMPLES} samples can be analyzed in one batch.")
+    return samples
+
+def sample_names(files):
+    """Unique sample names from file names, without directories or extensions."""
+    names = []
+    seen = {}
+    for file in files:
+        name = os.path.splitext(os.path.basename(file.filename))[0] or 'sample'
+        seen[name] = seen.get(name, 0) + 1
+        names.append(name if seen[name] == 1 else f"{name} ({seen[name]})")
+    return names
+
+def common_grid(spectra, x_col, y_col, n_points):
+    """Interpolate spectra onto n_points shared x values spanning the range they all cover.
 
-        if not query or not prev_analysis:
-            return jsonify({"error": "Missing query or previous analysis data."}), 400
+    Returns:
+        (grid, stack): the x values and a float32 array with one row per spectrum.
+    """
+    lo = max(float(df[x_col].min()) for df in spectra)
+    hi = min(float(df[x_col].max()) for df in spectra)
+    if not lo < hi:
+        raise ValueError(f"The samples' {x_col} ranges do not overlap.")
+    grid = np.linspace(lo, hi, n_points)
+    stack = np.empty((len(spectra), n_points), dtype=np.float32)
+    for row, df in zip(stack, spectra):
+        x = df[x_col].to_numpy(dtype=np.float64)
+        order = np.argsort(x, kind='stable')
+        row[:] = np.interp(grid, x[order], df[y_col].to_numpy(dtype=np.float64)[order])
+    return grid, stack
+
+def match_peaks(grid, stack, peaks, tolerance):
+    """Group peaks of different samples that lie within tolerance grid points of each other.
 
+    Returns:
+        (centers, positions, intensities): the x value of each peak group, and
+        sample x group matrices of each sample's strongest peak in the group
+        (NaN where a sample has no peak there).
+    """
+    all_peaks = np.sort(np.concatenate(peaks)) if peaks else np.array([], dtype=int)
+    if not len(all_peaks):
+        empty = np.empty((len(stack), 0))
+        return np.array([]), empty, empty
+    # A new group starts wherever consecutive peaks are more than tolerance apart
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(all_peaks) > tolerance) + 1, [len(all_peaks)]))
+    group_starts = all_peaks[bounds[:-1]]
+    centers = np.array([grid[int(np.median(all_peaks[a:b]))] for a, b in zip(bounds[:-1], bounds[1:])])
+
+    positions = np.full((len(stack), len(centers)), np.nan)
+    intensities = np.full((len(stack), len(centers)), np.nan)
+    for i, index in enumerate(peaks):
+        # Weakest first, so the strongest peak of a group is written last
+        index = index[np.argsort(stack[i, index], kind='stable')]
+        group = np.searchsorted(group_starts, index, side='right') - 1
+        positions[i, group] = grid[index]
+        intensities[i, group] = stack[i, index]
+    return centers, positions, intensities
+
+def matrix_to_json(matrix, decimals=4):
+    """Nested lists with None for missing values (NaN isn't valid JSON)."""
+    rounded = np.round(matrix, decimals)
+    return np.where(np.isnan(rounded), None, rounded).tolist()
+
+def analyze_batch(technique):
+    """Shared implementation of /analyze-xrd-batch and /analyze-ir-batch."""
+    parser, x_col, y_col = BATCH_TECHNIQUES[technique]
+    try:
+        explanation = request.form.get('explanation', '')
+        ai_query = request.form.get('ai_query', '')
+        samples = batch_samples(request.files.getlist('files'))
+        names = sample_names(samples)
+        max_points = get_max_points()
+        peak_settings = {**PEAK_DEFAULTS[technique], **get_peak_settings(technique)}
+
+        # Per-sample peaks aren't needed, so parse with detection effectively off
+        options = {"peak_settings": {"max_peaks": 0}}
+        parsed = parse_uploads({f"files[{i}] ({name})": (parser, file, options)
+                                for i, (name, file) in enumerate(zip(names, samples))})
+        spectra = [data for data, _ in parsed.values()]
+
+        longest = max(len(df) for df in spectra)
+        grid, stack = common_grid(spectra, x_col, y_col, min(max_points, longest) if max_points else longest)
+        _, peaks = detect_peaks(stack, **peak_settings)
+        centers, positions, intensities = match_peaks(grid, stack, peaks, peak_settings['distance'])
+
+        table = "\n".join(
+            f"{name}: " + ", ".join('-' if np.isnan(value) else f"{value:.4g}" for value in row)
+            for name, row in zip(names, intensities)
+        )
         prompt = f"""
-Based on the previous XRD analysis:
-Previous analysis results: {json.dumps(prev_analysis)}
-Previous AI suggestion: {prev_analysis.get('ai_suggestion', '')}
-Answer the following follow-up question:
-{query}
-"""
-        ai_suggestion = get_ai_suggestion(prompt)
-        return jsonify({"ai_suggestion": ai_suggestion})
+        Analyze the following series of {len(names)} {technique.upper()} samples measured together.
+        Peak positions ({x_col}) matched across samples: {json.dumps(np.round(centers, 4).tolist())}
+        Peak {y_col} per sample, in the same order ('-' = peak absent):
+        {table}
+        Description of the series: {explanation}
+        User's Specific Query: {ai_query}
 
+        Provide a comprehensive summary of the trends across the series: peaks that appear, disappear, shift or change in intensity, and which samples stand out. Discuss the potential implications from a materials science perspective.
+        """
+
+        summary = {
+            "samples": names,
+            "peak_positions": np.round(centers, 4).tolist(),
+            "positions": matrix_to_json(positions),
+            "intensities": matrix_to_json(intensities)
+        }
+
+        def record_history(ai_suggestion):
+            history_store.add(f"{technique}_batch", {
+                "timestamp": datetime.now().isoformat(),
+                "file_names": [file.filename for file in samples],
+                "explanation": explanation,
+                "user_query": ai_query,
+                **summary,
+                "ai_suggestion": ai_suggestion
+            })
+
+        return ai_response(prompt, {
+            **summary,
+            "spectra": pd.DataFrame({x_col: grid, **dict(zip(names, stack))})
+        }, record_history, analysis_session(f"{technique}_batch", ai_query, explanation=explanation))
+    except Overloaded as e:
+        return overloaded_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        return jsonify({"error": f"Follow-up request failed: {e}"}), 500
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
-@app.route('/analyze-ir-followup', methods=['POST'])
-def follow_up_ir():
-    try:
-        data = request.form
-        query = data.get('user_query', '')
-        prev_analysis = json.loads(data.get('previous_analysis', '{}'))
+@app.route('/analyze-xrd-batch', methods=['POST'])
+def analyze_xrd_batch():
+    return analyze_batch('xrd')
 
-        if not query or not prev_analysis:
-            return jsonify({"error": "Missing query or previous analysis data."}), 400
+@app.route('/analyze-ir-batch', methods=['POST'])
+def analyze_ir_batch():
+    return analyze_batch('ir')
 
-        prompt = f"""
-Based on the previous IR analysis:
-Previous analysis results: {json.dumps(prev_analysis)}
-Previous AI suggestion: {prev_analysis.get('ai_suggestion', '')}
+# -----------------------------
+# Analysis Sessions
+# Every analysis response carries an analysis_id. The session behind it
+# keeps a compact summary of the results (peaks, surface areas, fits, TGA
+# values; never the spectra) and the question/answer turns so far, so a
+# follow-up only sends the ID and its question. Follow-up prompts are kept
+# within FOLLOW_UP_TOKEN_BUDGET, dropping the oldest turns first.
+# -----------------------------
+ANALYSIS_SESSION_TTL = int(os.environ.get('ANALYSIS_SESSION_TTL', 24 * 60 * 60))
+ANALYSIS_SESSION_MAX_ITEMS = int(os.environ.get('ANALYSIS_SESSION_MAX_ITEMS', 1000))
+FOLLOW_UP_TOKEN_BUDGET = int(os.environ.get('FOLLOW_UP_TOKEN_BUDGET', 4000))
+# Rough size of a token, for budgeting without a tokenizer
+CHARS_PER_TOKEN = 4
+SUMMARY_MAX_LIST_ITEMS = 20
+
+TECHNIQUE_LABELS = {'xrd': 'XRD', 'ir': 'IR', 'bet': 'BET', 'tga': 'TGA', 'combined': 'combined',
+                    'xrd_batch': 'XRD batch', 'ir_batch': 'IR batch'}
+
+class AnalysisSessionStore:
+    """In-memory analysis sessions, least recently used evicted first."""
+
+    def __init__(self, max_items, ttl):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def create(self, technique, summary):
+        analysis_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[analysis_id] = {"technique": technique, "summary": summary, "turns": [], "updated": time.time()}
+            while len(self.sessions) > self.max_items:
+                self.sessions.popitem(last=False)
+        return analysis_id
+
+    def get(self, analysis_id):
+        """A snapshot of the session, or None if it is unknown or expired."""
+        with self.lock:
+            session = self.sessions.get(analysis_id)
+            if session is None:
+                return None
+            if time.time() - session["updated"] > self.ttl:
+                del self.sessions[analysis_id]
+                return None
+            self.sessions.move_to_end(analysis_id)
+            return dict(session, turns=list(session["turns"]))
+
+    def add_turn(self, analysis_id, question, answer):
+        with self.lock:
+            session = self.sessions.get(analysis_id)
+            if session is not None:
+                session["turns"].append({"question": question, "answer": answer})
+                session["updated"] = time.time()
+                self.sessions.move_to_end(analysis_id)
+
+analysis_sessions = AnalysisSessionStore(ANALYSIS_SESSION_MAX_ITEMS, ANALYSIS_SESSION_TTL)
+
+def analysis_session(technique, question, **context):
+    """The session argument of ai_response() for a new analysis.
+
+    context holds inputs worth keeping that aren't in the response payload,
+    such as the modification description.
+    """
+    return {"technique": technique, "question": question, "context": context}
+
+def compact_summary(obj):
+    """Strip an analysis payload down to what a follow-up prompt needs.
+
+    Spectra (DataFrames, encoded frames, long record lists), IDs and empty
+    values are dropped, long value lists are shortened and floats rounded.
+    """
+    if isinstance(obj, dict):
+        if 'columns' in obj and 'length' in obj:
+            return None
+        summary = {}
+        for key, value in obj.items():
+            if key == 'ai_suggestion' or key.endswith('_id'):
+                continue
+            value = compact_summary(value)
+            if value is not None and value != [] and value != {}:
+                summary[key] = value
+        return summary
+    if isinstance(obj, pd.DataFrame):
+        return None
+    if isinstance(obj, (list, tuple)):
+        if len(obj) > SUMMARY_MAX_LIST_ITEMS:
+            if any(isinstance(item, dict) for item in obj):
+                return None
+            return [compact_summary(item) for item in obj[:SUMMARY_MAX_LIST_ITEMS]] + [f"... ({len(obj)} values)"]
+        return [compact_summary(item) for item in obj]
+    if isinstance(obj, (float, np.floating)):
+        return float(f"{obj:.6g}")
+    if isinstance(obj, np.integer):
+        return int(obj)
+    return obj
+
+def follow_up_prompt(technique, session, question):
+    """Build a follow-up prompt from a session, within FOLLOW_UP_TOKEN_BUDGET."""
+    budget = FOLLOW_UP_TOKEN_BUDGET * CHARS_PER_TOKEN - len(question)
+    summary = json.dumps(session["summary"], separators=(',', ':'), default=str)
+    if len(summary) > budget // 2:
+        summary = summary[:budget // 2] + '...'
+    remaining = budget - len(summary)
+
+    # Newest turns first, until the budget runs out
+    turns = []
+    for turn in reversed(session["turns"]):
+        text = f"Q: {turn['question'] or '(initial analysis)'}\nA: {turn['answer']}"
+        if len(text) > remaining:
+            if not turns and remaining > 0:
+                turns.append(text[:remaining] + '...')
+            break
+        turns.append(text)
+        remaining -= len(text)
+    omitted = len(session["turns"]) - len(turns)
+
+    return f"""
+Based on the previous {TECHNIQUE_LABELS.get(session['technique'], technique)} analysis:
+Analysis summary: {summary}
+Conversation so far{f' ({omitted} earlier turns omitted)' if omitted else ''}:
+{chr(10).join(reversed(turns))}
 Answer the following follow-up question:
-{query}
+{question}
 """
-        ai_suggestion = get_ai_suggestion(prompt)
-        return jsonify({"ai_suggestion": ai_suggestion})
 
-    except Exception as e:
-        return jsonify({"error": f"Follow-up request failed: {e}"}), 500
+# -----------------------------
+# Follow-up question
+# -----------------------------
+def answer_follow_up(technique):
+    """Shared implementation of the /analyze-*-followup endpoints.
 
-@app.route('/analyze-bet-followup', methods=['POST'])
-def follow_up_bet():
+    Takes user_query and either analysis_id (returned by the analyze
+    endpoints) or, from older clients, the whole previous response as
+    previous_analysis. The latter is condensed into a new session.
+    """
     try:
         data = request.form
         query = data.get('user_query', '')
-        prev_analysis = json.loads(data.get('previous_analysis', '{}'))
-
-        if not query or not prev_analysis:
+        analysis_id = data.get('analysis_id')
+
+        if analysis_id:
+            session = analysis_sessions.get(analysis_id)
+            if session is None:
+                return jsonify({"error": "This analysis has expired. Please run the analysis again."}), 404
+        else:
+            prev_analysis = json.loads(data.get('previous_analysis', '{}'))
+            if not query or not prev_analysis:
+                return jsonify({"error": "Missing query or previous analysis data."}), 400
+            analysis_id = analysis_sessions.create(technique, compact_summary(prev_analysis))
+            analysis_sessions.add_turn(analysis_id, '', prev_analysis.get('ai_suggestion', ''))
+            session = analysis_sessions.get(analysis_id)
+
+        if not query:
             return jsonify({"error": "Missing query or previous analysis data."}), 400
 
-        prompt = f"""
-Based on the previous BET analysis:
-Previous analysis results: {json.dumps(prev_analysis)}
-Previous AI suggestion: {prev_analysis.get('ai_suggestion', '')}
-Answer the following follow-up question:
-{query}
-"""
-        ai_suggestion = get_ai_suggestion(prompt)
-        return jsonify({"ai_suggestion": ai_suggestion})
+        prompt = follow_up_prompt(technique, session, query)
+        return ai_response(prompt, {}, session={"analysis_id": analysis_id, "question": query})
 
+    except Overloaded as e:
+        return overloaded_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": f"Follow-up request failed: {e}"}), 500
 
-@app.route('/analyze-tga-followup', methods=['POST'])
-def follow_up_tga():
-    try:
-        data = request.form
-        query = data.get('user_query', '')
-        prev_analysis = json.loads(data.get('previous_analysis', '{}'))
+@app.route('/analyze-xrd-followup', methods=['POST'])
+def follow_up_xrd():
+    return answer_follow_up('xrd')
 
-        if not query or not prev_analysis:
-            return jsonify({"error": "Missing query or previous analysis data."}), 400
+@app.route('/analyze-ir-followup', methods=['POST'])
+def follow_up_ir():
+    return answer_follow_up('ir')
 
-        prompt = f"""
-Based on the previous TGA analysis:
-Previous analysis results: {json.dumps(prev_analysis)}
-Previous AI suggestion: {prev_analysis.get('ai_suggestion', '')}
-Answer the following follow-up question:
-{query}
-"""
-        ai_suggestion = get_ai_suggestion(prompt)
-        return jsonify({"ai_suggestion": ai_suggestion})
+@app.route('/analyze-bet-followup', methods=['POST'])
+def follow_up_bet():
+    return answer_follow_up('bet')
 
-    except Exception as e:
-        return jsonify({"error": f"Follow-up request failed: {e}"}), 500
+@app.route('/analyze-tga-followup', methods=['POST'])
+def follow_up_tga():
+    return answer_follow_up('tga')
 
 @app.route('/analyze-combined-followup', methods=['POST'])
 def follow_up_combined():
-    try:
-        data = request.form
-        query = data.get('user_query', '')
-        prev_analysis = json.loads(data.get('previous_analysis', '{}'))
+    return answer_follow_up('combined')
 
-        if not query or not prev_analysis:
-            return jsonify({"error": "Missing query or previous analysis data."}), 400
+# -----------------------------
+# Background Jobs
+# With async=1 (query parameter or form field) an /analyze-* POST only
+# validates and buffers the uploads, then returns 202 with a job ID. The
+# normal view function runs later on a bounded worker pool, inside a request
+# context rebuilt from the buffered uploads. GET /jobs/<id> reports progress
+# and the final payload; /jobs/<id>/events streams the same as SSE.
+# -----------------------------
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 32))
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', 60 * 60))
+
+# Endpoints that can run as jobs, with the file fields they require
+JOB_ENDPOINTS = {
+    'analyze_xrd': ('original_file', 'modified_file'),
+    'analyze_ir': ('original_file', 'modified_file'),
+    'analyze_bet': (),
+    'analyze_tga': ('tga_file',),
+    'analyze_combined': (),
+    'analyze_xrd_batch': ('files',),
+    'analyze_ir_batch': ('files',),
+}
+
+class Job:
+    """State of one background analysis, shared between the worker and pollers."""
+
+    def __init__(self, endpoint):
+        self.id = uuid.uuid4().hex
+        self.endpoint = endpoint
+        self.status = 'queued'
+        self.stages = []
+        self.result = None
+        self.error = None
+        self.status_code = None
+        self.created = time.time()
+        self.finished = None
+        self.version = 0
+        self.condition = threading.Condition()
+
+    def set_stage(self, stage, **details):
+        with self.condition:
+            now = time.time()
+            if self.stages and self.stages[-1]['stage'] == stage:
+                self.stages[-1].update(details)
+            else:
+                if self.stages:
+                    self.stages[-1]['duration'] = now - self.stages[-1]['started_at']
+                self.stages.append(dict(details, stage=stage, started_at=now))
+            self.status = 'running'
+            self.version += 1
+            self.condition.notify_all()
+
+    def finish(self, result=None, error=None, status_code=200):
+        with self.condition:
+            self.finished = time.time()
+            if self.stages and 'duration' not in self.stages[-1]:
+                self.stages[-1]['duration'] = self.finished - self.stages[-1]['started_at']
+            self.status = 'failed' if error is not None else 'done'
+            self.result = result
+            self.error = error
+            self.status_code = status_code
+            self.version += 1
+            self.condition.notify_all()
+
+    @property
+    def is_finished(self):
+        return self.status in ('done', 'failed')
+
+    def wait_for_change(self, version, timeout):
+        """Block until the job changes past version. Returns the new version."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout=timeout)
+            return self.version
+
+    def to_dict(self, include_result=True):
+        with self.condition:
+            data = {
+                "job_id": self.id,
+                "endpoint": self.endpoint,
+                "status": self.status,
+                "stage": self.stages[-1]['stage'] if self.stages else self.status,
+                "stages": [dict(stage) for stage in self.stages],
+                "created": datetime.fromtimestamp(self.created).isoformat(),
+                "finished": datetime.fromtimestamp(self.finished).isoformat() if self.finished else None
+            }
+            if self.error is not None:
+                data["error"] = self.error
+                data["status_code"] = self.status_code
+            if include_result and self.result is not None:
+                data["result"] = self.result
+            return data
+
+jobs = {}
+jobs_lock = threading.Lock()
+job_slots = threading.BoundedSemaphore(JOB_WORKERS + JOB_QUEUE_SIZE)
+job_pool = None
+
+def get_job_pool():
+    global job_pool
+    with jobs_lock:
+        if job_pool is None:
+            job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+    return job_pool
+
+def purge_expired_jobs():
+    now = time.time()
+    with jobs_lock:
+        expired = [job_id for job_id, job in jobs.items() if job.finished and now - job.finished > JOB_TTL_SECONDS]
+        for job_id in expired:
+            del jobs[job_id]
+
+def get_job(job_id):
+    purge_expired_jobs()
+    with jobs_lock:
+        return jobs.get(job_id)
+
+def report_progress(stage, **details):
+    """Record the current stage if this code is running inside a background job."""
+    job = getattr(g, 'job', None) if g else None
+    if job is not None:
+        job.set_stage(stage, **details)
+
+def async_requested():
+    value = request.args.get('async') or request.form.get('async') or ''
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+@app.before_request
+def submit_async_job():
+    """Turn an /analyze-* POST with async=1 into a background job."""
+    if request.method != 'POST' or request.endpoint not in JOB_ENDPOINTS or not async_requested():
+        return None
 
-        prompt = f"""
-Based on the previous combined analysis:
-Previous analysis results: {json.dumps(prev_analysis)}
-Previous AI suggestion: {prev_analysis.get('ai_suggestion', '')}
-Answer the following follow-up question:
-{query}
-"""
-        ai_suggestion = get_ai_suggestion(prompt)
-        return jsonify({"ai_suggestion": ai_suggestion})
+    missing = [field for field in JOB_ENDPOINTS[request.endpoint] if not request.files.get(field)]
+    if missing:
+        return jsonify({"error": f"Missing file(s): {', '.join(missing)}"}), 400
+    try:
+        fmt = get_response_format()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
+    if not job_slots.acquire(blocking=False):
+        response = jsonify({"error": "Too many queued analyses. Please retry shortly."})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+
+    # Buffer everything the view needs; the upload streams die with this request
+    ignored = ('async', 'stream', 'format')
+    query = MultiDict((key, value) for key, value in request.args.items(multi=True) if key not in ignored)
+    # Results are stored as JSON, so the packed binary format becomes base64 float32
+    query['format'] = 'float32' if fmt == 'binary' else fmt
+    form = [(key, value) for key, value in request.form.items(multi=True) if key not in ignored]
+    files = [(field, file.stream.read(), file.filename, file.content_type)
+             for field, file in request.files.items(multi=True)]
+
+    purge_expired_jobs()
+    job = Job(request.endpoint)
+    with jobs_lock:
+        jobs[job.id] = job
+    get_job_pool().submit(run_job, job, request.path, query, form, files)
+    return jsonify({
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events"
+    }), 202
+
+def run_job(job, path, query, form, files):
+    """Run a buffered analysis request through its normal view function."""
+    try:
+        data = MultiDict(form)
+        for field, raw, filename, content_type in files:
+            data.add(field, (io.BytesIO(raw), filename, content_type))
+        with app.test_request_context(path, method='POST', query_string=query, data=data):
+            g.job = job
+            g.timer = RequestTimer(job.endpoint, job.id)
+            job.set_stage('parsing')
+            response = app.make_response(app.view_functions[job.endpoint]())
+            g.timer.finish(response.status_code, sum(len(raw) for _, raw, _, _ in files), response.content_length)
+        payload = response.get_json(silent=True)
+        if response.status_code >= 400:
+            error = payload.get('error') if isinstance(payload, dict) else response.get_data(as_text=True)
+            job.finish(error=error, status_code=response.status_code)
+        else:
+            job.finish(result=payload)
     except Exception as e:
-        return jsonify({"error": f"Follow-up request failed: {e}"}), 500
+        print(f"Job {job.id} failed: {e}")
+        job.finish(error=f"An unexpected error occurred: {e}", status_code=500)
+    finally:
+        job_slots.release()
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found or expired."}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found or expired."}), 404
+
+    def generate():
+        version = None
+        while True:
+            new_version = job.wait_for_change(version, timeout=15)
+            if new_version == version:
+                yield ": keep-alive\n\n"
+                continue
+            version = new_version
+            if job.is_finished:
+                yield sse_event(job.status, job.to_dict())
+                return
+            yield sse_event('progress', job.to_dict(include_result=False))
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# -----------------------------
+# Cache statistics
+# -----------------------------
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify({"parse_cache": parse_cache.stats(), "ai_cache": ai_cache.stats(), "spectrum_blobs": spectrum_blobs.stats()})
 
 # -----------------------------
 # History
 # -----------------------------
-@app.route('/history/xrd', methods=['GET'])
-def get_xrd_history():
-    return jsonify(xrd_history)
-
-@app.route('/history/ir', methods=['GET'])
-def get_ir_history():
-    return jsonify(ir_history)
-
-@app.route('/history/bet', methods=['GET'])
-def get_bet_history():
-    # Return a stripped-down history to avoid large payloads
-    history_to_send = [{
-        "ai_suggestion": item["ai_suggestion"],
-        "original_bet_surface_area": item["original_bet_surface_area"],
-        "modified_bet_surface_area": item["modified_bet_surface_area"],
-        "timestamp": item["timestamp"],
-        "user_query": item["user_query"]
-    } for item in bet_history]
-    return jsonify(history_to_send)
-
-@app.route('/history/tga', methods=['GET'])
-def get_tga_history():
-    # Return a stripped-down history for TGA
-    history_to_send = [{
-        "ai_suggestion": item["ai_suggestion"],
-        "adsorption_capacity": item["adsorption_capacity"],
-        "desorption_energy": item["desorption_energy"],
-        "timestamp": item["timestamp"],
-        "user_query": item["user_query"]
-    } for item in tga_history]
-    return jsonify(history_to_send)
-
-@app.route('/history/combined', methods=['GET'])
-def get_combined_history():
-    # Return a stripped-down history to avoid large payloads
-    history_to_send = [{
-        "ai_suggestion": item["ai_suggestion"],
-        "original_xrd_peaks": item["original_xrd_peaks"],
-        "modified_xrd_peaks": item["modified_xrd_peaks"],
-        "original_ir_peaks": item["original_ir_peaks"],
-        "modified_ir_peaks": item["modified_ir_peaks"],
-        "original_bet_surface_area": item["original_bet_surface_area"],
-        "modified_bet_surface_area": item["modified_bet_surface_area"],
-        "tga_results": item["tga_results"],
-        "timestamp": item["timestamp"],
-        "user_query": item["user_query"]
-    } for item in combined_history]
-    return jsonify(history_to_send)
+# Fields returned per technique; None means the whole entry.
+# The stripped-down lists avoid sending large payloads.
+HISTORY_FIELDS = {
+    'xrd': None,
+    'ir': None,
+    'bet': ("ai_suggestion", "original_bet_surface_area", "modified_bet_surface_area", "original_bet_fit", "modified_bet_fit",
+            "timestamp", "user_query"),
+    'tga': ("ai_suggestion", "adsorption_capacity", "desorption_energy", "tga_results", "timestamp", "user_query"),
+    'combined': ("ai_suggestion", "original_xrd_peaks", "modified_xrd_peaks", "original_ir_peaks", "modified_ir_peaks",
+                 "original_bet_surface_area", "modified_bet_surface_area", "tga_results", "timestamp", "user_query"),
+    'xrd_batch': None,
+    'ir_batch': None,
+}
+
+@app.route('/spectra/<blob_id>', methods=['GET'])
+def get_spectrum_blob(blob_id):
+    """Load a spectrum referenced by a history entry ({"blob_id": ...}) on demand."""
+    try:
+        df = spectrum_blobs.load(blob_id)
+        if df is None:
+            return jsonify({"error": "Spectrum not found or expired."}), 404
+        max_points = get_max_points() if request.args.get('max_points') else 0
+        if len(df.columns) >= 2:
+            df = downsample_spectrum(df, df.columns[0], df.columns[1], max_points)
+        return analysis_response({"blob_id": blob_id, "data": df})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/history/<technique>', methods=['GET'])
+def get_history(technique):
+    """Newest-first history page.
+
+    Query parameters: limit (default 50), cursor (next_cursor from the
+    previous page) and q (full-text search over the query and AI suggestion).
+    Pages carry an ETag; while the store is unchanged, If-None-Match gets 304.
+    """
+    if technique not in HISTORY_FIELDS:
+        return jsonify({"error": f"Unknown history type '{technique}'."}), 404
+    # Entries are never modified, so the store version and the query pin down the page
+    page_key = f"{technique}:{history_store.version()}:{request.query_string.decode('latin-1')}"
+    etag = hashlib.sha1(page_key.encode('utf-8')).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        try:
+            limit = request.args.get('limit', default=HISTORY_PAGE_SIZE, type=int)
+            limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+            entries, next_cursor = history_store.page(
+                technique,
+                limit=limit,
+                cursor=request.args.get('cursor'),
+                search=request.args.get('q', '').strip() or None
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        fields = HISTORY_FIELDS[technique]
+        if fields is not None:
+            entries = [dict({key: entry.get(key) for key in fields}, id=entry['id']) for entry in entries]
+        response = jsonify({"items": entries, "next_cursor": next_cursor})
+    # Weak, because the bytes differ with the content encoding. no-cache lets
+    # browsers keep the page but makes them revalidate it on every fetch.
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# -----------------------------
+# Similarity Search
+# Every XRD and IR spectrum that goes into history is also resampled onto a
+# fixed grid per technique (the maximum within each grid step, so narrow
+# peaks survive), baseline-subtracted, scaled to unit length and added to a
+# float32 matrix. Cosine similarity against all stored spectra is then one
+# matrix-vector product; correlation reuses the same product, corrected with
+# each row's mean. A shift tolerance broadens the query's peaks (a running
+# maximum) before the product. The grids are coarse on purpose: a query
+# reads the whole matrix, so its cost is proportional to the grid size.
+# The rows are appended to SIMILARITY_DIR as fixed-size records (history ID,
+# side, mean, vector), one file per technique and grid. Worker processes
+# share the files, and each reads what the others appended before a query.
+# -----------------------------
+SIMILARITY_DIR = os.environ.get('SIMILARITY_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'similarity'))
+SIMILARITY_GRIDS = {
+    'xrd': {"start": 5.0, "stop": 90.0, "step": 0.2, "x_col": 'Pos', "y_col": 'Iobs'},
+    'ir': {"start": 400.0, "stop": 4000.0, "step": 8.0, "x_col": 'Wavenumber', "y_col": 'Absorbance'},
+}
+SIMILARITY_DEFAULT_K = 10
+SIMILARITY_MAX_K = 100
+SIMILARITY_METRICS = ('correlation', 'cosine')
+SIMILARITY_MAX_SHIFT_STEPS = 50
+SPECTRUM_SIDES = ('original', 'modified')
+
+class SimilarityIndex:
+    """Normalized spectra of one technique on a common grid, searchable by similarity."""
+
+    def __init__(self, technique, directory, start, stop, step, x_col, y_col):
+        self.technique = technique
+        self.start = start
+        self.step = step
+        self.size = int(round((stop - start) / step)) + 1
+        self.x_col = x_col
+        self.y_col = y_col
+        self.path = os.path.join(directory, f"{technique}-{start:g}-{stop:g}-{step:g}.bin")
+        self.lock = threading.Lock()
+        self.offset = 0
+        self.count = 0
+        self.vectors = self.means = self.history_ids = self.sides = None
+
+    def record_dtype(self):
+        return np.dtype([('history_id', '<i8'), ('side', '<i4'), ('mean', '<f4'), ('vector', '<f4', (self.size,))])
+
+    def vectorize(self, df):
+        """(unit vector, mean) of a spectrum on the grid, or None if it doesn't overlap the grid."""
+        if not has_rows(df):
+            return None
+        x = df[self.x_col].to_numpy(dtype=np.float64)
+        y = df[self.y_col].to_numpy(dtype=np.float64)
+        finite = np.isfinite(x) & np.isfinite(y)
+        order = np.argsort(x[finite], kind='stable')
+        x, y = x[finite][order], y[finite][order]
+        if len(x) < 2:
+            return None
+
+        grid = self.start + self.step * np.arange(self.size)
+        edges = np.append(grid - self.step / 2, grid[-1] + self.step / 2)
+        bounds = np.searchsorted(x, edges)
+        values = np.interp(grid, x, y, left=np.nan, right=np.nan)
+        # Steps that hold measured points take their maximum; sparser scans are interpolated
+        filled = np.diff(bounds) > 0
+        if filled.any():
+            values[filled] = np.maximum.reduceat(y[bounds[0]:bounds[-1]], bounds[:-1][filled] - bounds[0])
+        covered = np.isfinite(values)
+        if not covered.any():
+            return None
+        values[covered] -= values[covered].min()
+        values[~covered] = 0
+        norm = np.linalg.norm(values)
+        if not norm:
+            return None
+        vector = (values / norm).astype(np.float32)
+        return vector, float(vector.mean())
+
+    def add(self, history_id, side, df):
+        """Append a spectrum from history entry history_id. Spectra that miss the grid are skipped."""
+        vectorized = self.vectorize(df)
+        if vectorized is None:
+            return
+        record = np.zeros(1, dtype=self.record_dtype())
+        record['history_id'] = history_id
+        record['side'] = SPECTRUM_SIDES.index(side)
+        record['vector'], record['mean'] = vectorized
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # One write on an O_APPEND descriptor, so records from concurrent processes don't interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, record.tobytes())
+        finally:
+            os.close(fd)
+
+    def refresh(self):
+        """Read records appended since the last call. Returns (vectors, means, history_ids, sides)."""
+        with self.lock:
+            dtype = self.record_dtype()
+            try:
+                size = os.path.getsize(self.path)
+            except FileNotFoundError:
+                size = 0
+            if size < self.offset:
+                # The file was removed or replaced; start over
+                self.offset = self.count = 0
+            complete = size - size % dtype.itemsize
+            if complete > self.offset:
+                with open(self.path, 'rb') as f:
+                    f.seek(self.offset)
+                    records = np.frombuffer(f.read(complete - self.offset), dtype=dtype)
+                self._append(records)
+                self.offset = complete
+            n = self.count
+            if self.vectors is None:
+                return np.empty((0, self.size), dtype=np.float32), np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+            # Views: later appends only write past n or into new arrays
+            return self.vectors[:n], self.means[:n], self.history_ids[:n], self.sides[:n]
+
+    def _append(self, records):
+        """Copy records into the in-memory arrays, doubling their capacity as needed. Caller holds the lock."""
+        needed = self.count + len(records)
+        capacity = 0 if self.vectors is None else len(self.vectors)
+        if needed > capacity:
+            capacity = max(needed, 2 * capacity, 1024)
+            grown = (np.empty((capacity, self.size), dtype=np.float32), np.empty(capacity, dtype=np.float32),
+                     np.empty(capacity, dtype=np.int64), np.empty(capacity, dtype=np.int32))
+            if self.vectors is not None:
+                for new, old in zip(grown, (self.vectors, self.means, self.history_ids, self.sides)):
+                    new[:self.count] = old[:self.count]
+            self.vectors, self.means, self.history_ids, self.sides = grown
+        rows = slice(self.count, needed)
+        self.vectors[rows] = records['vector']
+        self.means[rows] = records['mean']
+        self.history_ids[rows] = records['history_id']
+        self.sides[rows] = records['side']
+        self.count = needed
+
+    def stored_vector(self, history_id, side):
+        """(unit vector, mean) stored for one side of a history entry, or None."""
+        vectors, means, history_ids, sides = self.refresh()
+        rows = np.flatnonzero((history_ids == history_id) & (sides == SPECTRUM_SIDES.index(side)))
+        if not len(rows):
+            return None
+        return vectors[rows[-1]], float(means[rows[-1]])
+
+    def search(self, vector, mean, k=SIMILARITY_DEFAULT_K, metric='correlation', shift_steps=0, exclude_history_id=None):
+        """Top-k stored spectra most similar to (vector, mean), from vectorize().
+
+        shift_steps broadens every query peak by that many grid steps on each
+        side, so stored peaks shifted by up to that much still overlap it.
+        Returns dicts with history_id, side and similarity, best first.
+        """
+        vectors, means, history_ids, sides = self.refresh()
+        if not len(vectors):
+            return []
+
+        if shift_steps:
+            padded = np.pad(vector, shift_steps)
+            vector = np.lib.stride_tricks.sliding_window_view(padded, 2 * shift_steps + 1).max(axis=1)
+            vector = vector / np.linalg.norm(vector)
+            mean = float(vector.mean())
+
+        scores = vectors @ vector.astype(np.float32)
+        if metric == 'correlation':
+            # Pearson correlation of unit vectors u and q with means mu and mq:
+            # (u·q - n mu mq) / sqrt((1 - n mu²)(1 - n mq²))
+            n = self.size
+            row_means = means.astype(np.float64)
+            spread = np.sqrt(np.maximum(1 - n * row_means ** 2, 1e-12) * max(1 - n * mean ** 2, 1e-12))
+            scores = (scores - n * row_means * mean) / spread
+        if exclude_history_id is not None:
+            scores[history_ids == exclude_history_id] = -np.inf
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [{
+            "history_id": int(history_ids[i]),
+            "side": SPECTRUM_SIDES[sides[i]],
+            "similarity": round(float(scores[i]), 4)
+        } for i in top if np.isfinite(scores[i])]
+
+    def stats(self):
+        vectors, _, _, _ = self.refresh()
+        return {"spectra": len(vectors), "grid_points": self.size, "bytes": vectors.nbytes}
+
+similarity_indexes = {technique: SimilarityIndex(technique, SIMILARITY_DIR, **grid) for technique, grid in SIMILARITY_GRIDS.items()}
+
+def index_spectra(technique, history_id, original=None, modified=None):
+    """Add the spectra of a new history entry to the technique's similarity index."""
+    index = similarity_indexes[technique]
+    try:
+        with timed('similarity_index'):
+            for side, df in (('original', original), ('modified', modified)):
+                if df is not None:
+                    index.add(history_id, side, df)
+    except OSError as e:
+        print(f"Could not add to the {technique} similarity index: {e}")
+
+@app.route('/similar/<technique>', methods=['GET', 'POST'])
+def similar_spectra(technique):
+    """Stored spectra most similar to an uploaded one (file) or to a history entry (history_id and side).
+
+    Optional parameters: k (default 10), metric (correlation or cosine) and
+    shift, the largest peak shift to allow, in x units (degrees 2θ or cm⁻¹).
+    """
+    index = similarity_indexes.get(technique)
+    if index is None:
+        return jsonify({"error": f"Similarity search is not available for '{technique}'."}), 404
+    try:
+        k = request.values.get('k', default=SIMILARITY_DEFAULT_K, type=int)
+        k = max(1, min(k, SIMILARITY_MAX_K))
+        metric = request.values.get('metric', 'correlation')
+        if metric not in SIMILARITY_METRICS:
+            raise ValueError(f"metric must be one of: {', '.join(SIMILARITY_METRICS)}.")
+        try:
+            shift = float(request.values.get('shift') or 0)
+        except ValueError:
+            raise ValueError("shift must be a number.")
+        shift_steps = min(int(round(abs(shift) / index.step)), SIMILARITY_MAX_SHIFT_STEPS)
+
+        query_file = request.files.get('file')
+        history_id = request.values.get('history_id', type=int)
+        if query_file:
+            parser = parse_xrd_data if technique == 'xrd' else parse_ir_data
+            df, _ = cached_parse(parser, query_file, peak_settings=get_peak_settings(technique))
+            query = index.vectorize(df)
+            if query is None:
+                raise ValueError("The spectrum does not overlap the similarity grid.")
+        elif history_id is not None:
+            side = request.values.get('side', 'original')
+            if side not in SPECTRUM_SIDES:
+                raise ValueError(f"side must be one of: {', '.join(SPECTRUM_SIDES)}.")
+            query = index.stored_vector(history_id, side)
+            if query is None:
+                return jsonify({"error": "That history entry has no indexed spectrum."}), 404
+        else:
+            raise ValueError("Upload a file or give a history_id.")
+
+        with timed('similarity'):
+            results = index.search(*query, k=k, metric=metric, shift_steps=shift_steps, exclude_history_id=history_id)
+
+        # Label the matches from their history entries
+        entries = history_store.get_many([result["history_id"] for result in results])
+        for result in results:
+            entry = entries.get(result["history_id"], {})
+            result["technique"] = entry.get("technique")
+            result["timestamp"] = entry.get("timestamp")
+            # Combined entries name their files per technique
+            result["file_name"] = entry.get(f"{result['side']}_{technique}_file_name") or entry.get(f"{result['side']}_file_name")
+            result["user_query"] = entry.get("user_query")
+        return jsonify({"technique": technique, "metric": metric, "searched": index.count, "results": results})
+
+    except Overloaded as e:
+        return overloaded_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+if WARM_UP:
+    warm_up()
 
 if __name__ == '__main__':
 
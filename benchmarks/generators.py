@@ -0,0 +1,126 @@
+"""Seeded synthetic inputs for the benchmarks.
+
+Every generator returns the raw bytes of an upload. The same (size, seed)
+pair always produces the same file.
+"""
+import io
+
+import numpy as np
+
+XRD_PHASES = [(20.0, 1000), (26.6, 450), (35.0, 600), (44.0, 800), (50.1, 250), (60.0, 300), (68.3, 180)]
+IR_BANDS = [(3400, 0.8, 60), (2920, 0.3, 15), (1650, 0.5, 12), (1450, 0.2, 10), (1100, 0.9, 20), (800, 0.25, 8)]
+
+
+def to_csv(header, columns, fmt):
+    buffer = io.StringIO()
+    buffer.write(header + "\n")
+    np.savetxt(buffer, np.column_stack(columns), fmt=fmt, delimiter=',')
+    return buffer.getvalue().encode('utf-8')
+
+
+def pseudo_voigt(x, center, fwhm, eta):
+    """Mix of a Lorentzian (weight eta) and a Gaussian with the same FWHM, unit height."""
+    gaussian = np.exp(-4 * np.log(2) * ((x - center) / fwhm) ** 2)
+    lorentzian = 1 / (1 + 4 * ((x - center) / fwhm) ** 2)
+    return eta * lorentzian + (1 - eta) * gaussian
+
+
+def xrd_scan(n, seed=0):
+    """A 10-90 °2θ scan: pseudo-Voigt reflections on a decaying background with counting noise."""
+    rng = np.random.default_rng(seed)
+    two_theta = np.linspace(10, 90, n)
+    intensity = 80 + 400 * np.exp(-two_theta / 12)
+    for center, height in XRD_PHASES:
+        shift = rng.normal(0, 0.02)
+        intensity += height * rng.uniform(0.8, 1.2) * pseudo_voigt(two_theta, center + shift, rng.uniform(0.1, 0.3), rng.uniform(0.2, 0.8))
+    counts = rng.poisson(intensity).astype(np.float64)
+    return to_csv("Pos [°2θ],Iobs [counts]", [two_theta, counts], ['%.5f', '%.1f'])
+
+
+def ir_spectrum(n, seed=0):
+    """A 4000-400 cm-1 absorbance spectrum: Lorentzian bands on a sloping baseline with noise."""
+    rng = np.random.default_rng(seed)
+    wavenumber = np.linspace(4000, 400, n)
+    absorbance = 0.03 + 0.00001 * (4000 - wavenumber)
+    for center, height, width in IR_BANDS:
+        absorbance += height * rng.uniform(0.8, 1.2) * pseudo_voigt(wavenumber, center + rng.normal(0, 3), width, 1.0)
+    absorbance += rng.normal(0, 0.002, n)
+    return to_csv("Wavenumber (cm-1),Absorbance", [wavenumber, absorbance], ['%.3f', '%.6f'])
+
+
+def bet_points(n, seed=0):
+    """(P/P0, Va) of a type II N2 isotherm following BET up to ~0.35, with 0.5% noise."""
+    rng = np.random.default_rng(seed)
+    vm = rng.uniform(20, 150)
+    c = rng.uniform(30, 300)
+    p = np.linspace(0.005, 0.95, n)
+    bet = vm * c * p / ((1 - p) * (1 + (c - 1) * p))
+    # Multilayer growth flattens off above the BET range
+    va = np.where(p < 0.35, bet, bet * (1 - 0.5 * (p - 0.35)))
+    return p, va * (1 + rng.normal(0, 0.005, n))
+
+
+def bet_isotherm(n, seed=0):
+    p, va = bet_points(n, seed)
+    return to_csv("P/P0,Va", [p, va], ['%.6f', '%.5f'])
+
+
+def tga_table(n, seed=0):
+    """Adsorption capacity / desorption energy table as exported by the TGA software."""
+    rng = np.random.default_rng(seed)
+    capacity = rng.uniform(0.5, 4.0, n)
+    energy = 60 + 25 * capacity + rng.normal(0, 3, n)
+    return to_csv("Adsorption capacity (mmol/g),Desorption energy (kJ/mol)", [capacity, energy], ['%.4f', '%.2f'])
+
+
+TGA_STEPS = [(100, 0.08, 8), (350, 0.30, 15), (600, 0.15, 20)]
+
+
+def tga_thermogram(n, seed=0):
+    """A 25-900 °C run at 10 °C/min: sigmoid mass-loss steps from a 10 mg sample, with balance noise."""
+    rng = np.random.default_rng(seed)
+    temperature = np.linspace(25, 900, n) + rng.normal(0, 0.05, n)
+    time = (np.linspace(25, 900, n) - 25) * 6
+    mass = np.full(n, 10.0)
+    for center, loss, width in TGA_STEPS:
+        mass -= 10 * loss * rng.uniform(0.9, 1.1) / (1 + np.exp(-(temperature - center - rng.normal(0, 5)) / width))
+    mass += rng.normal(0, 0.002, n)
+    return to_csv("Time (s),Temperature (°C),Mass (mg)", [time, temperature, mass], ['%.2f', '%.3f', '%.5f'])
+
+
+def pdf_document(pages):
+    """A minimal PDF with one Helvetica text line per entry of each page's line list."""
+    def escape(text):
+        return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+    kids = " ".join(f"{4 + 2 * i} 0 R" for i in range(len(pages)))
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i, lines in enumerate(pages):
+        content = ("BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(f"({escape(line)}) Tj T*" for line in lines) + " ET").encode('latin-1')
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>".encode())
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF".encode()
+    return bytes(out)
+
+
+def bet_pdf_report(n, seed=0, lines_per_page=70):
+    """An instrument report whose isotherm table (n rows) follows several pages of boilerplate."""
+    p, va = bet_points(n, seed)
+    boilerplate = [f"Sample prep log {k}: degassed at 150 C under vacuum, mass 0.1{k % 10} g" for k in range(lines_per_page)]
+    lines = [line for _ in range(5) for line in boilerplate]
+    lines += ["Isotherm data", "P/P0 Va (cm3/g STP)"] + [f"{a:.6f} {b:.5f}" for a, b in zip(p, va)] + ["End of report"]
+    return pdf_document([lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)])
@@ -0,0 +1,415 @@
+"""Benchmark the parsers and the analyze endpoints.
+
+Each benchmark runs in its own process so peak memory can be attributed to
+it. Parsers are called directly; endpoints go through the Flask test client
+with the parse cache disabled and the AI call answered by the local stub in
+stub_llm.py. Examples:
+
+    python benchmarks/run.py                               # default sizes
+    python benchmarks/run.py --sizes 1k,10M --only parse_xrd
+    python benchmarks/run.py --save-baseline benchmarks/baselines/default.json
+    python benchmarks/run.py --baseline benchmarks/baselines/default.json
+    python benchmarks/run.py --only startup --import-report
+
+Startup benchmarks time `import app` in a fresh interpreter, so heavy
+imports creeping back into module load show up as a regression.
+With --baseline the exit status is 1 if any benchmark got slower or used
+more memory than the baseline allows.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import generators  # noqa: E402
+from stub_llm import start_stub  # noqa: E402
+
+DEFAULT_SIZES = "1k,10k,100k,1M"
+# Endpoint inputs are generated per repetition, so keep them smaller
+ENDPOINT_MAX_SIZE = 1_000_000
+
+# name -> (generator, largest size worth running)
+PARSERS = {
+    'parse_xrd_data': (generators.xrd_scan, None),
+    'parse_ir_data': (generators.ir_spectrum, None),
+    'parse_bet_data_from_df': (generators.bet_points, None),
+    # Report generation dominates past this size
+    'parse_pdf_bet_data': (generators.bet_pdf_report, 10_000),
+    'parse_tga_data': (generators.tga_thermogram, None),
+}
+
+# route -> ({form field: generator}, largest size)
+ENDPOINTS = {
+    '/analyze-xrd': ({'original_file': generators.xrd_scan, 'modified_file': generators.xrd_scan}, None),
+    '/analyze-ir': ({'original_file': generators.ir_spectrum, 'modified_file': generators.ir_spectrum}, None),
+    '/analyze-bet': ({'original_file': generators.bet_isotherm, 'modified_file': generators.bet_isotherm}, None),
+    '/analyze-tga': ({'tga_file': generators.tga_thermogram}, None),
+    '/analyze-combined': ({
+        'original_xrd_file': generators.xrd_scan,
+        'modified_xrd_file': generators.xrd_scan,
+        'original_ir_file': generators.ir_spectrum,
+        'original_bet_file': generators.bet_isotherm,
+        'tga_file': generators.tga_thermogram,
+    }, None),
+}
+
+UPLOAD_NAMES = {generators.bet_pdf_report: 'report.pdf'}
+
+# name -> statement timed in a fresh interpreter
+STARTUP = {
+    'import': 'import app',
+    'warm_up': 'import app; app.warm_up()',
+}
+
+# Runs in a bare interpreter: the runner's own imports (numpy) would hide the cost
+STARTUP_SCRIPT = """
+import json, sys, time
+sys.path.insert(0, {repo!r})
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+try:
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+except ImportError:
+    peak = None
+print(json.dumps({{"ms": elapsed * 1000, "peak_rss_mb": peak}}))
+"""
+IMPORT_REPORT_TOP = 15
+
+
+def parse_size(text):
+    units = {'k': 1_000, 'M': 1_000_000}
+    return int(float(text[:-1]) * units[text[-1]]) if text[-1] in units else int(text)
+
+
+def format_size(n):
+    for unit, scale in (('M', 1_000_000), ('k', 1_000)):
+        if n >= scale and n % scale == 0:
+            return f"{n // scale}{unit}"
+    return str(n)
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far, or None where unavailable (Windows)."""
+    # ru_maxrss on Linux keeps the parent's peak across fork and exec, so
+    # prefer VmHWM, which only covers this process's own memory
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb():
+    """Current resident memory; falls back to the peak where /proc isn't available."""
+    try:
+        import resource
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+    except (ImportError, OSError):
+        return peak_rss_mb()
+
+
+def write_inputs(kind, target, size, repeat, scratch):
+    """Generate the benchmark's inputs into files, so the worker's memory peak is the code under test.
+
+    Returns a list of {field: path}: one set for a parser, one per run (plus
+    the warm-up) for an endpoint, so no cache can answer.
+    """
+    if kind == 'parser':
+        generators_by_field = [{'file': PARSERS[target][0]}]
+    else:
+        fields = ENDPOINTS[target][0]
+        generators_by_field = [fields] * (repeat + 1)
+
+    inputs = []
+    for run, fields in enumerate(generators_by_field):
+        paths = {}
+        for k, (field, generator) in enumerate(fields.items()):
+            seed = run * len(fields) + k
+            path = os.path.join(scratch, f"{generator.__name__}-{size}-{seed}")
+            if not os.path.exists(path):
+                data = generator(size, seed=seed)
+                with open(path, 'wb') as f:
+                    if isinstance(data, tuple):
+                        np.save(f, np.array(data))
+                    else:
+                        f.write(data)
+            paths[field] = path
+        inputs.append(paths)
+    return inputs
+
+
+def measure(run, repeat):
+    """Time repeat calls of run(i) after one warm-up call.
+
+    Returns the latencies in ms and how far the peak RSS rose above the
+    resident memory before the first call.
+    """
+    before = current_rss_mb()
+    run(-1)
+    latencies = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        run(i)
+        latencies.append((time.perf_counter() - start) * 1000)
+    after = peak_rss_mb()
+    return latencies, (after - before if before is not None and after is not None else None)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def bench_parser(name, inputs, repeat):
+    sys.path.insert(0, REPO_DIR)
+    import app
+    # Load the lazy modules before the RSS baseline, so their import cost
+    # isn't counted against the first call
+    app.warm_up()
+    from werkzeug.datastructures import FileStorage
+
+    generator = PARSERS[name][0]
+    parser = getattr(app, name)
+    if name == 'parse_bet_data_from_df':
+        p, va = np.load(inputs[0]['file'])
+        input_bytes = p.nbytes + va.nbytes
+
+        def run(i):
+            parser(app.pd.DataFrame({'P/P0': p, 'Va': va}))
+    else:
+        raw = read(inputs[0]['file'])
+        input_bytes = len(raw)
+
+        def run(i):
+            parser(FileStorage(stream=io.BytesIO(raw), filename=UPLOAD_NAMES.get(generator, 'data.csv')))
+
+    latencies, extra_rss = measure(run, repeat)
+    return latencies, input_bytes, extra_rss
+
+
+def bench_endpoint(route, inputs, repeat):
+    sys.path.insert(0, REPO_DIR)
+    import app
+    # Load the lazy modules before the RSS baseline, so their import cost
+    # isn't counted against the first call
+    app.warm_up()
+
+    client = app.app.test_client()
+    input_bytes = sum(os.path.getsize(path) for path in inputs[0].values())
+
+    def run(i):
+        data = {field: (io.BytesIO(read(path)), f"{field}.csv") for field, path in inputs[i + 1].items()}
+        data['bypass_cache'] = '1'
+        response = client.post(route, data=data, content_type='multipart/form-data')
+        if response.status_code != 200:
+            raise RuntimeError(f"{route} returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+
+    latencies, extra_rss = measure(run, repeat)
+    return latencies, input_bytes, extra_rss
+
+
+def worker(spec):
+    """Run one benchmark and print its result as JSON (child process side)."""
+    bench = bench_parser if spec['kind'] == 'parser' else bench_endpoint
+    latencies, input_bytes, extra_rss = bench(spec['target'], spec['inputs'], spec['repeat'])
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(json.dumps({
+        "size": spec['size'],
+        "input_mb": round(input_bytes / (1024 * 1024), 3),
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(p95, 3),
+        "p99_ms": round(p99, 3),
+        "points_per_s": round(spec['size'] / (p50 / 1000)) if p50 else None,
+        "peak_rss_mb": round(extra_rss, 1) if extra_rss is not None else None,
+    }))
+
+
+def run_benchmark(kind, target, size, repeat, env, scratch):
+    inputs = write_inputs(kind, target, size, repeat, scratch)
+    spec = json.dumps({"kind": kind, "target": target, "size": size, "repeat": repeat, "inputs": inputs})
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', spec],
+                               env=env, capture_output=True, text=True)
+    if completed.returncode < 0:
+        return {"error": f"killed by signal {-completed.returncode} (out of memory?)"}
+    if completed.returncode != 0:
+        return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "failed"}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run_startup(name, repeat, env):
+    """Time a STARTUP statement in repeat fresh interpreters."""
+    script = STARTUP_SCRIPT.format(repo=REPO_DIR, statement=STARTUP[name])
+    latencies, peaks = [], []
+    for _ in range(repeat):
+        completed = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True)
+        if completed.returncode != 0:
+            return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "failed"}
+        run = json.loads(completed.stdout.strip().splitlines()[-1])
+        latencies.append(run['ms'])
+        peaks.append(run['peak_rss_mb'])
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "size": 0,
+        "input_mb": 0.0,
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(p95, 3),
+        "p99_ms": round(p99, 3),
+        "points_per_s": None,
+        "peak_rss_mb": round(max(peaks), 1) if None not in peaks else None,
+    }
+
+
+def import_report(env):
+    """Print the modules app imports directly, slowest first, from python -X importtime."""
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                               env=env, cwd=REPO_DIR, capture_output=True, text=True)
+    imports = []
+    for line in completed.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package", nesting shown by
+        # indentation, and a package is listed after everything it imported
+        if not line.startswith('import time:') or line.count('|') != 2:
+            continue
+        _, cumulative, module = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        if depth == 0:
+            if module.strip() == 'app':
+                break
+            imports = []
+        elif depth == 1:
+            imports.append((int(cumulative) / 1000, module.strip()))
+    print("\nSlowest imports below app (cumulative ms):")
+    for ms, module in sorted(imports, reverse=True)[:IMPORT_REPORT_TOP]:
+        print(f"  {ms:>9.1f}  {module}")
+
+
+def compare(result, baseline, tolerance):
+    """Return a list of regressions of result against its baseline entry."""
+    problems = []
+    # Small absolute slack so sub-millisecond timings don't flap
+    if baseline.get('p50_ms') and result['p50_ms'] > baseline['p50_ms'] * (1 + tolerance) + 1:
+        problems.append(f"p50 {baseline['p50_ms']:.1f} -> {result['p50_ms']:.1f} ms")
+    if baseline.get('peak_rss_mb') is not None and result.get('peak_rss_mb') is not None \
+            and result['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + tolerance) + 5:
+        problems.append(f"peak RSS {baseline['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the parsers and analyze endpoints.")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help=f"comma-separated point counts (default {DEFAULT_SIZES})")
+    parser.add_argument('--only', action='append', default=[], help="run benchmarks whose name contains this (repeatable)")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs per benchmark")
+    parser.add_argument('--latency', type=float, default=0.0, help="stub AI answer latency in seconds")
+    parser.add_argument('--baseline', help="JSON file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown/growth over the baseline")
+    parser.add_argument('--save-baseline', help="write the results to this JSON file")
+    parser.add_argument('--import-report', action='store_true', help="list the slowest imports of app")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(json.loads(args.worker))
+        return 0
+
+    server, api_base = start_stub(latency=args.latency)
+    scratch = tempfile.mkdtemp(prefix='xrd-bench-')
+    env = dict(os.environ,
+               GEMINI_API_BASE=api_base,
+               HISTORY_DB=':memory:',
+               SPECTRA_DIR=os.path.join(scratch, 'spectra'),
+               SIMILARITY_DIR=os.path.join(scratch, 'similarity'),
+               PARSE_CACHE_MAX_BYTES='0',
+               PARSE_CACHE_DIR='')
+
+    plan = [('startup', name, 0, None) for name in STARTUP]
+    for size in (parse_size(text) for text in args.sizes.split(',')):
+        for name, (_, max_size) in PARSERS.items():
+            plan.append(('parser', name, size, max_size))
+        for route, (_, max_size) in ENDPOINTS.items():
+            plan.append(('endpoint', route, size, min(max_size or ENDPOINT_MAX_SIZE, ENDPOINT_MAX_SIZE)))
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<42} {'input MB':>9} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'points/s':>12} {'peak MB':>8}")
+    for kind, target, size, max_size in plan:
+        name = f"{kind}:{target}" if kind == 'startup' else f"{kind}:{target}@{format_size(size)}"
+        if args.only and not any(pattern in name for pattern in args.only):
+            continue
+        if max_size is not None and size > max_size:
+            continue
+        if kind == 'startup':
+            result = run_startup(target, args.repeat, env)
+        else:
+            result = run_benchmark(kind, target, size, args.repeat, env, scratch)
+        results[name] = result
+        if 'error' in result:
+            print(f"{name:<42} ERROR {result['error']}")
+            continue
+        rss = f"{result['peak_rss_mb']:.0f}" if result['peak_rss_mb'] is not None else '-'
+        line = (f"{name:<42} {result['input_mb']:>9.2f} {result['p50_ms']:>10.1f} {result['p95_ms']:>10.1f} "
+                f"{result['p99_ms']:>10.1f} {result['points_per_s'] or 0:>12,} {rss:>8}")
+        problems = compare(result, baseline[name], args.tolerance) if name in baseline else []
+        if problems:
+            regressions.append((name, problems))
+            line += "  REGRESSION: " + "; ".join(problems)
+        print(line, flush=True)
+    if args.import_report:
+        import_report(env)
+    server.shutdown()
+    shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({
+                "meta": {
+                    "created": time.strftime('%Y-%m-%d'),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "cpus": os.cpu_count(),
+                    "repeat": args.repeat,
+                },
+                "results": results
+            }, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.save_baseline}")
+
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) regressed beyond {args.tolerance:.0%} of {args.baseline}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
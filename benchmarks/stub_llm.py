@@ -0,0 +1,72 @@
+"""A local stand-in for the Gemini API, so benchmarks measure the app and not the network.
+
+Answers generateContent and streamGenerateContent (SSE) with a short canned
+text. Run it on its own with
+
+    python benchmarks/stub_llm.py --port 8765 --latency 0.5
+
+and start the app with GEMINI_API_BASE=http://127.0.0.1:8765/v1beta.
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        prompt = body['contents'][0]['parts'][0]['text']
+        words = f"Stub analysis of a {len(prompt)} character prompt.".split()
+
+        if ':streamGenerateContent' in self.path:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for word in words:
+                time.sleep(self.latency / len(words))
+                event = {"candidates": [{"content": {"parts": [{"text": word + ' '}]}}]}
+                data = f"data: {json.dumps(event)}\r\n\r\n".encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+            return
+
+        time.sleep(self.latency)
+        data = json.dumps({"candidates": [{"content": {"parts": [{"text": ' '.join(words)}]}}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_stub(port=0, latency=0.0):
+    """Serve the stub on a background thread. Returns (server, api_base)."""
+    handler = type('Handler', (StubGeminiHandler,), {'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1beta"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds per answer")
+    args = parser.parse_args()
+    server, api_base = start_stub(args.port, args.latency)
+    print(f"Stub Gemini API at {api_base}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
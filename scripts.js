@@ -15,6 +15,34 @@ let lastBetResult = null;
 let lastTgaResult = null; // New global variable for TGA results
 let lastCombinedResult = null;
 
+// Wire format requested from the /analyze-* endpoints (records, columnar or float32)
+const RESPONSE_FORMAT = 'columnar';
+
+// --- Data Decoding Utility Functions ---
+function decodeFloat32(base64Text) {
+    const binary = atob(base64Text);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return Array.from(new Float32Array(bytes.buffer));
+}
+
+// Returns one column as an array, whether the backend sent row records or columns
+function columnOf(data, key) {
+    if (!data) {
+        return [];
+    }
+    if (Array.isArray(data)) {
+        return data.map(d => d[key]);
+    }
+    const column = data.columns ? data.columns[key] : undefined;
+    if (column === undefined) {
+        return [];
+    }
+    return typeof column === 'string' ? decodeFloat32(column) : column;
+}
+
 // --- Markdown and Plotting Utility Functions ---
 function formatMarkdownToHtml(markdownText) {
     let lines = markdownText.split('\n'),
@@ -51,8 +79,8 @@ function formatMarkdownToHtml(markdownText) {
 }
 
 function plotXRD(divId, fullData, title, peaks) {
-    const angles = fullData.map(d => d.Pos);
-    const intensities = fullData.map(d => d.Iobs);
+    const angles = columnOf(fullData, 'Pos');
+    const intensities = columnOf(fullData, 'Iobs');
     const peakAngles = peaks.map(p => p.Pos);
     const peakIntensities = peaks.map(p => p.Iobs);
 
@@ -89,8 +117,8 @@ function plotXRD(divId, fullData, title, peaks) {
 }
 
 function plotIR(divId, fullData, title, peaks) {
-    const wavenumbers = fullData.map(d => d.Wavenumber);
-    const absorbances = fullData.map(d => d.Absorbance);
+    const wavenumbers = columnOf(fullData, 'Wavenumber');
+    const absorbances = columnOf(fullData, 'Absorbance');
     const peakWavenumbers = peaks.map(p => p.Wavenumber);
     const peakAbsorbances = peaks.map(p => p.Absorbance);
 
@@ -128,8 +156,8 @@ function plotIR(divId, fullData, title, peaks) {
 }
 
 function plotBET(divId, fullData, title) {
-    const pP0 = fullData.map(d => d['P/P0']);
-    const betPlot = fullData.map(d => d['BET_Plot']);
+    const pP0 = columnOf(fullData, 'P/P0');
+    const betPlot = columnOf(fullData, 'BET_Plot');
 
     const data = [{
         x: pP0,
@@ -152,9 +180,9 @@ function plotBET(divId, fullData, title) {
 }
 
 function plotTGA(divId, fullData, title) {
-    const temps = fullData.map(d => d['Temp']);
-    const weights = fullData.map(d => d['Weight_normalized']);
-    const dtg = fullData.map(d => d['DTG']);
+    const temps = columnOf(fullData, 'Temp');
+    const weights = columnOf(fullData, 'Weight_normalized');
+    const dtg = columnOf(fullData, 'DTG');
 
     const data = [
         {
@@ -201,10 +229,10 @@ function plotTGA(divId, fullData, title) {
 }
 
 function plotCombinedXRD(divId, originalData, modifiedData) {
-    const originalAngles = originalData.map(d => d.Pos);
-    const originalIntensities = originalData.map(d => d.Iobs);
-    const modifiedAngles = modifiedData.map(d => d.Pos);
-    const modifiedIntensities = modifiedData.map(d => d.Iobs);
+    const originalAngles = columnOf(originalData, 'Pos');
+    const originalIntensities = columnOf(originalData, 'Iobs');
+    const modifiedAngles = columnOf(modifiedData, 'Pos');
+    const modifiedIntensities = columnOf(modifiedData, 'Iobs');
     const data = [
         {
             x: originalAngles,
@@ -233,10 +261,10 @@ function plotCombinedXRD(divId, originalData, modifiedData) {
 }
 
 function plotCombinedIR(divId, originalData, modifiedData) {
-    const originalWavenumbers = originalData.map(d => d.Wavenumber);
-    const originalAbsorbances = originalData.map(d => d.Absorbance);
-    const modifiedWavenumbers = modifiedData.map(d => d.Wavenumber);
-    const modifiedAbsorbances = modifiedData.map(d => d.Absorbance);
+    const originalWavenumbers = columnOf(originalData, 'Wavenumber');
+    const originalAbsorbances = columnOf(originalData, 'Absorbance');
+    const modifiedWavenumbers = columnOf(modifiedData, 'Wavenumber');
+    const modifiedAbsorbances = columnOf(modifiedData, 'Absorbance');
     const data = [
         {
             x: originalWavenumbers,
@@ -265,10 +293,10 @@ function plotCombinedIR(divId, originalData, modifiedData) {
 }
 
 function plotCombinedBET(divId, originalData, modifiedData) {
-    const originalPP0 = originalData.map(d => d['P/P0']);
-    const originalBetPlot = originalData.map(d => d['BET_Plot']);
-    const modifiedPP0 = modifiedData.map(d => d['P/P0']);
-    const modifiedBetPlot = modifiedData.map(d => d['BET_Plot']);
+    const originalPP0 = columnOf(originalData, 'P/P0');
+    const originalBetPlot = columnOf(originalData, 'BET_Plot');
+    const modifiedPP0 = columnOf(modifiedData, 'P/P0');
+    const modifiedBetPlot = columnOf(modifiedData, 'BET_Plot');
     const data = [
         {
             x: originalPP0,
@@ -297,6 +325,102 @@ function plotCombinedBET(divId, originalData, modifiedData) {
     };
     Plotly.newPlot(divId, data, layout, { responsive: true });
 }
+// Re-fetches full-resolution data for the visible window when the user zooms a plot.
+// The backend only sends a downsampled overview; trace 0 is the full scan.
+function enableZoomRefetch(divId, spectrumId, xKey, yKey) {
+    const plotDiv = document.getElementById(divId);
+    if (!spectrumId || !plotDiv.on) {
+        return;
+    }
+    const overview = { x: plotDiv.data[0].x, y: plotDiv.data[0].y };
+    plotDiv.removeAllListeners && plotDiv.removeAllListeners('plotly_relayout');
+    plotDiv.on('plotly_relayout', async (event) => {
+        if (event['xaxis.autorange']) {
+            Plotly.restyle(divId, { x: [overview.x], y: [overview.y] }, [0]);
+            return;
+        }
+        const start = event['xaxis.range[0]'];
+        const end = event['xaxis.range[1]'];
+        if (start === undefined || end === undefined) {
+            return;
+        }
+        const params = new URLSearchParams({
+            x_min: Math.min(start, end),
+            x_max: Math.max(start, end),
+            max_points: 5000,
+            format: RESPONSE_FORMAT
+        });
+        try {
+            const response = await fetch(`${BASE_URL}/spectrum/${spectrumId}?${params}`);
+            if (!response.ok) {
+                return;
+            }
+            const result = await response.json();
+            Plotly.restyle(divId, { x: [columnOf(result.data, xKey)], y: [columnOf(result.data, yKey)] }, [0]);
+        } catch (error) {
+            console.error(`Zoom re-fetch failed: ${error.message}`);
+        }
+    });
+}
+
+// Mass-loss steps detected in a thermogram, lowest temperature first.
+function formatTgaSteps(steps) {
+    if (!steps || !steps.length) {
+        return 'None detected';
+    }
+    return steps.map(s =>
+        `${s.onset_temp}–${s.offset_temp} °C (DTG peak ${s.peak_temp} °C): ${s.mass_loss_percent}%`
+    ).join('; ');
+}
+
+// Fitted peak profiles (FWHM, area, Scherrer size), one table per scan.
+function peakProfileTable(title, profiles) {
+    const format = value => value === null || value === undefined ? '–' : value;
+    const rows = (profiles || []).map(p => `
+        <tr><td>${format(p.Pos)}</td><td>${format(p.FWHM)}</td><td>${format(p.Area)}</td><td>${format(p.Crystallite_Size_nm)}</td></tr>
+    `).join('');
+    return `
+        <div>
+            <p class="font-semibold mb-1">${title}</p>
+            <table class="w-full text-left">
+                <thead><tr><th>2θ (°)</th><th>FWHM (°)</th><th>Area</th><th>Size (nm)</th></tr></thead>
+                <tbody>${rows}</tbody>
+            </table>
+        </div>
+    `;
+}
+
+function showPeakProfiles(divId, originalProfiles, modifiedProfiles) {
+    const container = document.getElementById(divId);
+    if (!(originalProfiles && originalProfiles.length) && !(modifiedProfiles && modifiedProfiles.length)) {
+        container.style.display = 'none';
+        return;
+    }
+    container.querySelector('div').innerHTML =
+        peakProfileTable('Original', originalProfiles) + peakProfileTable('Modified', modifiedProfiles);
+    container.style.display = 'block';
+}
+
+// Candidate phases from reference-pattern matching, best first.
+function formatPhaseCandidates(phases) {
+    return phases.map(p =>
+        `${p.phase} (FoM ${p.figure_of_merit}, ${p.matched_peaks}/${p.total_peaks} peaks, Δ2θ ${p.mean_delta_2theta}°)`
+    ).join('; ');
+}
+
+function showPhaseCandidates(divId, originalPhases, modifiedPhases) {
+    const container = document.getElementById(divId);
+    if (!(originalPhases && originalPhases.length) && !(modifiedPhases && modifiedPhases.length)) {
+        container.style.display = 'none';
+        return;
+    }
+    container.querySelector('div').innerHTML = `
+        <p><strong>Original:</strong> ${originalPhases && originalPhases.length ? formatPhaseCandidates(originalPhases) : 'No match'}</p>
+        <p><strong>Modified:</strong> ${modifiedPhases && modifiedPhases.length ? formatPhaseCandidates(modifiedPhases) : 'No match'}</p>
+    `;
+    container.style.display = 'block';
+}
+
 // --- Form Submission Handlers ---
 
 // Individual forms
@@ -309,7 +433,7 @@ document.getElementById('xrdForm').addEventListener('submit', async (e) => {
     const formData = new FormData(e.target);
     
     try {
-        const response = await fetch(`${BASE_URL}/analyze-xrd`, {
+        const response = await fetch(`${BASE_URL}/analyze-xrd?format=${RESPONSE_FORMAT}`, {
             method: 'POST',
             body: formData,
         });
@@ -318,6 +442,10 @@ document.getElementById('xrdForm').addEventListener('submit', async (e) => {
         if (response.ok) {
             plotXRD('xrdOriginalPlot', result.original_data, 'Original XRD Data', result.original_peaks);
             plotXRD('xrdModifiedPlot', result.modified_data, 'Modified XRD Data', result.modified_peaks);
+            enableZoomRefetch('xrdOriginalPlot', result.original_spectrum_id, 'Pos', 'Iobs');
+            enableZoomRefetch('xrdModifiedPlot', result.modified_spectrum_id, 'Pos', 'Iobs');
+            showPeakProfiles('xrdProfiles', result.original_profiles, result.modified_profiles);
+            showPhaseCandidates('xrdPhases', result.original_phases, result.modified_phases);
             
             const aiSuggestionDiv = document.querySelector('#xrdAiSuggestion .markdown-content');
             aiSuggestionDiv.innerHTML = formatMarkdownToHtml(result.ai_suggestion);
@@ -346,7 +474,7 @@ document.getElementById('irForm').addEventListener('submit', async (e) => {
     const formData = new FormData(e.target);
     
     try {
-        const response = await fetch(`${BASE_URL}/analyze-ir`, {
+        const response = await fetch(`${BASE_URL}/analyze-ir?format=${RESPONSE_FORMAT}`, {
             method: 'POST',
             body: formData,
         });
@@ -355,6 +483,8 @@ document.getElementById('irForm').addEventListener('submit', async (e) => {
         if (response.ok) {
             plotIR('irOriginalPlot', result.original_data, 'Original IR Data', result.original_peaks);
             plotIR('irModifiedPlot', result.modified_data, 'Modified IR Data', result.modified_peaks);
+            enableZoomRefetch('irOriginalPlot', result.original_spectrum_id, 'Wavenumber', 'Absorbance');
+            enableZoomRefetch('irModifiedPlot', result.modified_spectrum_id, 'Wavenumber', 'Absorbance');
             
             const aiSuggestionDiv = document.querySelector('#irAiSuggestion .markdown-content');
             aiSuggestionDiv.innerHTML = formatMarkdownToHtml(result.ai_suggestion);
@@ -383,7 +513,7 @@ document.getElementById('betForm').addEventListener('submit', async (e) => {
     const formData = new FormData(e.target);
     
     try {
-        const response = await fetch(`${BASE_URL}/analyze-bet`, {
+        const response = await fetch(`${BASE_URL}/analyze-bet?format=${RESPONSE_FORMAT}`, {
             method: 'POST',
             body: formData,
         });
@@ -439,12 +569,13 @@ document.getElementById('tgaForm').addEventListener('submit', async (e) => {
         const result = await response.json();
 
         if (response.ok) {
-            // Check if the response contains plot data or summary data
-            if (result.tga_data && Array.isArray(result.tga_data)) {
-                // This branch would handle the full plot data if the backend was updated
+            // A thermogram comes with a curve and a step summary; an adsorption table only with values
+            if (result.tga_data) {
                 plotTGA('tgaPlot', result.tga_data, 'TGA Analysis');
+                document.getElementById('totalWeightLoss').textContent = result.tga_results.total_weight_loss;
+                document.getElementById('tgaPeakInfo').textContent = formatTgaSteps(result.tga_results.steps);
                 document.getElementById('tgaPlot').style.display = 'block';
-                document.getElementById('tgaSummary').style.display = 'none';
+                document.getElementById('tgaSummary').style.display = 'block';
             } else if (result.tga_results) {
                 // This branch handles the current backend response with adsorption/desorption
                 const tgaDiv = document.getElementById('tgaPlot');
@@ -499,9 +630,10 @@ document.getElementById('analyzeAllForm').addEventListener('submit', async (e) =
     if (modifiedBetFile) formData.append('modified_bet_file', modifiedBetFile);
     if (tgaFile) formData.append('tga_file', tgaFile);
     formData.append('ai_query', document.getElementById('aiQueryCombined').value);
+    if (document.getElementById('combinedBypassCache').checked) formData.append('bypass_cache', '1');
 
     try {
-        const response = await fetch(`${BASE_URL}/analyze-combined`, {
+        const response = await fetch(`${BASE_URL}/analyze-combined?format=${RESPONSE_FORMAT}`, {
             method: 'POST',
             body: formData,
         });
@@ -536,16 +668,15 @@ document.getElementById('analyzeAllForm').addEventListener('submit', async (e) =
                 document.getElementById('betModifiedPlotCombined').style.display = 'none';
             }
 
-            if (result.tga_data) {
+            if (result.tga_results) {
                 document.getElementById('tgaPlotCombined').style.display = 'block';
-                // Check if the data is an array before trying to map it
-                if (Array.isArray(result.tga_data)) {
+                if (result.tga_data) {
                     plotTGA('tgaPlotCombined', result.tga_data, 'TGA Analysis');
                 } else {
-                    // Handle the TGA data as a dictionary
+                    // An adsorption table has values but no curve
                     const tgaDiv = document.getElementById('tgaPlotCombined');
-                    tgaDiv.innerHTML = `<p><strong>Adsorption Capacity:</strong> ${result.tga_data.adsorption_capacity}</p>
-                                        <p><strong>Desorption Energy:</strong> ${result.tga_data.desorption_energy}</p>`;
+                    tgaDiv.innerHTML = `<p><strong>Adsorption Capacity:</strong> ${result.tga_results.adsorption_capacity}</p>
+                                        <p><strong>Desorption Energy:</strong> ${result.tga_results.desorption_energy}</p>`;
                 }
             } else {
                 document.getElementById('tgaPlotCombined').style.display = 'none';
@@ -592,6 +723,30 @@ document.getElementById('combinedFollowUpBtn').addEventListener('click', async (
     await handleFollowUp('combined', document.getElementById('combinedFollowUpQuery').value, lastCombinedResult);
 });
 
+// Reads a text/event-stream response and calls onEvent(name, data) for each event
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let eventName = 'message';
+            let dataText = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                else if (line.startsWith('data:')) dataText += line.slice(5).trim();
+            });
+            if (dataText) onEvent(eventName, JSON.parse(dataText));
+        }
+    }
+}
+
 async function handleFollowUp(type, query, previousAnalysis) {
     if (!query) {
         alert("Please enter a question.");
@@ -605,23 +760,42 @@ async function handleFollowUp(type, query, previousAnalysis) {
     
     const formData = new FormData();
     formData.append('user_query', query);
-    formData.append('previous_analysis', JSON.stringify(previousAnalysis));
+    // The server keeps a summary of the analysis; older responses without an ID send it back whole
+    if (previousAnalysis && previousAnalysis.analysis_id) {
+        formData.append('analysis_id', previousAnalysis.analysis_id);
+    } else {
+        formData.append('previous_analysis', JSON.stringify(previousAnalysis));
+    }
+    formData.append('stream', '1');
     
     try {
         const response = await fetch(`${BASE_URL}/analyze-${type}-followup`, {
             method: 'POST',
             body: formData,
         });
-        const result = await response.json();
         
         if (response.ok) {
             const followUpHtml = `
                 <div class="mt-4 p-4 bg-gray-100 rounded-lg border border-gray-200">
                     <h5 class="text-md font-semibold text-gray-800 mb-2">Follow-up Response</h5>
-                    <div class="markdown-content text-gray-700">${formatMarkdownToHtml(result.ai_suggestion)}</div>
+                    <div class="markdown-content text-gray-700"></div>
                 </div>`;
-            document.getElementById(`${type}FollowUpSection`).insertAdjacentHTML('beforeend', followUpHtml);
+            const section = document.getElementById(`${type}FollowUpSection`);
+            section.insertAdjacentHTML('beforeend', followUpHtml);
+            const contentDiv = section.lastElementChild.querySelector('.markdown-content');
+            let text = '';
+            // Render the answer progressively as tokens arrive
+            await readEventStream(response, (eventName, data) => {
+                if (eventName === 'token') {
+                    text += data.text;
+                    loadingDiv.style.display = 'none';
+                } else if (eventName === 'done') {
+                    text = data.ai_suggestion;
+                }
+                contentDiv.innerHTML = formatMarkdownToHtml(text);
+            });
         } else {
+            const result = await response.json();
             errorDiv.textContent = result.error || 'Unknown error occurred during follow-up.';
             errorDiv.style.display = 'block';
         }
@@ -643,9 +817,7 @@ document.getElementById('xrdHistoryBtn').addEventListener('click', async () => {
         return;
     }
     try {
-        const resp = await fetch(`${BASE_URL}/history/xrd`);
-        xrdHistoryData = await resp.json();
-        updateHistoryUI('xrd');
+        await loadHistory('xrd');
         container.classList.remove('hidden');
     } catch (err) {
         const contentDiv = document.getElementById('xrdHistoryContent');
@@ -662,9 +834,7 @@ document.getElementById('irHistoryBtn').addEventListener('click', async () => {
         return;
     }
     try {
-        const resp = await fetch(`${BASE_URL}/history/ir`);
-        irHistoryData = await resp.json();
-        updateHistoryUI('ir');
+        await loadHistory('ir');
         container.classList.remove('hidden');
     } catch (err) {
         const contentDiv = document.getElementById('irHistoryContent');
@@ -682,9 +852,7 @@ document.getElementById('betHistoryBtn').addEventListener('click', async () => {
         return;
     }
     try {
-        const resp = await fetch(`${BASE_URL}/history/bet`);
-        betHistoryData = await resp.json();
-        updateHistoryUI('bet');
+        await loadHistory('bet');
         container.classList.remove('hidden');
     } catch (err) {
         const contentDiv = document.getElementById('betHistoryContent');
@@ -701,9 +869,7 @@ document.getElementById('tgaHistoryBtn').addEventListener('click', async () => {
         return;
     }
     try {
-        const resp = await fetch(`${BASE_URL}/history/tga`);
-        tgaHistoryData = await resp.json();
-        updateHistoryUI('tga');
+        await loadHistory('tga');
         container.classList.remove('hidden');
     } catch (err) {
         const contentDiv = document.getElementById('tgaHistoryContent');
@@ -721,9 +887,7 @@ document.getElementById('combinedHistoryBtn').addEventListener('click', async ()
         return;
     }
     try {
-        const resp = await fetch(`${BASE_URL}/history/combined`);
-        combinedHistoryData = await resp.json();
-        updateHistoryUI('combined');
+        await loadHistory('combined');
         container.classList.remove('hidden');
     } catch (err) {
         const contentDiv = document.getElementById('combinedHistoryContent');
@@ -732,6 +896,47 @@ document.getElementById('combinedHistoryBtn').addEventListener('click', async ()
     }
 });
 
+// Pagination/search state per history type; the server does the filtering
+const historyState = {
+    xrd: { query: '', nextCursor: null },
+    ir: { query: '', nextCursor: null },
+    bet: { query: '', nextCursor: null },
+    tga: { query: '', nextCursor: null },
+    combined: { query: '', nextCursor: null }
+};
+const HISTORY_PAGE_SIZE = 50;
+const historySearchTimers = {};
+
+function setHistoryData(type, items) {
+    if (type === 'xrd') xrdHistoryData = items;
+    else if (type === 'ir') irHistoryData = items;
+    else if (type === 'bet') betHistoryData = items;
+    else if (type === 'tga') tgaHistoryData = items;
+    else combinedHistoryData = items;
+}
+
+// Fetches one page of history. With append, the page is added to what is already shown.
+async function loadHistory(type, append = false) {
+    const state = historyState[type];
+    const params = new URLSearchParams({ limit: HISTORY_PAGE_SIZE });
+    if (state.query) params.set('q', state.query);
+    if (append && state.nextCursor) params.set('cursor', state.nextCursor);
+
+    const resp = await fetch(`${BASE_URL}/history/${type}?${params}`);
+    const page = await resp.json();
+    if (!resp.ok) {
+        throw new Error(page.error || 'Unknown error occurred.');
+    }
+    const current = type === 'xrd' ? xrdHistoryData :
+                    type === 'ir' ? irHistoryData :
+                    type === 'bet' ? betHistoryData :
+                    type === 'tga' ? tgaHistoryData :
+                    combinedHistoryData;
+    setHistoryData(type, append ? current.concat(page.items) : page.items);
+    state.nextCursor = page.next_cursor;
+    updateHistoryUI(type);
+}
+
 function updateHistoryUI(type) {
     const data = type === 'xrd' ? xrdHistoryData :
                  type === 'ir' ? irHistoryData :
@@ -743,7 +948,9 @@ function updateHistoryUI(type) {
     contentDiv.innerHTML = ''; // Clear previous content
 
     if (data.length === 0) {
-        contentDiv.innerHTML = `<p class="text-gray-500">No analysis history found.</p>`;
+        contentDiv.innerHTML = historyState[type].query
+            ? `<p class="text-gray-500">No matching analysis history found.</p>`
+            : `<p class="text-gray-500">No analysis history found.</p>`;
         return;
     }
 
@@ -765,6 +972,12 @@ function updateHistoryUI(type) {
                 <p><strong>Original XRD Peaks:</strong> ${originalPeaks}</p>
                 <p><strong>Modified XRD Peaks:</strong> ${modifiedPeaks}</p>
             `;
+            if (item.original_phases && item.original_phases.length) {
+                details += `<p><strong>Original Candidate Phases:</strong> ${formatPhaseCandidates(item.original_phases)}</p>`;
+            }
+            if (item.modified_phases && item.modified_phases.length) {
+                details += `<p><strong>Modified Candidate Phases:</strong> ${formatPhaseCandidates(item.modified_phases)}</p>`;
+            }
         }
         if (type === 'ir' || type === 'combined') {
             const originalPeaks = item.original_ir_peaks ? JSON.stringify(item.original_ir_peaks) : 'N/A';
@@ -784,8 +997,13 @@ function updateHistoryUI(type) {
         }
         if (type === 'tga' || type === 'combined') {
             // Check if tga_results exists and is an object
-            const tgaResults = item.tga_results;
-            if (tgaResults) {
+            const tgaResults = item.tga_results || (item.adsorption_capacity ? item : null);
+            if (tgaResults && tgaResults.steps) {
+                details += `
+                    <p><strong>Total Weight Loss:</strong> ${tgaResults.total_weight_loss}%</p>
+                    <p><strong>Mass-Loss Steps:</strong> ${formatTgaSteps(tgaResults.steps)}</p>
+                `;
+            } else if (tgaResults) {
                 const adsorption = tgaResults.adsorption_capacity ? tgaResults.adsorption_capacity : 'N/A';
                 const desorption = tgaResults.desorption_energy ? tgaResults.desorption_energy : 'N/A';
                 details += `
@@ -803,47 +1021,28 @@ function updateHistoryUI(type) {
         historyItem.innerHTML = details;
         contentDiv.appendChild(historyItem);
     });
+
+    if (historyState[type].nextCursor) {
+        const loadMoreBtn = document.createElement('button');
+        loadMoreBtn.className = 'w-full py-2 text-sm text-blue-600 hover:underline';
+        loadMoreBtn.textContent = 'Load more';
+        loadMoreBtn.addEventListener('click', () => loadHistory(type, true));
+        contentDiv.appendChild(loadMoreBtn);
+    }
 }
 
 function filterHistory(type, query) {
-    const data = type === 'xrd' ? xrdHistoryData :
-                 type === 'ir' ? irHistoryData :
-                 type === 'bet' ? betHistoryData :
-                 type === 'tga' ? tgaHistoryData :
-                 combinedHistoryData;
-                 
-    const contentDiv = document.getElementById(`${type}HistoryContent`);
-    contentDiv.innerHTML = '';
-    
-    const filteredData = data.filter(item => {
-        const aiSuggestion = item.ai_suggestion.toLowerCase();
-        const userQuery = item.user_query ? item.user_query.toLowerCase() : '';
-        const timestamp = new Date(item.timestamp).toLocaleString().toLowerCase();
-        return aiSuggestion.includes(query) || userQuery.includes(query) || timestamp.includes(query);
-    });
-    
-    if (filteredData.length === 0) {
-        contentDiv.innerHTML = `<p class="text-gray-500">No matching analysis history found.</p>`;
-        return;
-    }
-    
-    filteredData.forEach(item => {
-        const historyItem = document.createElement('div');
-        historyItem.className = 'history-row p-3 mb-2 rounded-lg bg-white border border-gray-200 shadow-sm transition-transform transform hover:scale-[1.01]';
-        
-        let details = `
-            <p><strong>Date:</strong> ${new Date(item.timestamp).toLocaleString()}</p>
-        `;
-        if (item.user_query) {
-            details += `<p><strong>Query:</strong> ${item.user_query}</p>`;
+    // Debounce keystrokes, then let the server run the full-text search
+    clearTimeout(historySearchTimers[type]);
+    historySearchTimers[type] = setTimeout(async () => {
+        historyState[type].query = query.trim();
+        historyState[type].nextCursor = null;
+        try {
+            await loadHistory(type);
+        } catch (err) {
+            document.getElementById(`${type}HistoryContent`).innerHTML = `<p class="text-red-600">Error searching history: ${err.message}</p>`;
         }
-        
-        const aiSummary = item.ai_suggestion ? item.ai_suggestion.substring(0, 150) + '...' : 'N/A';
-        details += `<p class="mt-2 text-sm text-gray-600"><strong>AI Summary:</strong> ${aiSummary}</p>`;
-        
-        historyItem.innerHTML = details;
-        contentDiv.appendChild(historyItem);
-    });
+    }, 250);
 }
 
 // Search listeners
@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# app reads its storage settings at import time, so point them at scratch space first
+SCRATCH = tempfile.mkdtemp(prefix='xrd-tests-')
+os.environ.setdefault('HISTORY_DB', ':memory:')
+os.environ.setdefault('SPECTRA_DIR', os.path.join(SCRATCH, 'spectra'))
+os.environ.setdefault('SIMILARITY_DIR', os.path.join(SCRATCH, 'similarity'))
+os.environ.setdefault('PARSE_CACHE_DIR', '')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import app
+
+VM, C = 80.0, 120.0
+
+
+def isotherm(n):
+    """Noise-free type II isotherm that follows BET up to P/P0 = 0.35."""
+    p = np.linspace(0.005, 0.95, n)
+    va = VM * C * p / ((1 - p) * (1 + (C - 1) * p))
+    return p, np.where(p < 0.35, va, va * (1 - 0.5 * (p - 0.35)))
+
+
+def classic_fit(p, va):
+    """The fit the app used before Rouquerol selection: LinearRegression over 0.05-0.35."""
+    linear_model = pytest.importorskip('sklearn.linear_model')
+    low, high = app.BET_FALLBACK_RANGE
+    inside = (p >= low) & (p <= high)
+    model = linear_model.LinearRegression().fit(p[inside, None], p[inside] / (va[inside] * (1 - p[inside])))
+    slope, intercept = model.coef_[0], model.intercept_
+    return 1 / (slope + intercept), slope / intercept + 1
+
+
+@pytest.mark.parametrize('n', [120, 1200])
+def test_fit_bet_matches_classic_window(n):
+    p, va = isotherm(n)
+    fit = app.fit_bet(p, va)
+    vm, c = classic_fit(p, va)
+
+    assert fit['vm'] == pytest.approx(vm, rel=1e-3)
+    assert fit['c'] == pytest.approx(c, rel=1e-2)
+    assert fit['vm'] == pytest.approx(VM, rel=1e-3)
+    # The window holds the monolayer pressure and stays in the BET range
+    assert fit['p_min'] <= 1 / (np.sqrt(fit['c']) + 1) <= fit['p_max'] < 0.35
+    assert fit['n_points'] == ((p >= fit['p_min']) & (p <= fit['p_max'])).sum()
+
+
+def test_thinned_isotherm_is_refitted_on_every_point():
+    p, va = isotherm(app.BET_MAX_FIT_POINTS * 4)
+    fit = app.fit_bet(p, va)
+
+    assert fit['n_points'] > app.BET_MAX_FIT_POINTS // 2
+    assert fit['n_points'] == ((p >= fit['p_min']) & (p <= fit['p_max'])).sum()
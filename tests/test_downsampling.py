@@ -0,0 +1,17 @@
+import numpy as np
+
+import app
+
+
+def test_lttb_keeps_endpoints_and_extremes():
+    x = np.linspace(0, 100, 50_000)
+    y = np.sin(x / 7) + np.random.default_rng(0).normal(0, 0.01, len(x))
+    y[12_345] = 5
+    y[37_000] = -5
+
+    indices = app.lttb_indices(x, y, 500)
+
+    assert len(indices) == 500
+    assert np.all(np.diff(indices) > 0)
+    assert indices[0] == 0 and indices[-1] == len(x) - 1
+    assert np.argmax(y) in indices and np.argmin(y) in indices
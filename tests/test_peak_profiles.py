@@ -0,0 +1,24 @@
+import io
+import math
+
+import numpy as np
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import app
+import generators
+
+
+def test_gaussian_fwhm_is_recovered():
+    sigma = 0.0354
+    pos = np.arange(20, 40, 0.005)
+    intensity = 50 + 1000 * np.exp(-((pos - 30) ** 2) / (2 * sigma ** 2))
+    raw = generators.to_csv("Pos,Iobs", [pos, intensity], ['%.4f', '%.3f'])
+    df, peaks = app.parse_xrd_data(FileStorage(io.BytesIO(raw), filename='gaussian.csv'))
+
+    profiles = app.fit_peak_profiles(df, peaks)
+
+    assert len(profiles) == len(peaks) == 1
+    assert profiles[0]['Pos'] == pytest.approx(30, abs=0.005)
+    assert profiles[0]['FWHM'] == pytest.approx(2 * sigma * math.sqrt(2 * math.log(2)), rel=0.01)
+    assert profiles[0]['Eta'] < 0.1
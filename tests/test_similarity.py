@@ -0,0 +1,25 @@
+import io
+
+import app
+import generators
+
+
+def test_identical_spectrum_ranks_first(monkeypatch):
+    monkeypatch.setattr(app, 'get_ai_suggestion', lambda *args, **kwargs: "ok")
+    client = app.app.test_client()
+    scans = {seed: generators.xrd_scan(2000, seed) for seed in range(4)}
+    for seed in (0, 2):
+        response = client.post('/analyze-xrd', data={
+            'original_file': (io.BytesIO(scans[seed]), f"scan{seed}.csv"),
+            'modified_file': (io.BytesIO(scans[seed + 1]), f"scan{seed + 1}.csv"),
+        }, content_type='multipart/form-data')
+        assert response.status_code == 200
+
+    response = client.post('/similar/xrd', data={'file': (io.BytesIO(scans[2]), 'query.csv')},
+                           content_type='multipart/form-data')
+
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert results[0]['file_name'] == 'scan2.csv'
+    assert results[0]['similarity'] > 0.99
+    assert results[0]['similarity'] > results[1]['similarity']